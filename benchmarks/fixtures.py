@@ -0,0 +1,308 @@
+# -*- coding: utf-8 -*-
+
+# ocitysmap, city map and street index generator from OpenStreetMap data
+# Copyright (C) 2023  Hartmut Holzgraefe
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Synthetic benchmark fixture data
+
+All data is generated from a fixed random seed, so that every run of
+a given size works on exactly the same input. Sizes are modelled after
+real cities: '1k' streets is a small town, '10k' a large city, and
+'50k' a metropolitan area rendered as a multi page atlas.
+"""
+
+import json
+import math
+import os
+import random
+
+# Number of streets per fixture size
+SIZES = { '1k': 1000, '10k': 10000, '50k': 50000 }
+
+# Paris sized area around the city center
+CITY_BBOX = (48.90, 2.25, 48.80, 2.42)
+
+# Map scale denominator, as used for grids on A1 paper
+CITY_SCALE = 25000
+
+STREET_TYPES = ['Rue', 'Avenue', 'Boulevard', 'Place', 'Impasse', 'Allée',
+                'Quai', 'Chemin', 'Passage', 'Square', 'Cité', 'Villa']
+
+AMENITY_CATEGORIES = ['Schools', 'Places of worship', 'Public buildings',
+                      'Health', 'Culture', 'Police', 'Post offices',
+                      'Parking', 'Transport']
+
+SYLLABLES = ['ar', 'be', 'cha', 'de', 'du', 'fon', 'gre', 'la', 'le', 'lou',
+             'ma', 'mon', 'ne', 'pa', 'ri', 'ro', 'sa', 'sen', 'ti', 'vil']
+
+
+class Fixture:
+    """
+    Lazily generated benchmark input data of one size.
+    """
+
+    def __init__(self, size, seed=42):
+        """
+        Parameters
+        ----------
+        size : str
+            One of the SIZES keys
+        seed : int, optional
+            Random seed, all data derives from it
+        """
+        self.size = size
+        self.street_count = SIZES[size]
+        self.seed = seed
+        self._cache = {}
+
+    def _random(self, what):
+        return random.Random("%s-%s-%s" % (self.seed, self.size, what))
+
+    def _cached(self, key, factory):
+        if key not in self._cache:
+            self._cache[key] = factory()
+        return self._cache[key]
+
+    def bounding_box(self):
+        from ocitysmap.coords import BoundingBox
+        return BoundingBox(*CITY_BBOX)
+
+    def grid(self):
+        from ocitysmap.maplib.grid import Grid
+        return self._cached('grid', lambda: Grid(self.bounding_box(), CITY_SCALE))
+
+    def i18n(self):
+        import ocitysmap.i18n
+        locale_path = os.path.join(os.path.dirname(__file__), '..', 'locale')
+        return self._cached('i18n', lambda: ocitysmap.i18n.install_translation(
+            'en_US.UTF-8', locale_path))
+
+    def street_names(self):
+        """ Street names, with some names occurring more than once """
+        def generate():
+            rnd = self._random('names')
+            names = []
+            for i in range(self.street_count):
+                if names and rnd.random() < 0.05:
+                    # same street name in different parts of the city
+                    names.append(rnd.choice(names))
+                    continue
+                name = ''.join(rnd.choice(SYLLABLES)
+                               for n in range(rnd.randint(2, 4))).capitalize()
+                names.append('%s %s' % (rnd.choice(STREET_TYPES), name))
+            return names
+        return self._cached('names', generate)
+
+    def endpoints(self):
+        """ (lat, lon) endpoint pairs of all streets within the bbox """
+        def generate():
+            rnd = self._random('endpoints')
+            lat1, lon1, lat2, lon2 = CITY_BBOX
+            result = []
+            for i in range(self.street_count):
+                lat = rnd.uniform(lat2, lat1)
+                lon = rnd.uniform(lon1, lon2)
+                length = rnd.expovariate(1 / 0.003)
+                angle = rnd.uniform(0, math.pi)
+                result.append(((lat, lon),
+                               (min(max(lat + length * math.sin(angle), lat2), lat1),
+                                min(max(lon + length * math.cos(angle), lon1), lon2))))
+            return result
+        return self._cached('endpoints', generate)
+
+    def index_items(self, page_count=None):
+        """ Fresh GeneralIndexItem list for all streets
+
+        Parameters
+        ----------
+        page_count : int, optional
+            Distribute items over this many atlas pages
+
+        Returns
+        -------
+        list of GeneralIndexItem
+        """
+        from ocitysmap.coords import Point
+        from ocitysmap.indexlib.GeneralIndex import GeneralIndexItem
+
+        rnd = self._random('pages')
+        items = []
+        for name, (ep1, ep2) in zip(self.street_names(), self.endpoints()):
+            page_number = rnd.randint(1, page_count) if page_count else None
+            items.append(GeneralIndexItem(name, Point(*ep1), Point(*ep2),
+                                          page_number))
+        return items
+
+    def categories(self, page_count=None, with_locations=True):
+        """ Fresh street and amenity index categories
+
+        Street categories are grouped by first letter, like the
+        StreetIndex does, plus amenity categories with one entry
+        per 20 streets in total.
+
+        Parameters
+        ----------
+        page_count : int, optional
+            Distribute items over this many atlas pages
+        with_locations : bool, optional
+            Fill in the grid location strings
+
+        Returns
+        -------
+        list of GeneralIndexCategory
+        """
+        from ocitysmap.indexlib.GeneralIndex import GeneralIndexCategory
+
+        items = self.index_items(page_count)
+        if with_locations:
+            grid = self.grid()
+            for item in items:
+                item.update_location_str(grid)
+
+        streets = {}
+        for item in items:
+            letter = item.label.split(' ', 1)[1][0]
+            streets.setdefault(letter, []).append(item)
+
+        categories = [GeneralIndexCategory(letter,
+                                           sorted(streets[letter], key=lambda i: i.label),
+                                           is_street=True)
+                      for letter in sorted(streets)]
+
+        categories += self.amenity_categories(page_count, with_locations)
+
+        return categories
+
+    def amenity_categories(self, page_count=None, with_locations=True):
+        """ Fresh amenity categories, with some duplicated entries """
+        from ocitysmap.coords import Point
+        from ocitysmap.indexlib.GeneralIndex import GeneralIndexCategory, GeneralIndexItem
+
+        rnd = self._random('amenities')
+        lat1, lon1, lat2, lon2 = CITY_BBOX
+        grid = self.grid() if with_locations else None
+
+        categories = []
+        per_category = max(1, self.street_count // 20 // len(AMENITY_CATEGORIES))
+        for category_name in AMENITY_CATEGORIES:
+            items = []
+            for i in range(per_category):
+                point = Point(rnd.uniform(lat2, lat1), rnd.uniform(lon1, lon2))
+                label = '%s %d' % (category_name, rnd.randint(1, per_category))
+                page_number = rnd.randint(1, page_count) if page_count else None
+                item = GeneralIndexItem(label, point, point, page_number)
+                if grid is not None:
+                    item.update_location_str(grid)
+                items.append(item)
+            categories.append(GeneralIndexCategory(category_name, items,
+                                                   is_street=False))
+        return categories
+
+    def page_indexes(self, page_count):
+        """ Per page indexes as collected by the MultiPageRenderer """
+        from ocitysmap.indexlib.GeneralIndex import GeneralIndexCategory
+
+        class PageIndex:
+            def __init__(self):
+                self.categories = []
+
+        pages = [PageIndex() for i in range(page_count)]
+        for category in self.categories(page_count):
+            per_page = {}
+            for item in category.items:
+                per_page.setdefault(item.page_number, []).append(item)
+            for page_number, items in per_page.items():
+                pages[page_number - 1].categories.append(
+                    GeneralIndexCategory(category.name, items, category.is_street))
+        return pages
+
+    def boundary_wkt(self):
+        """ City boundary polygon with one vertex per 10 streets """
+        def generate():
+            rnd = self._random('boundary')
+            lat1, lon1, lat2, lon2 = CITY_BBOX
+            center_lat, center_lon = (lat1 + lat2) / 2, (lon1 + lon2) / 2
+            radius_lat, radius_lon = (lat1 - lat2) / 2, (lon2 - lon1) / 2
+            vertices = max(16, self.street_count // 10)
+            points = []
+            for i in range(vertices):
+                angle = 2 * math.pi * i / vertices
+                r = rnd.uniform(0.8, 0.95)
+                points.append('%f %f' % (center_lon + r * radius_lon * math.cos(angle),
+                                         center_lat + r * radius_lat * math.sin(angle)))
+            points.append(points[0])
+            return 'POLYGON((%s))' % ','.join(points)
+        return self._cached('boundary', generate)
+
+    def write_gpx(self, filename):
+        """ GPX file with one track point per street """
+        rnd = self._random('gpx')
+        lat1, lon1, lat2, lon2 = CITY_BBOX
+        lat, lon = (lat1 + lat2) / 2, (lon1 + lon2) / 2
+        points = []
+        for i in range(self.street_count):
+            lat = min(max(lat + rnd.uniform(-0.0005, 0.0005), lat2), lat1)
+            lon = min(max(lon + rnd.uniform(-0.0005, 0.0005), lon1), lon2)
+            points.append('<trkpt lat="%f" lon="%f"/>' % (lat, lon))
+
+        with open(filename, 'w', encoding='utf-8') as f:
+            f.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+                    '<gpx version="1.1" creator="ocitysmap benchmarks" '
+                    'xmlns="http://www.topografix.com/GPX/1/1">\n'
+                    '<metadata><name>Benchmark track</name></metadata>\n'
+                    '<trk><name>Benchmark track</name><trkseg>\n%s\n'
+                    '</trkseg></trk>\n</gpx>\n' % "\n".join(points))
+
+    def write_umap(self, filename):
+        """ Umap file with one feature per 10 streets """
+        rnd = self._random('umap')
+        lat1, lon1, lat2, lon2 = CITY_BBOX
+        features = []
+        for i in range(max(10, self.street_count // 10)):
+            lat, lon = rnd.uniform(lat2, lat1), rnd.uniform(lon1, lon2)
+            kind = i % 3
+            if kind == 0:
+                geometry = { 'type': 'Point', 'coordinates': [lon, lat] }
+                properties = { 'name': 'Marker %d' % i,
+                               '_umap_options': { 'iconClass': rnd.choice(['Default', 'Circle', 'Drop']),
+                                                  'color': rnd.choice(['red', 'DarkBlue', '#00ff00']) } }
+            elif kind == 1:
+                geometry = { 'type': 'LineString',
+                             'coordinates': [[lon + 0.001 * n, lat + 0.0005 * n] for n in range(20)] }
+                properties = { 'name': 'Line %d' % i,
+                               '_umap_options': { 'weight': rnd.randint(1, 8),
+                                                  'dashArray': '5,10' } }
+            else:
+                geometry = { 'type': 'Polygon',
+                             'coordinates': [[[lon, lat], [lon + 0.002, lat],
+                                              [lon + 0.002, lat + 0.001],
+                                              [lon, lat + 0.001], [lon, lat]]] }
+                properties = { 'name': 'Area %d' % i,
+                               '_umap_options': { 'fillColor': 'yellow',
+                                                  'fillOpacity': 0.4 } }
+            features.append({ 'type': 'Feature', 'geometry': geometry,
+                              'properties': properties })
+
+        umap = {
+            'type': 'umap',
+            'properties': { 'name': 'Benchmark map',
+                            'licence': { 'name': 'ODbL' } },
+            'layers': [ { 'type': 'FeatureCollection',
+                          '_umap_options': { 'color': 'blue' },
+                          'features': features } ],
+        }
+        with open(filename, 'w', encoding='utf-8') as f:
+            json.dump(umap, f)
@@ -0,0 +1,378 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8; mode: Python -*-
+
+# ocitysmap, city map and street index generator from OpenStreetMap data
+# Copyright (C) 2023  Hartmut Holzgraefe
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Offline benchmarks for the OCitySMap hot paths
+
+Runs the grid, index, shape file and import file code paths on
+synthetic city sized data, see fixtures.py, without needing an OSM
+database. Results are stored as JSON, one file per commit, so that two
+runs can be compared with --compare.
+"""
+
+import copy
+import datetime
+import json
+import logging
+import optparse
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHMARK_DIR))
+
+import fixtures
+
+# Registered benchmarks, in definition order
+BENCHMARKS = []
+
+class SkipBenchmark(Exception):
+    """Raised by benchmarks that can't run with the given fixture."""
+    pass
+
+def benchmark(name):
+    """ Register a benchmark
+
+    The decorated function is called with a fixtures.Fixture and a
+    temporary directory, and returns a (prepare, run) tuple. `prepare`
+    may be None, otherwise it is called before each timed run, and its
+    result passed to `run`, so that input that `run` modifies can be
+    re-created without being part of the measured time.
+    """
+    def register(func):
+        BENCHMARKS.append((name, func))
+        return func
+    return register
+
+# Paper sizes in pt
+A0 = (2384, 3370)
+A4 = (595, 842)
+
+
+@benchmark('grid.construct')
+def bench_grid_construct(fixture, tmpdir):
+    from ocitysmap.maplib.grid import Grid
+    bbox = fixture.bounding_box()
+    def run(state):
+        for i in range(100):
+            Grid(bbox, fixtures.CITY_SCALE)
+    return None, run
+
+@benchmark('grid.get_location_str')
+def bench_grid_location(fixture, tmpdir):
+    grid = fixture.grid()
+    points = [p for ep in fixture.endpoints() for p in ep]
+    def run(state):
+        for lat, lon in points:
+            grid.get_location_str(lat, lon)
+    return None, run
+
+@benchmark('index_item.update_location_str')
+def bench_update_location_str(fixture, tmpdir):
+    grid = fixture.grid()
+    items = fixture.index_items(page_count=10)
+    def run(state):
+        for item in items:
+            item.update_location_str(grid)
+    return None, run
+
+@benchmark('general_index.group_identical_grid_locations')
+def bench_group_locations(fixture, tmpdir):
+    from ocitysmap.indexlib.GeneralIndex import GeneralIndex
+    def prepare():
+        index = GeneralIndex(None, None, fixture.bounding_box(),
+                             fixture.bounding_box().as_wkt(), fixture.i18n())
+        index._categories = fixture.categories()
+        return index
+    def run(index):
+        index._group_identical_grid_locations()
+    return prepare, run
+
+def _index_renderer(fixture):
+    from ocitysmap.indexlib.GeneralIndex import GeneralIndexRenderer
+    return GeneralIndexRenderer(fixture.i18n(), fixture.categories())
+
+def _precompute(renderer):
+    import cairo
+    from ocitysmap.indexlib.commons import IndexDoesNotFitError
+
+    surface = cairo.PDFSurface(None, *A0)
+    try:
+        # right side index, like the single page renderer does
+        return renderer.precompute_occupation_area(
+            surface, A0[0] * 2 / 3, 0, A0[0] / 3, A0[1], 'width', 'right')
+    except IndexDoesNotFitError:
+        return None
+    finally:
+        surface.finish()
+
+@benchmark('general_index_renderer.precompute_occupation_area')
+def bench_precompute(fixture, tmpdir):
+    renderer = _index_renderer(fixture)
+    def run(state):
+        _precompute(renderer)
+    return None, run
+
+@benchmark('general_index_renderer.render')
+def bench_index_render(fixture, tmpdir):
+    import cairo
+
+    renderer = _index_renderer(fixture)
+    area = _precompute(renderer)
+    if area is None:
+        raise SkipBenchmark("index does not fit on A0 paper")
+    def prepare():
+        surface = cairo.PDFSurface(None, *A0)
+        return surface, cairo.Context(surface), copy.copy(area)
+    def run(state):
+        surface, ctx, area_copy = state
+        renderer.render(ctx, area_copy)
+        surface.finish()
+    return prepare, run
+
+@benchmark('multi_page_index_renderer.render')
+def bench_multi_page_index(fixture, tmpdir):
+    import cairo
+    from ocitysmap.indexlib.GeneralIndex import MultiPageIndexRenderer
+
+    categories = fixture.categories(page_count=40)
+    def prepare():
+        surface = cairo.PDFSurface(None, *A4)
+        ctx = cairo.Context(surface)
+        return surface, MultiPageIndexRenderer(fixture.i18n(), ctx, surface,
+                                               categories, A4,
+                                               (28, 28, A4[0] - 56, A4[1] - 56),
+                                               42)
+    def run(state):
+        surface, renderer = state
+        renderer.render()
+        surface.finish()
+    return prepare, run
+
+@benchmark('multi_page_renderer.merge_page_indexes')
+def bench_merge_page_indexes(fixture, tmpdir):
+    from ocitysmap.layoutlib.multi_page_renderer import MultiPageRenderer
+
+    class RenderingConfigurationMock:
+        i18n = fixture.i18n()
+
+    # only the rendering configuration is needed for merging
+    renderer = MultiPageRenderer.__new__(MultiPageRenderer)
+    renderer.rc = RenderingConfigurationMock()
+    def prepare():
+        return fixture.page_indexes(40)
+    def run(indexes):
+        renderer._merge_page_indexes(indexes)
+    return prepare, run
+
+@benchmark('shapes.grid_shape_file')
+def bench_grid_shape_file(fixture, tmpdir):
+    grid = fixture.grid()
+    filename = os.path.join(tmpdir, 'grid.shp')
+    def run(state):
+        for i in range(20):
+            grid.generate_shape_file(filename).flush()
+    return None, run
+
+@benchmark('shapes.shade_shape_file')
+def bench_shade_shape_file(fixture, tmpdir):
+    import shapely.wkt
+    from ocitysmap.maplib import shapes
+
+    bbox = fixture.bounding_box()
+    exterior = shapely.wkt.loads(bbox.create_expanded(0.01, 0.01).as_wkt())
+    interior = shapely.wkt.loads(fixture.boundary_wkt())
+    filename = os.path.join(tmpdir, 'shade.shp')
+    def run(state):
+        # same steps as the renderers take for the area outside the city
+        shade_wkt = exterior.difference(interior).wkt
+        shade = shapes.PolyShapeFile(bbox, filename, 'shade')
+        shade.add_shade_from_wkt(shade_wkt)
+        shade.flush()
+    return None, run
+
+@benchmark('stylelib.gpx')
+def bench_gpx(fixture, tmpdir):
+    from ocitysmap.stylelib.Gpx import GpxStylesheet
+
+    gpx_file = os.path.join(tmpdir, 'track.gpx')
+    fixture.write_gpx(gpx_file)
+    def run(state):
+        GpxStylesheet(gpx_file, tmpdir)
+    return None, run
+
+@benchmark('stylelib.umap')
+def bench_umap(fixture, tmpdir):
+    from ocitysmap.stylelib.Umap import UmapStylesheet
+
+    umap_file = os.path.join(tmpdir, 'map.umap')
+    fixture.write_umap(umap_file)
+    def run(state):
+        UmapStylesheet(umap_file, tmpdir)
+    return None, run
+
+def run_benchmark(func, fixture, repeat):
+    """ Time one benchmark
+
+    Returns
+    -------
+    dict
+        Minimum, median and mean run time in seconds and the number of
+        runs, or a `skipped` reason
+    """
+    tmpdir = tempfile.mkdtemp(prefix='ocitysmap-bench')
+    try:
+        try:
+            prepare, run = func(fixture, tmpdir)
+        except SkipBenchmark as e:
+            return { 'skipped': str(e) }
+        except (ImportError, ValueError) as e:
+            # ValueError is raised by gi.require_version()
+            return { 'skipped': "%s: %s" % (type(e).__name__, e) }
+
+        times = []
+        for i in range(repeat):
+            state = prepare() if prepare else None
+            start = time.perf_counter()
+            run(state)
+            times.append(time.perf_counter() - start)
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+    return { 'min':    round(min(times), 6),
+             'median': round(statistics.median(times), 6),
+             'mean':   round(statistics.mean(times), 6),
+             'runs':   repeat }
+
+def git_revision():
+    """ Short commit id of the checkout, with '-dirty' for local changes """
+    try:
+        return subprocess.check_output(
+            ['git', 'describe', '--always', '--dirty'],
+            cwd=BENCHMARK_DIR, stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+def compare(baseline, current, threshold):
+    """ Print median times of two result sets side by side
+
+    Returns
+    -------
+    int
+        Number of benchmarks slower than `threshold` times the baseline
+    """
+    regressions = 0
+    print("%-55s %5s %10s %10s %7s" % ('benchmark', 'size', 'baseline', 'current', 'ratio'))
+    for size, results in current['results'].items():
+        for name, result in results.items():
+            base = baseline['results'].get(size, {}).get(name, {})
+            if 'median' not in result or 'median' not in base:
+                continue
+            ratio = result['median'] / base['median'] if base['median'] else 1.0
+            flag = ''
+            if ratio > threshold:
+                regressions += 1
+                flag = ' SLOWER'
+            elif ratio < 1 / threshold:
+                flag = ' faster'
+            print("%-55s %5s %9.4fs %9.4fs %6.2fx%s"
+                  % (name, size, base['median'], result['median'], ratio, flag))
+    return regressions
+
+def main():
+    usage = '%prog [options] [benchmark name filter ...]'
+    parser = optparse.OptionParser(usage=usage)
+    parser.add_option('-s', '--size', dest='sizes', metavar='SIZE',
+                      action='append', choices=list(fixtures.SIZES),
+                      help='fixture size to run, one of %s, may be given '
+                           'more than once. Defaults to all sizes.'
+                           % ', '.join(fixtures.SIZES))
+    parser.add_option('-r', '--repeat', dest='repeat', metavar='N',
+                      type='int', default=5,
+                      help='number of timed runs per benchmark. Defaults to 5.')
+    parser.add_option('-o', '--output-dir', dest='output_dir', metavar='DIR',
+                      default=os.path.join(BENCHMARK_DIR, 'results'),
+                      help='directory to store the JSON results in, one '
+                           'file per commit. Defaults to benchmarks/results.')
+    parser.add_option('-c', '--compare', dest='compare', metavar='FILE',
+                      help='earlier result file to compare with.')
+    parser.add_option('-t', '--threshold', dest='threshold', metavar='RATIO',
+                      type='float', default=1.1,
+                      help='slowdown ratio reported as regression when '
+                           'comparing. Defaults to 1.1.')
+    parser.add_option('-l', '--list', dest='list', action='store_true',
+                      help='list available benchmarks and exit.')
+    parser.add_option('-v', '--verbose', dest='verbose', action='store_true',
+                      help='show OCitySMap log messages.')
+
+    (options, args) = parser.parse_args()
+
+    if options.list:
+        for name, func in BENCHMARKS:
+            print(name)
+        return 0
+
+    logging.basicConfig(stream=sys.stderr,
+                        level=logging.DEBUG if options.verbose else logging.WARNING)
+
+    sizes = options.sizes or list(fixtures.SIZES)
+    selected = [(name, func) for (name, func) in BENCHMARKS
+                if not args or any(arg in name for arg in args)]
+
+    revision = git_revision()
+    report = { 'revision': revision,
+               'date':     datetime.datetime.now().isoformat(timespec='seconds'),
+               'python':   platform.python_version(),
+               'host':     platform.node(),
+               'results':  {} }
+
+    for size in sizes:
+        fixture = fixtures.Fixture(size)
+        results = report['results'][size] = {}
+        for name, func in selected:
+            result = run_benchmark(func, fixture, options.repeat)
+            results[name] = result
+            if 'skipped' in result:
+                print("%-55s %5s skipped (%s)" % (name, size, result['skipped']))
+            else:
+                print("%-55s %5s %9.4fs" % (name, size, result['median']))
+            sys.stdout.flush()
+
+    os.makedirs(options.output_dir, exist_ok=True)
+    output_file = os.path.join(options.output_dir, '%s.json' % revision)
+    with open(output_file, 'w') as f:
+        json.dump(report, f, indent=2)
+    print("Results written to %s" % output_file)
+
+    if options.compare:
+        with open(options.compare) as f:
+            baseline = json.load(f)
+        print("\nComparing with %s (%s)" % (baseline['revision'], options.compare))
+        if compare(baseline, report, options.threshold):
+            return 1
+
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -87,6 +87,7 @@ import psycopg2
 import re
 import tempfile
 import shapely
+import shapely.wkb
 import shapely.wkt
 import shapely.geometry
 import gpxpy
@@ -98,6 +99,12 @@ from .indexlib.commons import IndexDoesNotFitError, IndexEmptyError
 from .layoutlib import renderers
 from .layoutlib import commons
 from .indexlib import indexers
+from . import datasource
+from . import metrics
+from . import output_writers
+from .cachelib.result_cache import ResultCache
+from .cachelib.geometry_cache import GeometryCache
+from .cachelib.index_cache import IndexCache
 from .stylelib import Stylesheet
 
 LOG = logging.getLogger('ocitysmap')
@@ -153,6 +160,25 @@ def guess_filetype(import_file):
         import_file.seek(0) # rewind to start
     return result
 
+def _parse_bool(value):
+    """ Parse a boolean configuration file value
+
+    Parameters
+    ----------
+    value : str
+        Value as found in the config file, e.g. 'yes', 'off', '1'
+
+    Returns
+    -------
+    bool
+    """
+    value = value.strip().lower()
+    if value in ['1', 'yes', 'true', 'on']:
+        return True
+    if value in ['0', 'no', 'false', 'off']:
+        return False
+    raise ValueError("Not a boolean: %s" % value)
+
 class RenderingConfiguration:
     """
     The RenderingConfiguration class encapsulate all the information concerning
@@ -193,19 +219,81 @@ class RenderingConfiguration:
         # custom QRcode text
         self.qrcode_text     = None
 
+        # number of processes rendering multi page map pages,
+        # defaults to the 'page_workers' config setting if None
+        self.page_workers    = None
+
+        # number of processes rendering single page maps tile by tile
+        # for raster output, defaults to the 'map_tile_workers' config setting if None,
+        # and tile size and margin in pixels, set up by OCitySMap::render()
+        self.map_tile_workers = None
+        self.map_tile_size    = None
+        self.map_tile_margin  = None
+
+        # render multi page atlas maps once for the whole area and cut
+        # the pages out of it, defaults to the 'atlas_render_once'
+        # config setting if None
+        self.atlas_render_once = None
+
         # progress / status message callback
         self.status_update   = lambda msg: None
 
+        # per phase timings, reset by OCitySMap::render()
+        self.metrics         = metrics.RenderMetrics()
+
+        # index query result cache, set up by OCitySMap::render()
+        self.index_cache     = None
+
+        # index layouts computed for this job, shared by the renderers
+        # of all output formats, reset by OCitySMap::render()
+        self.index_layouts   = {}
+
+        # connection pool of the default datasource, set up by
+        # OCitySMap::render(), and the maximum number of connections
+        # to run independent index queries on at the same time,
+        # defaults to the 'index_query_workers' config setting if None
+        self.db_pool         = None
+        self.index_query_workers = None
+
+        # maximum vertices per part of the area of interest in database
+        # queries, defaults to the 'area_subdivide_max_vertices' config
+        # setting if None
+        self.area_subdivide_max_vertices = None
+
 class OCitySMap:
     """
     This is the main entry point of the OCitySMap map rendering engine. Read
     this module's documentation for more details on its API.
     """
 
-    DEFAULT_REQUEST_TIMEOUT_MIN = 15 # TODO make this a config file setting
+    DEFAULT_REQUEST_TIMEOUT_MIN = datasource.DEFAULT_REQUEST_TIMEOUT_MIN
 
     DEFAULT_RENDERING_PNG_DPI = 300 # TODO make this a config file setting
 
+    DEFAULT_RENDER_ONCE = False
+
+    DEFAULT_OUTPUT_WORKERS = 1
+
+    DEFAULT_PAGE_WORKERS = 1
+
+    DEFAULT_INDEX_QUERY_WORKERS = 3
+
+    DEFAULT_MAP_TILE_WORKERS = 1
+
+    DEFAULT_MAP_TILE_SIZE = 2048
+
+    DEFAULT_MAP_TILE_MARGIN = 256
+
+    DEFAULT_ATLAS_RENDER_ONCE = False
+
+    DEFAULT_RESULT_CACHE_SIZE_MB = 1024
+
+    DEFAULT_GEOMETRY_CACHE_MEMORY_ENTRIES = 64
+
+    DEFAULT_GEOMETRY_CACHE_SIZE_MB = 256
+
+    DEFAULT_INDEX_CACHE_SIZE_MB = 256
+
     STYLESHEET_REGISTRY = []
 
     OVERLAY_REGISTRY = []
@@ -253,6 +341,35 @@ class OCitySMap:
         self._locale_path = os.path.join(os.path.dirname(__file__), '..', 'locale')
         self.__dbs = {}
 
+        # Optional cache for the output files of complete rendering jobs
+        self._result_cache = None
+        if self._parser.has_option('result_cache', 'directory'):
+            self._result_cache = ResultCache(
+                self._parser.get('result_cache', 'directory'),
+                self._get_config_option('result_cache', 'max_size_mb',
+                                        OCitySMap.DEFAULT_RESULT_CACHE_SIZE_MB,
+                                        int))
+
+        # Cache for OSM id envelope and area lookups, in memory and
+        # optionally also on disk
+        self._geometry_cache = GeometryCache(
+            self._get_config_option('geometry_cache', 'memory_entries',
+                                    OCitySMap.DEFAULT_GEOMETRY_CACHE_MEMORY_ENTRIES,
+                                    int),
+            self._get_config_option('geometry_cache', 'directory', None),
+            self._get_config_option('geometry_cache', 'max_size_mb',
+                                    OCitySMap.DEFAULT_GEOMETRY_CACHE_SIZE_MB,
+                                    int))
+
+        # Optional on-disk cache for index query results
+        self._index_cache = None
+        if self._parser.has_option('index_cache', 'directory'):
+            self._index_cache = IndexCache(
+                self._parser.get('index_cache', 'directory'),
+                self._get_config_option('index_cache', 'max_size_mb',
+                                        OCitySMap.DEFAULT_INDEX_CACHE_SIZE_MB,
+                                        int))
+
         # Read stylesheet configuration
         self.STYLESHEET_REGISTRY = Stylesheet.create_all_from_config(self._parser, locale = language)
         if not self.STYLESHEET_REGISTRY:
@@ -313,9 +430,8 @@ class OCitySMap:
             result = self._translator.gettext(txt)
         return result
 
-    @property
-    def _db(self, name='default'):
-        """ Connect to configured database
+    def _get_pool(self, name='default'):
+        """ Get the connection pool of a configured datasource
 
         Actual config entry name is `[datasource]` for the default db,
         and `[datasource_...name...]` for everything else
@@ -327,142 +443,126 @@ class OCitySMap:
 
         Returns
         -------
-        psycopg2.connection
-            Database connection for the given name.
+        datasource.ConnectionPool
+            Connection pool for the given name, shared within this process
         """
+        return datasource.get_pool(name, self._parser)
 
-        # check db chache for already opened connection for this name
-        if name in self.__dbs:
-            return self.__dbs[name]
-
-        # Database connection
-        if name == 'default':
-            datasource = dict(self._parser.items('datasource'))
-        else:
-            datasource = dict(self._parser.items('datasource_' + name))
-
-        # The port is not a mandatory configuration option, so make
-        # sure we define a default value.
-        if not 'port' in datasource:
-            datasource['port'] = 5432
-
-        LOG.debug('Connecting to database %s on %s:%s as %s...' %
-                 (datasource['dbname'], datasource['host'], datasource['port'],
-                  datasource['user']))
+    def get_db(self, name='default'):
+        """ Get the database connection of this instance for a datasource
 
-        db = psycopg2.connect(user=datasource['user'],
-                              password=datasource['password'],
-                              host=datasource['host'],
-                              database=datasource['dbname'],
-                              port=datasource['port'])
+        The connection is checked out from the datasource connection pool
+        on first use, and kept until `release_dbs()` is called, which
+        `render()` does at the end of each job.
 
-        # Force everything to be unicode-encoded, in case we run along Django
-        # (which loads the unicode extensions for psycopg2)
-        db.set_client_encoding('utf8')
+        Parameters
+        ----------
+        name : str, optional
+             Name of datasource to use.
 
-        # set request timeout from configuration, or static default if not configured
-        try:
-            timeout = int(self._parser.get('datasource', 'request_timeout'))
-        except (configparser.NoOptionError, ValueError):
-            timeout = OCitySMap.DEFAULT_REQUEST_TIMEOUT_MIN
-        self._set_request_timeout(db, timeout)
+        Returns
+        -------
+        psycopg2.connection
+            Database connection for the given name.
+        """
 
-        # cache result
+        # check for already checked out connection for this name
+        db = self.__dbs.get(name)
+        if db is not None:
+            if not db.closed:
+                return db
+            # closed by the server, hand it back so the pool does not
+            # keep counting it as in use
+            del self.__dbs[name]
+            self._get_pool(name).putconn(db, close=True)
+
+        db = self._get_pool(name).getconn()
         self.__dbs[name] = db
 
-        # return result
         return db
 
-    def _set_request_timeout(self, db, timeout_minutes=15):
-        """ Set db statement timeout
-
-        Sets the PostgreSQL request timeout to avoid long-running queries on
-        the database.
+    def release_dbs(self):
+        """ Return all database connections of this instance to their pools
 
         Parameters
         ----------
-        timeout_minutes : int, optional
-            Statement execution timeout in minutes (default: 15)
+        none
 
         Returns
         -------
         void
         """
-        cursor = db.cursor()
-        cursor.execute('set session statement_timeout=%d;' %
-                       (timeout_minutes * 60 * 1000))
-        cursor.execute('show statement_timeout;')
-        LOG.debug('Configured statement timeout: %s.' %
-                  cursor.fetchall()[0][0])
+        for name, db in self.__dbs.items():
+            if not db.closed:
+                datasource.discard_areas(db)
+            self._get_pool(name).putconn(db)
+        self.__dbs = {}
 
-    def _cleanup_tempdir(self, tmpdir):
-        """ Remove a temporary directory including all contents
+    @property
+    def _db(self):
+        """ Database connection for the default datasource """
+        return self.get_db('default')
+
+    def _get_config_option(self, section, option, default, conv=str):
+        """ Get an optional configuration setting
 
         Parameters
         ----------
-        tmpdir : str
-            Path to the temporary directory
+        section : str
+            Configuration file section name
+        option : str
+            Option name within section
+        default :
+            Value to return if the option is not set, or not valid
+        conv : callable, optional
+            Conversion function to apply to the option string value
 
         Returns
         -------
-        void
+        The converted option value, or the given default
         """
-        LOG.debug('Cleaning up %s...' % tmpdir)
-        shutil.rmtree(tmpdir)
-
-    def _get_geographic_info(self, osmid, table):
-        """ Get geograpich info for an OSM object
+        try:
+            return conv(self._parser.get(section, option))
+        except (configparser.NoSectionError, configparser.NoOptionError):
+            return default
+        except ValueError:
+            LOG.warning("Invalid value for option '%s' in section [%s], using default '%s'"
+                        % (option, section, default))
+            return default
 
-        Return the area for the given osm id in the given table, or raise
-        LookupError when not found
+    def _cleanup_tempdir(self, tmpdir):
+        """ Remove a temporary directory including all contents
 
         Parameters
         ----------
-        osmid : int
-            Openstreetmap in osm2pgsql table (may be negative)
-        table : str
-            Table to search in, either 'polygon' or 'line'
+        tmpdir : str
+            Path to the temporary directory
 
         Returns
         -------
-        shapely.geometry
-            The geometry corresponding to the OSM id
+        void
         """
+        LOG.debug('Cleaning up %s...' % tmpdir)
+        shutil.rmtree(tmpdir)
 
-        # Ensure all OSM IDs are integers, bust cast them back to strings
-        # afterwards.
-        LOG.debug('Looking up bounding box and contour of OSM ID %d...'
-                  % osmid)
-
-        cursor = self._db.cursor()
-        cursor.execute("""select
-                            st_astext(st_transform(st_buildarea(st_union(way)),
-                                                   4326))
-                          from planet_osm_%s where osm_id = %d
-                          group by osm_id;""" %
-                       (table, osmid))
-        records = cursor.fetchall()
-        try:
-            ((wkt,),) = records
-            if wkt is None:
-                raise ValueError
-        except ValueError:
-            raise LookupError("OSM ID %d not found in table %s" %
-                              (osmid, table))
-
-        return shapely.wkt.loads(wkt)
-
-    def get_geographic_info(self, osmid):
+    def get_geographic_info(self, osmid, simplify_tolerance=None):
         """ Get geometry information for OSM object by Id
 
         Return a tuple (WKT_envelope, WKT_buildarea) or raise
         LookupError when not found
 
+        The areas built from the object's ways in the `polygon` and
+        `line` tables are merged, and their envelope computed, by a
+        single query, with the results transferred as WKB.
+
         Parameters
         ----------
         osmid : int
             OpenStreetMap object Id to search for in `polygon'
             and `line` table (may be negative)
+        simplify_tolerance : float, optional
+            If given, a simplified version of the area, using this
+            tolerance in degrees, is returned as a third tuple member
 
         Returns
         -------
@@ -470,29 +570,65 @@ class OCitySMap:
             WKT representations of
             * object geometry envelope
             * actual object geometry itself
+            * simplified object geometry, if a tolerance was given
         """
-        found = False
+        osm_date = self.get_osm_database_last_update()
+        database_id = self._get_pool().database_id
+
+        cached = self._geometry_cache.get(database_id, osmid, osm_date)
+        if cached is not None:
+            LOG.debug('Using cached bounding box and contour of OSM ID %d'
+                      % osmid)
+            if simplify_tolerance is None:
+                return cached
+            area = shapely.wkt.loads(cached[1])
+            return (cached[0], cached[1],
+                    area.simplify(simplify_tolerance, preserve_topology=True).wkt)
 
-        # Scan polygon table:
-        try:
-            polygon_geom = self._get_geographic_info(osmid, 'polygon')
-            found = True
-        except LookupError:
-            polygon_geom = shapely.geometry.Polygon()
+        LOG.debug('Looking up bounding box and contour of OSM ID %d...'
+                  % osmid)
 
-        # Scan line table:
-        try:
-            line_geom = self._get_geographic_info(osmid, 'line')
-            found = True
-        except LookupError:
-            line_geom = shapely.geometry.Polygon()
+        cursor = self._db.cursor()
+        cursor.execute("""SELECT ST_AsBinary(ST_Envelope(area)),
+                                 ST_AsBinary(area),
+                                 CASE WHEN %(tolerance)s IS NULL THEN NULL
+                                      ELSE ST_AsBinary(ST_SimplifyPreserveTopology(
+                                               area, %(tolerance)s))
+                                 END
+                            FROM (SELECT ST_Transform(ST_Union(part), 4326) AS area
+                                    FROM (SELECT ST_BuildArea(ST_Union(way)) AS part
+                                            FROM planet_osm_polygon
+                                           WHERE osm_id = %(osmid)s
+                                          UNION ALL
+                                          SELECT ST_BuildArea(ST_Union(way)) AS part
+                                            FROM planet_osm_line
+                                           WHERE osm_id = %(osmid)s
+                                         ) AS parts
+                                   WHERE part IS NOT NULL
+                                 ) AS merged""",
+                       { 'osmid': int(osmid),
+                         'tolerance': simplify_tolerance })
+        records = cursor.fetchall()
+        cursor.close()
 
-        # Merge results:
-        if not found:
+        try:
+            ((envelope_wkb, area_wkb, simplified_wkb),) = records
+            if area_wkb is None:
+                raise ValueError
+        except ValueError:
             raise LookupError("No such OSM id: %d" % osmid)
-        result = polygon_geom.union(line_geom)
 
-        return (result.envelope.wkt, result.wkt)
+        envelope_wkt = shapely.wkb.loads(bytes(envelope_wkb)).wkt
+        area_wkt     = shapely.wkb.loads(bytes(area_wkb)).wkt
+
+        self._geometry_cache.put(database_id, osmid, osm_date,
+                                 envelope_wkt, area_wkt)
+
+        if simplify_tolerance is None:
+            return (envelope_wkt, area_wkt)
+
+        return (envelope_wkt, area_wkt,
+                shapely.wkb.loads(bytes(simplified_wkb)).wkt)
 
     def get_osm_database_last_update(self):
         """ Get last update timestamp from osm2pgsql database
@@ -520,6 +656,55 @@ class OCitySMap:
 
         return result
 
+    def get_result_cache_stats(self):
+        """ Get result cache usage statistics
+
+        Parameters
+        ----------
+        none
+
+        Returns
+        -------
+        dict or None
+            Cache hits, misses, number of entries, total size and
+            size limit in bytes, or None if no result cache is configured
+        """
+        if self._result_cache is None:
+            return None
+        return self._result_cache.get_stats()
+
+    def get_geometry_cache_stats(self):
+        """ Get OSM id geometry cache usage statistics
+
+        Parameters
+        ----------
+        none
+
+        Returns
+        -------
+        dict
+            Number of geometries cached in memory, and on-disk cache
+            statistics if an on-disk cache is configured
+        """
+        return self._geometry_cache.get_stats()
+
+    def get_index_cache_stats(self):
+        """ Get index query cache usage statistics
+
+        Parameters
+        ----------
+        none
+
+        Returns
+        -------
+        dict or None
+            Cache hits, misses, number of entries, total size and
+            size limit in bytes, or None if no index cache is configured
+        """
+        if self._index_cache is None:
+            return None
+        return self._index_cache.get_stats()
+
     def get_all_style_configurations(self):
         """ Get all configured stylesheets
 
@@ -708,7 +893,8 @@ class OCitySMap:
 
         return None
 
-    def render(self, config, renderer_name, output_formats, file_prefix):
+    def render(self, config, renderer_name, output_formats, file_prefix,
+               max_workers=None):
         """Renders a job with the given rendering configuration, using the
         provided renderer, to the given output formats.
 
@@ -719,96 +905,303 @@ class OCitySMap:
             output_formats (list): a list of output formats to render to, from
                 the list of supported output formats (pdf, svgz, etc.).
             file_prefix (string): filename prefix for all output files.
+            max_workers (int): maximum number of processes writing output
+                files in parallel when rendering once for all formats,
+                defaults to the 'output_workers' config setting.
         """
 
         assert config.osmid or config.bounding_box, \
                 'At least an OSM ID or a bounding box must be provided!'
 
-        output_formats = map(lambda x: x.lower(), output_formats)
+        output_formats = [x.lower() for x in output_formats]
+        config.metrics = metrics.RenderMetrics()
+        config.index_layouts = {}
         config.i18n = i18n.install_translation(config.language,
                                                self._locale_path)
+        if config.area_subdivide_max_vertices is None:
+            config.area_subdivide_max_vertices = self._get_config_option(
+                'rendering', 'area_subdivide_max_vertices',
+                datasource.DEFAULT_AREA_SUBDIVIDE_MAX_VERTICES, int)
+        if config.index_query_workers is None:
+            config.index_query_workers = self._get_config_option(
+                'rendering', 'index_query_workers',
+                OCitySMap.DEFAULT_INDEX_QUERY_WORKERS, int)
+        if config.page_workers is None:
+            config.page_workers = self._get_config_option('rendering', 'page_workers',
+                                                          OCitySMap.DEFAULT_PAGE_WORKERS,
+                                                          int)
+        if config.map_tile_workers is None:
+            config.map_tile_workers = self._get_config_option(
+                'rendering', 'map_tile_workers',
+                OCitySMap.DEFAULT_MAP_TILE_WORKERS, int)
+        if config.map_tile_size is None:
+            config.map_tile_size = max(256, self._get_config_option(
+                'rendering', 'map_tile_size',
+                OCitySMap.DEFAULT_MAP_TILE_SIZE, int))
+        if config.map_tile_margin is None:
+            config.map_tile_margin = max(0, self._get_config_option(
+                'rendering', 'map_tile_margin',
+                OCitySMap.DEFAULT_MAP_TILE_MARGIN, int))
+        if config.atlas_render_once is None:
+            config.atlas_render_once = self._get_config_option(
+                'rendering', 'atlas_render_once',
+                OCitySMap.DEFAULT_ATLAS_RENDER_ONCE, _parse_bool)
 
         LOG.info('Rendering with renderer %s in language: %s (rtl: %s).' %
                  (renderer_name, config.i18n.language_code(),
                   config.i18n.isrtl()))
 
+        # set before checking out database connections, pooled connections
+        # pick up the session settings on checkout
         if 'PGAPPNAME' not in os.environ:
             os.environ['PGAPPNAME'] = "ocitysmap"
 
         os.environ['PGOPTIONS'] = "-c mapnik.language=" + config.language[:2] + " -c mapnik.locality=" + config.language[:5] + " -c mapnik.country=" + config.language[3:5]
         LOG.debug("PGOPTIONS '%s'" % os.environ.get('PGOPTIONS', 'not set'))
 
-        # Determine bounding box and WKT of interest
-        if config.osmid:
-            osmid_bbox, osmid_area \
-                = self.get_geographic_info(config.osmid)
+        # return database connections to their pools on all exit paths,
+        # including lookup errors and failed sanity checks
+        try:
+            osm_date = self.get_osm_database_last_update()
+
+            config.db_pool = self._get_pool()
+
+            config.index_cache = None
+            if self._index_cache is not None:
+                config.index_cache = self._index_cache.bind(self._get_pool().database_id,
+                                                            osm_date)
+
+            # Reuse output files of an identical earlier job if available
+            requested_formats = output_formats
+            cache_key = None
+            if self._result_cache is not None:
+                cache_key = self._result_cache.job_key(
+                    config, renderer_name, osm_date,
+                    { 'png_dpi': self._get_config_option('rendering', 'png_dpi',
+                                                         OCitySMap.DEFAULT_RENDERING_PNG_DPI,
+                                                         int),
+                      'render_once': self._get_config_option('rendering', 'render_once',
+                                                             OCitySMap.DEFAULT_RENDER_ONCE,
+                                                             _parse_bool),
+                      'raster_options': self._get_raster_options(),
+                    })
+            if cache_key is not None:
+                output_formats = self._result_cache.fetch(cache_key, output_formats,
+                                                          file_prefix)
+                if not output_formats:
+                    LOG.info("Using cached results for all output formats")
+                    return len(requested_formats)
+
+            # Determine bounding box and WKT of interest
+            if config.osmid:
+                with config.metrics.phase('geographic_lookup'):
+                    osmid_bbox, osmid_area \
+                        = self.get_geographic_info(config.osmid)
+
+                # Define the bbox if not already defined
+                if not config.bounding_box:
+                    config.bounding_box \
+                        = coords.BoundingBox.parse_wkt(osmid_bbox)
+
+                # Update the polygon WKT of interest
+                config.polygon_wkt = osmid_area
+            else:
+                # No OSM ID provided => use specified bbox
+                config.polygon_wkt = config.bounding_box.as_wkt()
+
+            # Make sure we have a bounding box
+            assert config.bounding_box is not None
+            assert config.polygon_wkt is not None
+
+            # Make sure bounding box has non-zero width / height
+            LOG.warning("checking bounds")
+            if config.bounding_box.get_left() ==  config.bounding_box.get_right():
+                config.bounding_box = config.bounding_box.create_expanded(1.0 / 3600, 1.0 / 3600)
+            if config.bounding_box.get_top() ==  config.bounding_box.get_bottom():
+                config.bounding_box = config.bounding_box.create_expanded(1.0 / 3600, 1.0 / 3600)
+            assert config.bounding_box.get_left() !=  config.bounding_box.get_right(), \
+                    "Bounding box has zero width"
+            assert config.bounding_box.get_top()  !=  config.bounding_box.get_bottom(), \
+                    "Bounding box has zero height"
+
+            # Make sure paper has non-zero widht / height
+            assert config.paper_width_mm > 0, \
+                    "Paper needs non-zero width"
+            assert config.paper_height_mm > 0, \
+                    "Paper needs non-zero height"
+
+            # Create a temporary directory for all our temporary helper files
+            tmpdir = tempfile.mkdtemp(prefix='ocitysmap')
+
+            # count successfully created output files
+            output_count = 0
 
-            # Define the bbox if not already defined
-            if not config.bounding_box:
-                config.bounding_box \
-                    = coords.BoundingBox.parse_wkt(osmid_bbox)
+            try:
+                LOG.debug('Rendering in temporary directory %s' % tmpdir)
+
+                # Prepare the generic renderer
+                renderer_cls = renderers.get_renderer_class_by_name(renderer_name)
+
+                # Prepare and draw the job only once if requested, and if
+                # the layout can be replayed onto all the output formats
+                render_once = self._get_config_option('rendering', 'render_once',
+                                                      OCitySMap.DEFAULT_RENDER_ONCE,
+                                                      _parse_bool)
+                if render_once and renderer_cls.supports_recording:
+                    if max_workers is None:
+                        max_workers = self._get_config_option('rendering', 'output_workers',
+                                                              OCitySMap.DEFAULT_OUTPUT_WORKERS,
+                                                              int)
+                    try:
+                        output_count = self._render_recorded(config, tmpdir,
+                                                             renderer_cls,
+                                                             output_formats,
+                                                             osm_date, file_prefix,
+                                                             max_workers)
+                    except OSError as e:
+                        LOG.warning("OS Error while rendering %s: %s" % (config.output_format, e))
+                        raise
+                else:
+                    # Perform the actual rendering to the Cairo devices
+                    for output_format in output_formats:
+                        output_filename = '%s.%s' % (file_prefix, output_format)
+                        try:
+                            if not self._render_one(config, tmpdir, renderer_cls,
+                                                    output_format, output_filename,
+                                                    osm_date, file_prefix):
+                                continue
+                        except IndexDoesNotFitError:
+                            LOG.exception("The actual font metrics probably don't "
+                                          "match those pre-computed by the renderer's"
+                                          "constructor. Backtrace follows...")
+                            raise
+                        except OSError as e:
+                            LOG.warning("OS Error while rendering %s: %s" % (output_format, e))
+                            raise
+
+                        output_count = output_count + 1
+            finally:
+                config.status_update("")
+                self._cleanup_tempdir(tmpdir)
+
+            if cache_key is not None:
+                self._result_cache.store(cache_key, requested_formats, file_prefix)
+                output_count += len(requested_formats) - len(output_formats)
+
+            return output_count
+        finally:
+            self.release_dbs()
 
-            # Update the polygon WKT of interest
-            config.polygon_wkt = osmid_area
-        else:
-            # No OSM ID provided => use specified bbox
-            config.polygon_wkt = config.bounding_box.as_wkt()
-
-        # Make sure we have a bounding box
-        assert config.bounding_box is not None
-        assert config.polygon_wkt is not None
-
-        # Make sure bounding box has non-zero width / height
-        LOG.warning("checking bounds")
-        if config.bounding_box.get_left() ==  config.bounding_box.get_right():
-            config.bounding_box = config.bounding_box.create_expanded(1.0 / 3600, 1.0 / 3600)
-        if config.bounding_box.get_top() ==  config.bounding_box.get_bottom():
-            config.bounding_box = config.bounding_box.create_expanded(1.0 / 3600, 1.0 / 3600)
-        assert config.bounding_box.get_left() !=  config.bounding_box.get_right(), \
-                "Bounding box has zero width"
-        assert config.bounding_box.get_top()  !=  config.bounding_box.get_bottom(), \
-                "Bounding box has zero height"
-
-        # Make sure paper has non-zero widht / height
-        assert config.paper_width_mm > 0, \
-                "Paper needs non-zero width"
-        assert config.paper_height_mm > 0, \
-                "Paper needs non-zero height"
+    def _get_png_dpi(self, config):
+        """ Determine raster output resolution for a job
 
-        osm_date = self.get_osm_database_last_update()
+        Large PNG files are written band by band, so the configured
+        `png_dpi` is used regardless of the resulting image size.
 
-        # Create a temporary directory for all our temporary helper files
-        tmpdir = tempfile.mkdtemp(prefix='ocitysmap')
+        Parameters
+        ----------
+        config : RenderingConfiguration
+            The renderer / request settings.
+
+        Returns
+        -------
+        int
+            Resolution to use
+        """
+        return self._get_config_option('rendering', 'png_dpi',
+                                       OCitySMap.DEFAULT_RENDERING_PNG_DPI, int)
+
+    def _get_raster_options(self):
+        """ Raster image encoder settings
+
+        Parameters
+        ----------
+        none
+
+        Returns
+        -------
+        dict
+            Encoder settings for `output_writers.write_raster()`, taken
+            from the [rendering] section of the configuration
+        """
+        return { name: self._get_config_option('rendering', name, default, int)
+                 for name, default in output_writers.DEFAULT_RASTER_OPTIONS.items() }
+
+    def _render_recorded(self, config, tmpdir, renderer_cls,
+                         output_formats, osm_date, file_prefix,
+                         max_workers=1):
+        """ Render a job once and write it to all requested output formats
+
+        The page is prepared and drawn only once into a Cairo recording
+        surface, which is then replayed onto the output surfaces of all
+        requested file formats.
+
+        Parameters
+        ----------
+        config : RenderingConfiguration
+            The renderer / request settings.
+        tmpdir : str
+            Path to temporary directory to use for this job
+        renderer_cls : class
+            The layout renderer class to use, needs to support recording
+        output_formats : list of str
+            Output formats to write
+        osm_date : datetime.datetime
+            Time of last OSM database update
+        file_prefix : str
+            Filename prefix for all output files.
+        max_workers : int, optional
+            Maximum number of processes to write output files with
+
+        Returns
+        -------
+        int
+            Number of output files written
+        """
+        config.output_format = "/".join(output_formats).upper()
+        LOG.debug('Rendering once for %s formats...' % config.output_format)
+        config.status_update(_("Rendering %s") % config.output_format)
+
+        dpi = layoutlib.commons.PT_PER_INCH
+
+        renderer = renderer_cls(self._db, config, tmpdir, dpi, file_prefix)
+
+        recording = output_writers.create_recording_surface(
+            renderer.paper_width_pt, renderer.paper_height_pt)
+        renderer.render(recording, dpi, osm_date)
+        recording.flush()
 
-        # count successfully created output files
         output_count = 0
+        jobs = []
+        raster_options = self._get_raster_options()
+        for output_format in output_formats:
+            output_filename = '%s.%s' % (file_prefix, output_format)
 
-        try:
-            LOG.debug('Rendering in temporary directory %s' % tmpdir)
+            if output_format == 'csv':
+                # CSV index has already been written while rendering
+                output_count += 1
+                continue
 
-            # Prepare the generic renderer
-            renderer_cls = renderers.get_renderer_class_by_name(renderer_name)
+            if output_format not in output_writers.RECORDABLE_FORMATS:
+                raise ValueError( \
+                    'Unsupported output format: %s!' % output_format.upper())
 
-            # Perform the actual rendering to the Cairo devices
-            for output_format in output_formats:
-                output_filename = '%s.%s' % (file_prefix, output_format)
-                try:
-                    self._render_one(config, tmpdir, renderer_cls,
-                                     output_format, output_filename, osm_date,
-                                     file_prefix)
-                except IndexDoesNotFitError:
-                    LOG.exception("The actual font metrics probably don't "
-                                  "match those pre-computed by the renderer's"
-                                  "constructor. Backtrace follows...")
-                    raise
-                except OSError as e:
-                    LOG.warning("OS Error while rendering %s: %s" % (output_format, e))
-                    raise
-
-                output_count = output_count + 1
-        finally:
-            config.status_update("")
-            self._cleanup_tempdir(tmpdir)
+            png_dpi = None
+            if output_format in output_writers.RASTER_FORMATS:
+                png_dpi = self._get_png_dpi(config)
+
+            jobs.append((output_format, output_filename,
+                         renderer.paper_width_pt, renderer.paper_height_pt,
+                         png_dpi, config.title, renderer.description,
+                         raster_options))
+
+        config.status_update(_("%s: writing output files") % config.output_format)
+
+        with config.metrics.phase('serialization', config.output_format):
+            output_count += output_writers.write_recordings(recording, jobs,
+                                                            max_workers)
+
+        recording.finish()
 
         return output_count
 
@@ -830,7 +1223,9 @@ class OCitySMap:
 
         Returns
         -------
-        void
+        bool
+            True if the output file has been written, False if it has
+            been skipped as the image is too large for the format
         """
         tmp_output_filename = output_filename + ".tmp"
         config.output_format = output_format.upper()
@@ -839,80 +1234,42 @@ class OCitySMap:
 
         dpi = layoutlib.commons.PT_PER_INCH
 
-        renderer = renderer_cls(self._db, config, tmpdir, dpi, file_prefix)
-
-        if output_format == 'png':
-            try:
-                dpi = int(self._parser.get('rendering', 'png_dpi'))
-            except configparser.NoOptionError:
-                dpi = OCitySMap.DEFAULT_RENDERING_PNG_DPI
+        if output_format in output_writers.RASTER_FORMATS:
+            dpi = self._get_png_dpi(config)
 
             w_px = int(layoutlib.commons.convert_mm_to_dots(config.paper_width_mm, dpi))
             h_px = int(layoutlib.commons.convert_mm_to_dots(config.paper_height_mm, dpi))
 
-            if w_px > 25000 or h_px > 25000:
-                dpi = layoutlib.commons.PT_PER_INCH
-                w_px = int(layoutlib.commons.convert_pt_to_dots(renderer.paper_width_pt, dpi))
-                h_px = int(layoutlib.commons.convert_pt_to_dots(renderer.paper_height_pt, dpi))
-                if w_px > 25000 or h_px > 25000:
-                    LOG.warning("Paper size too large for PNG output, skipping")
-                    return
-                LOG.warning("%d DPI to high for this paper size, using 72dpi instead" % dpi)
+            if not output_writers.fits_raster_output(output_format, w_px, h_px):
+                LOG.warning("Image of %dpx x %dpx too large for %s output, skipping it"
+                            % (w_px, h_px, config.output_format))
+                return False
 
-            # as the dpi value may have changed we need to re-create the renderer
             renderer = renderer_cls(self._db, config, tmpdir, dpi, file_prefix)
 
-            # As strange as it may seem, we HAVE to use a vector
-            # device here and not a raster device such as
-            # ImageSurface. Because, for some reason, with
-            # ImageSurface, the font metrics would NOT match those
-            # pre-computed by renderer_cls.__init__() and used to
-            # layout the whole page
-            LOG.debug("Rendering PNG into %dpx x %dpx area at %ddpi ..."
-                      % (w_px, h_px, dpi))
-            surface = cairo.PDFSurface(None, w_px, h_px)
-
-        elif output_format == 'svg':
-            surface = cairo.SVGSurface(tmp_output_filename,
-                                       renderer.paper_width_pt, renderer.paper_height_pt)
-            surface.restrict_to_version(cairo.SVGVersion.VERSION_1_2);
-        elif output_format == 'svgz':
-            surface = cairo.SVGSurface(gzip.GzipFile(tmp_output_filename, 'wb'),
-                                       renderer.paper_width_pt, renderer.paper_height_pt)
-            surface.restrict_to_version(cairo.SVGVersion.VERSION_1_2);
-        elif output_format == 'pdf':
-            surface = cairo.PDFSurface(tmp_output_filename,
-                                       renderer.paper_width_pt, renderer.paper_height_pt)
-            surface.restrict_to_version(cairo.PDFVersion.VERSION_1_5);
-
-            try:
-                surface.set_metadata(cairo.PDFMetadata.CREATOR,
-                                     'MyOSMatic <https://print.get-map.org/>')
-
-                surface.set_metadata(cairo.PDFMetadata.TITLE,
-                                     config.title)
-
-                surface.set_metadata(cairo.PDFMetadata.AUTHOR,
-                                     "Created using MapOSMatic/OCitySMap\n" +
-                                     "Map data © 2018 OpenStreetMap contributors (see http://osm.org/copyright)")
-
-                surface.set_metadata(cairo.PDFMetadata.SUBJECT,
-                                     renderer.description) # TODO add style annotations here
+            # Renderers draw text with device independent font options,
+            # so a raster surface gives the same text metrics as the
+            # vector surfaces the page layout has been computed with.
+            # Images too large to be kept in memory are recorded instead,
+            # and then rasterized band by band when writing the PNG file.
+            LOG.debug("Rendering %s into %dpx x %dpx area at %ddpi ..."
+                      % (config.output_format, w_px, h_px, dpi))
+            if output_writers.fits_raster_surface(w_px, h_px):
+                surface = output_writers.create_raster_surface(w_px, h_px)
+            else:
+                surface = output_writers.create_recording_surface(w_px, h_px)
 
-                surface.set_metadata(cairo.PDFMetadata.KEYWORDS,
-                                     "OpenStreetMap, MapOSMatic, OCitysMap")
-            except:
-              LOG.warning("Installed Cairo version does not support PDF annotations yet")
-
-        elif output_format == 'ps':
-            surface = cairo.PSSurface(tmp_output_filename,
-                                      renderer.paper_width_pt, renderer.paper_height_pt)
-        elif output_format == 'ps.gz':
-            surface = cairo.PSSurface(gzip.GzipFile(tmp_output_filename, 'wb'),
-                                      renderer.paper_width_pt, renderer.paper_height_pt)
+        elif output_format in output_writers.RECORDABLE_FORMATS:
+            renderer = renderer_cls(self._db, config, tmpdir, dpi, file_prefix)
+            surface = output_writers.create_vector_surface(
+                output_format, tmp_output_filename,
+                renderer.paper_width_pt, renderer.paper_height_pt,
+                output_writers.pdf_metadata(config.title, renderer.description))
         elif output_format == 'csv':
-            # We don't render maps into CSV.
-            return
+            # We don't render maps into CSV, creating the renderer
+            # writes the CSV index
+            renderer_cls(self._db, config, tmpdir, dpi, file_prefix)
+            return True
         else:
             raise ValueError( \
                 'Unsupported output format: %s!' % output_format.upper())
@@ -923,13 +1280,27 @@ class OCitySMap:
 
         config.status_update(_("%s: writing output file") % output_format.upper())
 
-        if output_format == 'png':
-            surface.write_to_png(tmp_output_filename)
+        with config.metrics.phase('serialization', config.output_format):
+            if output_format in output_writers.RASTER_FORMATS:
+                raster_options = self._get_raster_options()
+                if isinstance(surface, cairo.ImageSurface):
+                    output_writers.write_raster(surface, output_format,
+                                                tmp_output_filename, dpi,
+                                                raster_options)
+                else:
+                    if raster_options['png_palette_colors']:
+                        LOG.warning("Image too large for palette quantization, writing RGB PNG")
+                    surface.flush()
+                    output_writers.write_png(surface, tmp_output_filename,
+                                             w_px, h_px, dpi=dpi,
+                                             compression_level=raster_options['png_compression_level'])
 
-        surface.finish()
+            surface.finish()
 
         os.rename(tmp_output_filename, output_filename)
 
+        return True
+
 if __name__ == '__main__':
     logging.basicConfig(level=logging.DEBUG)
 
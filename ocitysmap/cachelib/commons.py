@@ -0,0 +1,288 @@
+# -*- coding: utf-8 -*-
+
+# ocitysmap, city map and street index generator from OpenStreetMap data
+# Copyright (C) 2023  Hartmut Holzgraefe
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import errno
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+
+LOG = logging.getLogger('ocitysmap')
+
+
+def hash_key(*parts):
+    """ Create a cache key from arbitrary JSON serializable values
+
+    Parameters
+    ----------
+    *parts :
+        Values identifying a cache entry
+
+    Returns
+    -------
+    str
+        Hex digest of the canonical JSON representation of all parts
+    """
+    canonical = json.dumps(parts, sort_keys=True, separators=(',', ':'),
+                           default=str)
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+def link_or_copy(src, dst):
+    """ Hard link a file, or copy it if linking is not possible
+
+    Parameters
+    ----------
+    src : str
+        Path of existing file
+    dst : str
+        Path to create, an existing file is replaced
+
+    Returns
+    -------
+    void
+    """
+    if os.path.lexists(dst):
+        os.unlink(dst)
+    try:
+        os.link(src, dst)
+    except OSError:
+        # e.g. source and destination on different file systems
+        shutil.copyfile(src, dst)
+
+
+class DiskCache:
+    """
+    Size limited file system cache with least-recently-used eviction.
+
+    Each cache entry is a directory named by its key, holding one or
+    more named files. Entry directories are touched on every access,
+    so that their modification time reflects the time of last use.
+    Hit and miss counters are kept in a small JSON file in the cache
+    directory, so that they accumulate across processes and jobs.
+    """
+
+    STATS_FILE = 'stats.json'
+
+    def __init__(self, directory, max_size_mb):
+        """
+        Parameters
+        ----------
+        directory : str
+            Cache root directory, created if it does not exist yet
+        max_size_mb : int
+            Total size limit for all cache entries in megabytes
+        """
+        self.directory = os.path.expanduser(directory)
+        self.max_size  = int(max_size_mb) * 1024 * 1024
+
+        os.makedirs(self.directory, exist_ok=True)
+
+    def _entry_path(self, key):
+        return os.path.join(self.directory, key[:2], key)
+
+    def get(self, key):
+        """ Look up a cache entry
+
+        Parameters
+        ----------
+        key : str
+            Cache entry key
+
+        Returns
+        -------
+        str or None
+            Path of the entry directory, or None if not cached
+        """
+        path = self._entry_path(key)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return path
+
+    def get_file(self, key, name):
+        """ Look up a single file within a cache entry
+
+        Parameters
+        ----------
+        key : str
+            Cache entry key
+        name : str
+            File name within the entry
+
+        Returns
+        -------
+        str or None
+            Path of the cached file, or None if not cached
+        """
+        path = self.get(key)
+        if path is None:
+            return None
+        filename = os.path.join(path, name)
+        if not os.path.exists(filename):
+            return None
+        return filename
+
+    def put(self, key, files=None, data=None):
+        """ Store a cache entry, replacing an existing one
+
+        The entry is assembled in a temporary directory first and then
+        renamed into place, so that readers never see partial entries.
+
+        Parameters
+        ----------
+        key : str
+            Cache entry key
+        files : dict, optional
+            Entry file names mapped to paths of files to store
+        data : dict, optional
+            Entry file names mapped to bytes to store
+
+        Returns
+        -------
+        void
+        """
+        final_path = self._entry_path(key)
+        os.makedirs(os.path.dirname(final_path), exist_ok=True)
+        tmp_path = tempfile.mkdtemp(prefix='.tmp-', dir=self.directory)
+
+        try:
+            for name, src in (files or {}).items():
+                link_or_copy(src, os.path.join(tmp_path, name))
+            for name, content in (data or {}).items():
+                with open(os.path.join(tmp_path, name), 'wb') as f:
+                    f.write(content)
+
+            if os.path.exists(final_path):
+                shutil.rmtree(final_path, ignore_errors=True)
+            os.rename(tmp_path, final_path)
+        except OSError as e:
+            if e.errno not in (errno.ENOTEMPTY, errno.EEXIST):
+                LOG.warning("Could not store cache entry %s: %s" % (key, e))
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            return
+
+        self.evict()
+
+    def remove(self, key):
+        """ Remove a cache entry, if present
+
+        Parameters
+        ----------
+        key : str
+            Cache entry key
+
+        Returns
+        -------
+        void
+        """
+        shutil.rmtree(self._entry_path(key), ignore_errors=True)
+
+    def _entries(self):
+        """ List all entries with their last access time and size """
+        entries = []
+        for prefix in os.listdir(self.directory):
+            prefix_path = os.path.join(self.directory, prefix)
+            if prefix.startswith('.') or not os.path.isdir(prefix_path):
+                continue
+            for key in os.listdir(prefix_path):
+                path = os.path.join(prefix_path, key)
+                try:
+                    size = sum(os.path.getsize(os.path.join(path, name))
+                               for name in os.listdir(path))
+                    entries.append((os.path.getmtime(path), size, path))
+                except OSError:
+                    # removed concurrently
+                    pass
+        return entries
+
+    def evict(self):
+        """ Remove least recently used entries exceeding the size limit
+
+        Parameters
+        ----------
+        none
+
+        Returns
+        -------
+        void
+        """
+        entries = self._entries()
+        total_size = sum(size for (mtime, size, path) in entries)
+
+        for (mtime, size, path) in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            LOG.debug("Evicting cache entry %s" % path)
+            shutil.rmtree(path, ignore_errors=True)
+            total_size -= size
+
+    def _update_stats(self, counter):
+        """ Increment a persistent statistics counter """
+        stats_path = os.path.join(self.directory, self.STATS_FILE)
+        try:
+            with open(stats_path, 'a+') as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                f.seek(0)
+                try:
+                    stats = json.loads(f.read() or '{}')
+                except ValueError:
+                    stats = {}
+                stats[counter] = stats.get(counter, 0) + 1
+                f.seek(0)
+                f.truncate()
+                f.write(json.dumps(stats))
+        except OSError as e:
+            LOG.debug("Could not update cache statistics: %s" % e)
+
+    def record_hit(self):
+        self._update_stats('hits')
+
+    def record_miss(self):
+        self._update_stats('misses')
+
+    def get_stats(self):
+        """ Cache usage statistics
+
+        Parameters
+        ----------
+        none
+
+        Returns
+        -------
+        dict
+            Number of hits and misses, number of entries, total size
+            and size limit in bytes
+        """
+        try:
+            with open(os.path.join(self.directory, self.STATS_FILE)) as f:
+                stats = json.loads(f.read() or '{}')
+        except (OSError, ValueError):
+            stats = {}
+
+        entries = self._entries()
+        return {
+            'hits':     stats.get('hits', 0),
+            'misses':   stats.get('misses', 0),
+            'entries':  len(entries),
+            'size':     sum(size for (mtime, size, path) in entries),
+            'max_size': self.max_size,
+        }
@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+
+# ocitysmap, city map and street index generator from OpenStreetMap data
+# Copyright (C) 2023  Hartmut Holzgraefe
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import collections
+import logging
+import threading
+
+import shapely.wkb
+import shapely.wkt
+
+from .commons import DiskCache, hash_key
+
+LOG = logging.getLogger('ocitysmap')
+
+
+class GeometryCache:
+    """
+    Cache for the envelope and area geometries of OSM objects.
+
+    Lookups are served from an in-process LRU cache first, which is
+    shared by all instances within a process, and then from an optional
+    on-disk cache storing the geometries as WKB. Entries are keyed by the
+    database, the OSM id and the time of the last database update, so
+    data updates invalidate them implicitly.
+    """
+
+    # In-process cache, shared by all instances
+    _memory = collections.OrderedDict()
+    _memory_lock = threading.Lock()
+
+    def __init__(self, memory_entries, directory=None, max_size_mb=None):
+        """
+        Parameters
+        ----------
+        memory_entries : int
+            Maximum number of geometries to keep in memory
+        directory : str, optional
+            On-disk cache directory, no disk cache is used if not given
+        max_size_mb : int, optional
+            Size limit of the on-disk cache in megabytes
+        """
+        self._memory_entries = memory_entries
+        self._disk = None
+        if directory:
+            self._disk = DiskCache(directory, max_size_mb)
+
+    def get(self, database, osmid, osm_date):
+        """ Look up cached geometries of an OSM object
+
+        Parameters
+        ----------
+        database : str
+            Identifier of the database the geometry was taken from
+        osmid : int
+            OpenStreetMap object Id
+        osm_date : datetime.datetime
+            Time of the last OSM database update
+
+        Returns
+        -------
+        list of str or None
+            WKT of envelope and area, or None if not cached
+        """
+        if osm_date is None:
+            # without timestamp we can't tell whether data changed
+            return None
+
+        key = hash_key(database, osmid, osm_date)
+
+        with self._memory_lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                return self._memory[key]
+
+        if self._disk is None:
+            return None
+
+        envelope_file = self._disk.get_file(key, 'envelope.wkb')
+        area_file     = self._disk.get_file(key, 'area.wkb')
+        if envelope_file is None or area_file is None:
+            self._disk.record_miss()
+            return None
+
+        try:
+            with open(envelope_file, 'rb') as f:
+                envelope = shapely.wkb.loads(f.read())
+            with open(area_file, 'rb') as f:
+                area = shapely.wkb.loads(f.read())
+        except Exception as e:
+            LOG.warning("Ignoring broken geometry cache entry for OSM ID %d: %s"
+                        % (osmid, e))
+            self._disk.remove(key)
+            self._disk.record_miss()
+            return None
+
+        self._disk.record_hit()
+
+        result = (envelope.wkt, area.wkt)
+        self._remember(key, result)
+        return result
+
+    def put(self, database, osmid, osm_date, envelope_wkt, area_wkt):
+        """ Add geometries of an OSM object to the cache
+
+        Parameters
+        ----------
+        database : str
+            Identifier of the database the geometry was taken from
+        osmid : int
+            OpenStreetMap object Id
+        osm_date : datetime.datetime
+            Time of the last OSM database update
+        envelope_wkt : str
+            WKT of the object envelope
+        area_wkt : str
+            WKT of the object area
+
+        Returns
+        -------
+        void
+        """
+        if osm_date is None:
+            return
+
+        key = hash_key(database, osmid, osm_date)
+        self._remember(key, (envelope_wkt, area_wkt))
+
+        if self._disk is not None:
+            self._disk.put(key, data = {
+                'envelope.wkb': shapely.wkb.dumps(shapely.wkt.loads(envelope_wkt)),
+                'area.wkb':     shapely.wkb.dumps(shapely.wkt.loads(area_wkt)),
+            })
+
+    def _remember(self, key, value):
+        with self._memory_lock:
+            self._memory[key] = value
+            self._memory.move_to_end(key)
+            while len(self._memory) > self._memory_entries:
+                self._memory.popitem(last=False)
+
+    def get_stats(self):
+        """ Cache usage statistics
+
+        Parameters
+        ----------
+        none
+
+        Returns
+        -------
+        dict
+            Number of in-memory entries, and on-disk cache statistics
+            if a disk cache is used
+        """
+        with self._memory_lock:
+            stats = { 'memory_entries': len(self._memory) }
+        if self._disk is not None:
+            stats['disk'] = self._disk.get_stats()
+        return stats
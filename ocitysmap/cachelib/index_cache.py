@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+
+# ocitysmap, city map and street index generator from OpenStreetMap data
+# Copyright (C) 2023  Hartmut Holzgraefe
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+import marshal
+import zlib
+
+from .commons import DiskCache, hash_key
+
+LOG = logging.getLogger('ocitysmap')
+
+
+class IndexCache(DiskCache):
+    """
+    Cache for the result rows of index queries.
+
+    Rows are stored as zlib compressed marshal data, one entry per query.
+    Entries are keyed by the database, the query text, which includes
+    the area of interest, and the time of the last database update, so
+    that data updates invalidate them implicitly.
+
+    Rows are cached before being translated and sorted into index
+    categories, so entries are shared by jobs in different languages.
+    """
+
+    ROWS_FILE = 'rows.marshal.z'
+
+    def bind(self, database, osm_date):
+        """ Cache view for the queries of one rendering job
+
+        Parameters
+        ----------
+        database : str
+            Identifier of the database the job queries
+        osm_date : datetime.datetime
+            Time of the last OSM database update
+
+        Returns
+        -------
+        BoundIndexCache or None
+            Cache for the job's index queries, or None if the data
+            update time is unknown
+        """
+        if osm_date is None:
+            # without timestamp we can't tell whether data changed
+            return None
+        return BoundIndexCache(self, database, osm_date)
+
+    def fetch(self, database, osm_date, query):
+        """ Look up cached query result rows
+
+        Parameters
+        ----------
+        database : str
+            Identifier of the database the rows were taken from
+        osm_date : datetime.datetime
+            Time of the last OSM database update
+        query : str
+            The index query
+
+        Returns
+        -------
+        list of tuple or None
+            Result rows, or None if not cached
+        """
+        key = hash_key(database, query, osm_date)
+
+        filename = self.get_file(key, self.ROWS_FILE)
+        if filename is None:
+            self.record_miss()
+            return None
+
+        try:
+            with open(filename, 'rb') as f:
+                rows = marshal.loads(zlib.decompress(f.read()))
+        except Exception as e:
+            LOG.warning("Ignoring broken index cache entry %s: %s" % (key, e))
+            self.remove(key)
+            self.record_miss()
+            return None
+
+        self.record_hit()
+        return rows
+
+    def store(self, database, osm_date, query, rows):
+        """ Add query result rows to the cache
+
+        Parameters
+        ----------
+        database : str
+            Identifier of the database the rows were taken from
+        osm_date : datetime.datetime
+            Time of the last OSM database update
+        query : str
+            The index query
+        rows : list of tuple
+            Result rows of str, numbers, bytes or None values
+
+        Returns
+        -------
+        void
+        """
+        rows = [tuple(bytes(value) if isinstance(value, memoryview) else value
+                      for value in row)
+                for row in rows]
+        try:
+            data = zlib.compress(marshal.dumps(rows))
+        except ValueError as e:
+            LOG.debug("Index query result can't be cached: %s" % e)
+            return
+
+        self.put(hash_key(database, query, osm_date),
+                 data = { self.ROWS_FILE: data })
+
+
+class BoundIndexCache:
+    """
+    Index cache bound to the database state of one rendering job.
+    """
+
+    def __init__(self, cache, database, osm_date):
+        self._cache    = cache
+        self._database = database
+        self._osm_date = osm_date
+
+    def fetch(self, query):
+        """ Look up cached rows of a query, see `IndexCache.fetch()` """
+        return self._cache.fetch(self._database, self._osm_date, query)
+
+    def store(self, query, rows):
+        """ Add rows of a query to the cache, see `IndexCache.store()` """
+        self._cache.store(self._database, self._osm_date, query, rows)
@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+
+# ocitysmap, city map and street index generator from OpenStreetMap data
+# Copyright (C) 2023  Hartmut Holzgraefe
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import hashlib
+import logging
+import os
+
+from .commons import DiskCache, hash_key, link_or_copy
+
+LOG = logging.getLogger('ocitysmap')
+
+
+def _hash_import_file(import_file):
+    """ Content hash of an import file
+
+    Parameters
+    ----------
+    import_file : str or UploadedFile
+        Either a file path string, or a Django UploadedFile object
+
+    Returns
+    -------
+    str
+        SHA256 hex digest of the file contents
+    """
+    digest = hashlib.sha256()
+    if isinstance(import_file, str):
+        with open(import_file, 'rb') as f:
+            for chunk in iter(lambda: f.read(65536), b''):
+                digest.update(chunk)
+    else: # UploadedFile
+        import_file.open()
+        for chunk in import_file.chunks():
+            digest.update(chunk)
+        import_file.seek(0)
+    return digest.hexdigest()
+
+
+def _stylesheet_version(stylesheet):
+    """ Identify a stylesheet and the state of its file
+
+    Parameters
+    ----------
+    stylesheet : Stylesheet
+        Map or overlay stylesheet
+
+    Returns
+    -------
+    list
+        Name, path and modification time of the stylesheet file,
+        the time is None for internal overlays or missing files
+    """
+    try:
+        mtime = os.stat(stylesheet.path).st_mtime
+    except (OSError, TypeError, ValueError):
+        mtime = None
+    return [stylesheet.name, stylesheet.path, mtime]
+
+
+class ResultCache(DiskCache):
+    """
+    Cache for the output files of complete rendering jobs.
+
+    Entries are keyed by a canonical hash of all rendering configuration
+    settings that have an effect on the output, together with the
+    timestamp of the last OSM database update, so that entries do not
+    get used anymore once the underlying data changed.
+    """
+
+    def job_key(self, config, renderer_name, osm_date, extra = None):
+        """ Compute the cache key for a rendering job
+
+        Parameters
+        ----------
+        config : RenderingConfiguration
+            The renderer / request settings
+        renderer_name : str
+            Name of the layout renderer to use
+        osm_date : datetime.datetime
+            Time of last OSM database update
+        extra : dict, optional
+            Further settings affecting the output, e.g. PNG resolution
+
+        Returns
+        -------
+        str or None
+            The cache key, or None if the data update time is unknown
+        """
+        if osm_date is None:
+            # without timestamp we can't tell whether data changed
+            return None
+
+        bbox = None
+        if config.bounding_box:
+            bbox = config.bounding_box.as_json_bounds()
+
+        stylesheet = None
+        if config.stylesheet:
+            stylesheet = _stylesheet_version(config.stylesheet)
+
+        return hash_key(renderer_name,
+                        osm_date,
+                        config.title,
+                        config.osmid,
+                        bbox,
+                        config.language,
+                        stylesheet,
+                        [_stylesheet_version(o) for o in config.overlays],
+                        config.indexer,
+                        config.paper_width_mm,
+                        config.paper_height_mm,
+                        [[file_type, _hash_import_file(import_file)]
+                         for (file_type, import_file) in config.import_files],
+                        config.logo,
+                        config.extra_logo,
+                        config.extra_text,
+                        config.qrcode_text,
+                        config.origin_url,
+                        config.atlas_render_once,
+                        config.map_tile_size,
+                        config.map_tile_margin,
+                        extra)
+
+    def fetch(self, key, output_formats, file_prefix):
+        """ Provide cached output files for a job
+
+        Cached files are hard linked, or copied, to their final output
+        file names.
+
+        Parameters
+        ----------
+        key : str
+            Cache key, see `job_key()`
+        output_formats : list of str
+            Requested output formats
+        file_prefix : str
+            Filename prefix for all output files
+
+        Returns
+        -------
+        list of str
+            Requested output formats that are not in the cache
+        """
+        missing = []
+        for output_format in output_formats:
+            cached_file = self.get_file(key, output_format)
+            if cached_file is None:
+                missing.append(output_format)
+                continue
+            LOG.debug("Using cached %s output" % output_format)
+            link_or_copy(cached_file, '%s.%s' % (file_prefix, output_format))
+
+        if missing:
+            self.record_miss()
+        else:
+            self.record_hit()
+
+        return missing
+
+    def store(self, key, output_formats, file_prefix):
+        """ Add the output files of a finished job to the cache
+
+        Parameters
+        ----------
+        key : str
+            Cache key, see `job_key()`
+        output_formats : list of str
+            Output formats to store
+        file_prefix : str
+            Filename prefix for all output files
+
+        Returns
+        -------
+        void
+        """
+        files = {}
+        for output_format in output_formats:
+            filename = '%s.%s' % (file_prefix, output_format)
+            if os.path.exists(filename):
+                files[output_format] = filename
+
+        if files:
+            self.put(key, files=files)
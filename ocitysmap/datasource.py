@@ -0,0 +1,505 @@
+# -*- coding: utf-8 -*-
+
+# ocitysmap, city map and street index generator from OpenStreetMap data
+# Copyright (C) 2023  Hartmut Holzgraefe
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Database datasources
+
+Pooled PostgreSQL connections for the `[datasource]` and
+`[datasource_...name...]` configuration sections. Pools are shared by
+all OCitySMap instances within a process, so that connections can be
+reused across jobs by long-lived workers.
+
+Areas of interest can be uploaded once per connection into a session
+temporary table with `upload_area()`, so that queries can refer to the
+area with the expression returned by `area_sql()` instead of embedding
+its possibly huge WKT. Uploaded areas are also split into parts with a
+limited number of vertices, so that `area_filter_sql()` conditions can
+test geometries against a few small parts found by a spatial index
+instead of against the complete area geometry.
+"""
+
+import contextlib
+import hashlib
+import logging
+import os
+import shlex
+import threading
+import time
+
+import psycopg2
+import psycopg2.extensions
+
+LOG = logging.getLogger('ocitysmap')
+
+DEFAULT_REQUEST_TIMEOUT_MIN = 15
+DEFAULT_POOL_MAX_IDLE = 1
+DEFAULT_POOL_MAX = 4
+
+# Session temporary tables holding uploaded areas of interest,
+# and their subdivided parts
+AREA_TABLE = 'ocitysmap_areas'
+AREA_PARTS_TABLE = 'ocitysmap_area_parts'
+
+# Maximum number of vertices per area part
+DEFAULT_AREA_SUBDIVIDE_MAX_VERTICES = 256
+
+# All pools created in this process, by connection parameters
+_POOLS = {}
+_POOLS_LOCK = threading.Lock()
+
+
+def _session_settings():
+    """ Per job session settings requested via PGOPTIONS
+
+    Returns
+    -------
+    tuple of (str, str)
+        Setting names and values of all `-c name=value` options
+    """
+    settings = []
+    args = shlex.split(os.environ.get('PGOPTIONS', ''))
+    for i, arg in enumerate(args):
+        if arg == '-c' and i + 1 < len(args):
+            arg = args[i + 1]
+        elif arg.startswith('-c'):
+            arg = arg[2:]
+        else:
+            continue
+        if '=' in arg:
+            name, value = arg.split('=', 1)
+            settings.append((name, value))
+    return tuple(settings)
+
+
+class ConnectionPool:
+    """
+    A bounded pool of connections to one PostgreSQL database.
+
+    Connections are checked out with `getconn()` and have to be handed
+    back with `putconn()` when no longer needed, or the `connection()`
+    context manager can be used to do both. Connections are health
+    checked on checkout and replaced if broken. Pools are fork aware,
+    a forked child process never reuses connections of its parent.
+
+    Connections outlive the jobs that opened them, so session settings
+    passed via PGOPTIONS, like the Mapnik language settings of a job,
+    are not used as connection options but applied on each checkout.
+    """
+
+    # Idle connections are pinged before reuse after this many seconds
+    HEALTH_CHECK_INTERVAL = 30
+
+    def __init__(self, name, params, timeout_minutes,
+                 max_idle=1, max_connections=4):
+        """
+        Parameters
+        ----------
+        name : str
+            Datasource name, used in log messages only
+        params : dict
+            psycopg2 connection parameters
+        timeout_minutes : int
+            Statement execution timeout in minutes
+        max_idle : int, optional
+            Maximum number of returned connections to keep open for reuse
+        max_connections : int, optional
+            Maximum number of connections open at the same time
+        """
+        self.name = name
+        self._params = params
+        self._timeout_minutes = timeout_minutes
+        self._max_idle = max_idle
+        self._max_connections = max_connections
+
+        self._cond = threading.Condition()
+        self._reset()
+
+    @property
+    def database_id(self):
+        """ Identifier of the database the pool connects to """
+        return '%(user)s@%(host)s:%(port)s/%(database)s' % self._params
+
+    def _reset(self):
+        self._pid  = os.getpid()
+        self._idle = [] # (connection, time returned, session settings)
+        self._used = 0
+        self._settings = {} # id(connection) -> session settings
+
+    def _check_fork(self):
+        # The connection sockets are shared with the parent process
+        # after a fork, so just forget about them without closing
+        if self._pid != os.getpid():
+            self._reset()
+
+    def _connect(self):
+        LOG.debug('Connecting to database %s on %s:%s as %s...' %
+                  (self._params['database'], self._params['host'],
+                   self._params['port'], self._params['user']))
+
+        # Set the statement timeout as connection option, so that it does
+        # not take an extra round trip. Caller session settings are
+        # applied on checkout instead, see _apply_settings()
+        options = '-c statement_timeout=%d' % (self._timeout_minutes * 60 * 1000)
+
+        db = psycopg2.connect(options=options, **self._params)
+
+        # Force everything to be unicode-encoded, in case we run along Django
+        # (which loads the unicode extensions for psycopg2)
+        db.set_client_encoding('utf8')
+
+        return db
+
+    def _apply_settings(self, db, old_settings, new_settings):
+        """ Switch a connection's session settings to those of a job """
+        if old_settings == new_settings:
+            return
+        cursor = db.cursor()
+        new_names = set(name for name, value in new_settings)
+        for name, value in old_settings:
+            if name not in new_names:
+                cursor.execute("""SELECT set_config(%s, COALESCE(
+                                    (SELECT reset_val FROM pg_settings
+                                      WHERE name = %s), ''), false)""",
+                               (name, name))
+        for name, value in new_settings:
+            cursor.execute("SELECT set_config(%s, %s, false)", (name, value))
+        cursor.close()
+        db.commit()
+
+    def _is_healthy(self, db, idle_since):
+        """ Check whether a pooled connection can still be used """
+        if db.closed:
+            return False
+        try:
+            if (db.get_transaction_status()
+                != psycopg2.extensions.TRANSACTION_STATUS_IDLE):
+                db.rollback()
+            if time.time() - idle_since > self.HEALTH_CHECK_INTERVAL:
+                cursor = db.cursor()
+                cursor.execute("SELECT 1")
+                cursor.close()
+                db.rollback()
+        except psycopg2.Error as e:
+            LOG.info("Discarding broken '%s' database connection: %s"
+                     % (self.name, e))
+            return False
+        return True
+
+    def getconn(self, timeout=None):
+        """ Check out a connection from the pool
+
+        Blocks until a connection is available if the maximum number
+        of connections is in use.
+
+        Parameters
+        ----------
+        timeout : float, optional
+            Maximum number of seconds to wait for a free connection
+
+        Returns
+        -------
+        psycopg2.connection
+            A healthy database connection
+        """
+        with self._cond:
+            self._check_fork()
+            if not self._cond.wait_for(
+                    lambda: self._idle or self._used < self._max_connections,
+                    timeout):
+                raise psycopg2.OperationalError(
+                    "No '%s' database connection available" % self.name)
+            self._used += 1
+            idle = self._idle.pop() if self._idle else None
+
+        settings = _session_settings()
+        try:
+            db = None
+            if idle is not None:
+                (db, idle_since, old_settings) = idle
+                if not self._is_healthy(db, idle_since):
+                    try:
+                        db.close()
+                    except psycopg2.Error:
+                        pass
+                    db = None
+            if db is None:
+                db, old_settings = self._connect(), ()
+            try:
+                self._apply_settings(db, old_settings, settings)
+            except psycopg2.Error:
+                db.close()
+                raise
+            with self._cond:
+                self._settings[id(db)] = settings
+            return db
+        except:
+            with self._cond:
+                self._used -= 1
+                self._cond.notify()
+            raise
+
+    def putconn(self, db, close=False):
+        """ Return a connection to the pool
+
+        Parameters
+        ----------
+        db : psycopg2.connection
+            Connection checked out with `getconn()`
+        close : bool, optional
+            Close the connection instead of keeping it for reuse
+
+        Returns
+        -------
+        void
+        """
+        with self._cond:
+            if self._pid != os.getpid():
+                # checked out by our parent process
+                return
+            self._used -= 1
+            settings = self._settings.pop(id(db), ())
+            if (not close and not db.closed
+                and len(self._idle) < self._max_idle):
+                if (db.get_transaction_status()
+                    != psycopg2.extensions.TRANSACTION_STATUS_IDLE):
+                    try:
+                        db.rollback()
+                    except psycopg2.Error:
+                        close = True
+                if not close:
+                    self._idle.append((db, time.time(), settings))
+                    db = None
+            self._cond.notify()
+
+        if db is not None and not db.closed:
+            db.close()
+
+    @contextlib.contextmanager
+    def connection(self):
+        """ Context manager checking out a connection for its scope """
+        db = self.getconn()
+        try:
+            yield db
+        finally:
+            self.putconn(db)
+
+    def closeall(self):
+        """ Close all idle connections """
+        with self._cond:
+            self._check_fork()
+            idle, self._idle = self._idle, []
+        for (db, idle_since, settings) in idle:
+            db.close()
+
+
+def area_key(polygon_wkt):
+    """ Identifier of an uploaded area
+
+    Parameters
+    ----------
+    polygon_wkt : str
+        WKT of the area in EPSG:4326
+
+    Returns
+    -------
+    str
+        Hash of the area WKT
+    """
+    return hashlib.sha1(polygon_wkt.encode('utf-8')).hexdigest()
+
+def area_sql(polygon_wkt):
+    """ SQL expression for the EPSG:3857 geometry of an uploaded area
+
+    Parameters
+    ----------
+    polygon_wkt : str
+        WKT of the area in EPSG:4326, as passed to `upload_area()`
+
+    Returns
+    -------
+    str
+        Scalar subquery returning the area geometry
+    """
+    return ("(SELECT way FROM %s WHERE id = '%s')"
+            % (AREA_TABLE, area_key(polygon_wkt)))
+
+def area_filter_sql(polygon_wkt, geometry):
+    """ SQL condition testing whether a geometry intersects an uploaded area
+
+    The condition uses the bounding box of the area for a spatial index
+    lookup first, and then tests the geometry against the area parts.
+
+    Parameters
+    ----------
+    polygon_wkt : str
+        WKT of the area in EPSG:4326, as passed to `upload_area()`
+    geometry : str
+        SQL expression of the EPSG:3857 geometry to test, must not
+        refer to a column named 'part' without table qualification
+
+    Returns
+    -------
+    str
+        SQL condition
+    """
+    return ("""(%(geometry)s && %(area)s
+                AND EXISTS (SELECT 1 FROM %(parts)s
+                             WHERE %(parts)s.id = '%(key)s'
+                               AND ST_INTERSECTS(%(geometry)s, %(parts)s.part)))"""
+            % { 'geometry': geometry,
+                'area':     area_sql(polygon_wkt),
+                'parts':    AREA_PARTS_TABLE,
+                'key':      area_key(polygon_wkt) })
+
+def upload_area(db, polygon_wkt,
+                max_vertices=DEFAULT_AREA_SUBDIVIDE_MAX_VERTICES):
+    """ Make an area available to queries on a connection
+
+    The area is transformed to EPSG:3857 and stored in a session
+    temporary table, unless it is already present, together with
+    its subdivided parts. Areas already present are split again if
+    they were split with a different maximum number of vertices. The
+    upload is committed right away, so that it survives later rollbacks.
+
+    Parameters
+    ----------
+    db : psycopg2.connection
+        Connection that will run queries using the area
+    polygon_wkt : str
+        WKT of the area in EPSG:4326
+    max_vertices : int, optional
+        Maximum number of vertices per area part, None for the default
+
+    Returns
+    -------
+    void
+    """
+    key = area_key(polygon_wkt)
+    max_vertices = max(int(max_vertices or DEFAULT_AREA_SUBDIVIDE_MAX_VERTICES), 5)
+    cursor = db.cursor()
+    cursor.execute("""CREATE TEMPORARY TABLE IF NOT EXISTS %s (
+                          id           text PRIMARY KEY,
+                          way          geometry,
+                          max_vertices integer
+                      )""" % AREA_TABLE)
+    cursor.execute("SELECT max_vertices FROM %s WHERE id = %%s" % AREA_TABLE, (key,))
+    row = cursor.fetchone()
+    if row is None or row[0] != max_vertices:
+        cursor.execute("""CREATE TEMPORARY TABLE IF NOT EXISTS %(parts)s (
+                              id   text,
+                              part geometry
+                          );
+                          CREATE INDEX IF NOT EXISTS %(parts)s_part_idx
+                              ON %(parts)s USING GIST (part)"""
+                       % { 'parts': AREA_PARTS_TABLE })
+
+        if row is None:
+            LOG.debug("Uploading area %s (%d bytes WKT)" % (key, len(polygon_wkt)))
+            cursor.execute("""INSERT INTO %s (id, way, max_vertices)
+                              VALUES (%%s, ST_TRANSFORM(ST_GEOMFROMTEXT(%%s, 4326), 3857), %%s)"""
+                           % AREA_TABLE, (key, polygon_wkt, max_vertices))
+        else:
+            LOG.debug("Splitting area %s again, now into parts of at most %d vertices"
+                      % (key, max_vertices))
+            cursor.execute("DELETE FROM %s WHERE id = %%s" % AREA_PARTS_TABLE, (key,))
+            cursor.execute("UPDATE %s SET max_vertices = %%s WHERE id = %%s"
+                           % AREA_TABLE, (max_vertices, key))
+
+        cursor.execute("""INSERT INTO %s (id, part)
+                          SELECT id, ST_SUBDIVIDE(way, %%s)
+                            FROM %s
+                           WHERE id = %%s"""
+                       % (AREA_PARTS_TABLE, AREA_TABLE),
+                       (max_vertices, key))
+        LOG.debug("Area %s split into %d parts" % (key, cursor.rowcount))
+
+        # temporary tables are not analyzed automatically
+        cursor.execute("ANALYZE %s" % AREA_PARTS_TABLE)
+    cursor.close()
+    db.commit()
+
+def discard_areas(db):
+    """ Remove all areas uploaded on a connection
+
+    Parameters
+    ----------
+    db : psycopg2.connection
+        Connection areas may have been uploaded on
+
+    Returns
+    -------
+    void
+    """
+    try:
+        cursor = db.cursor()
+        cursor.execute("DROP TABLE IF EXISTS pg_temp.%s, pg_temp.%s"
+                       % (AREA_TABLE, AREA_PARTS_TABLE))
+        cursor.close()
+        db.commit()
+    except psycopg2.Error as e:
+        LOG.debug("Could not discard uploaded areas: %s" % e)
+        db.rollback()
+
+def get_pool(name, config):
+    """ Get the connection pool for a datasource configuration section
+
+    Parameters
+    ----------
+    name : str
+        Datasource name, 'default' for the `[datasource]` section,
+        otherwise the suffix of a `[datasource_...name...]` section
+    config : configparser.ConfigParser
+        The OCitySMap configuration
+
+    Returns
+    -------
+    ConnectionPool
+        Shared connection pool for the datasource
+    """
+    section = 'datasource' if name == 'default' else 'datasource_' + name
+    datasource = dict(config.items(section))
+
+    params = {
+        'user':     datasource['user'],
+        'password': datasource['password'],
+        'host':     datasource['host'],
+        'database': datasource['dbname'],
+        # The port is not a mandatory configuration option, so make
+        # sure we define a default value.
+        'port':     datasource.get('port', 5432),
+    }
+
+    # set request timeout from configuration, or static default if not configured
+    try:
+        timeout = int(datasource.get('request_timeout',
+                                     config.get('datasource', 'request_timeout')))
+    except Exception:
+        timeout = DEFAULT_REQUEST_TIMEOUT_MIN
+
+    try:
+        max_idle = int(datasource.get('pool_max_idle', DEFAULT_POOL_MAX_IDLE))
+        max_connections = int(datasource.get('pool_max', DEFAULT_POOL_MAX))
+    except ValueError:
+        LOG.warning("Invalid pool size for datasource '%s', using defaults" % name)
+        max_idle, max_connections = DEFAULT_POOL_MAX_IDLE, DEFAULT_POOL_MAX
+
+    key = tuple(sorted(params.items())) + (timeout,)
+    with _POOLS_LOCK:
+        if key not in _POOLS:
+            _POOLS[key] = ConnectionPool(name, params, timeout,
+                                         max_idle, max_connections)
+        return _POOLS[key]
@@ -0,0 +1,77 @@
+# -*- coding: utf-8; mode: Python -*-
+import functools
+import os
+import unittest
+from unittest import mock
+
+try:
+    import psycopg2
+    import ocitysmap
+    from ocitysmap import datasource
+except ImportError:
+    psycopg2 = None
+
+
+class _Connection:
+    """ Stand-in for a psycopg2 connection that never talks to a server """
+
+    def __init__(self):
+        self.closed = 0
+
+    def close(self):
+        self.closed = 1
+
+    def get_transaction_status(self):
+        return psycopg2.extensions.TRANSACTION_STATUS_IDLE
+
+    def rollback(self):
+        pass
+
+    def commit(self):
+        pass
+
+
+def _pool(max_connections):
+    pool = datasource.ConnectionPool('test', {}, 1, max_idle=1,
+                                     max_connections=max_connections)
+    pool._connect = _Connection
+    # fail instead of blocking forever when the pool is exhausted
+    pool.getconn = functools.partial(pool.getconn, timeout=1)
+    return pool
+
+
+@unittest.skipIf(psycopg2 is None, "needs psycopg2")
+class get_db_test(unittest.TestCase):
+    def setUp(self):
+        patcher = mock.patch.dict(os.environ)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        os.environ.pop('PGOPTIONS', None)
+
+        self.pool = _pool(2)
+        self.mapper = ocitysmap.OCitySMap.__new__(ocitysmap.OCitySMap)
+        self.mapper._OCitySMap__dbs = {}
+        self.mapper._get_pool = lambda name='default': self.pool
+
+    def test_reuse(self):
+        db = self.mapper.get_db()
+        self.assertIs(self.mapper.get_db(), db)
+        self.assertEqual(self.pool._used, 1)
+
+    def test_closed_connection(self):
+        # the server closing the connection of a long lived process
+        # again and again must not exhaust the pool
+        for i in range(5):
+            db = self.mapper.get_db()
+            db.close()
+        db = self.mapper.get_db()
+        self.assertFalse(db.closed)
+        self.assertEqual(self.pool._used, 1)
+
+        self.mapper._OCitySMap__dbs = {}
+        self.pool.putconn(db)
+        self.assertEqual(self.pool._used, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
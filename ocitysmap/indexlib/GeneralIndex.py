@@ -16,10 +16,12 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import concurrent.futures
+from copy import copy
 import locale
+import queue
 from natsort import natsorted, natsort_keygen, ns
-from itertools import groupby
-from functools import reduce
+from itertools import chain, groupby
 import csv
 import datetime
 import math
@@ -39,13 +41,18 @@ from ocitysmap.layoutlib.abstract_renderer import Renderer
 from .commons import IndexCategory, IndexItem, IndexDoesNotFitError
 import ocitysmap.layoutlib.commons as UTILS
 from ocitysmap.coords import Point
-from .renderer import IndexRenderingArea
+from ocitysmap import datasource
+from .renderer import IndexRenderingArea, IndexLayoutPlan
+from . import text_metrics
 import logging
 LOG = logging.getLogger('ocitysmap')
 
 # TODO: define in single place, not in multiple files
 PAGE_NUMBER_MARGIN_PT  = UTILS.convert_mm_to_pt(10)
 
+# Number of rows to transfer at a time from server side index query cursors
+INDEX_QUERY_BATCH_SIZE = 2000
+
 class GeneralIndex:
     name = "Genaral"
     description = gettext(u"(* General Index *)")
@@ -100,7 +107,8 @@ class GeneralIndex:
         """
         self._categories.append(GeneralIndexCategory(name, items, is_street))
 
-    def _build_query(self, tables, columns, where, group=False, join=None):
+    def _build_query(self, tables, columns, where, group=False, join=None,
+                     polygon_wkt=None, raw_geometry=False):
         """
         Helper function builing a SQL query string to extract index information
         from the osm2pgsql database.
@@ -116,6 +124,12 @@ class GeneralIndex:
 	    WHERE condition to filter for valid index entries
 	group: bool, optional
 	    Whether to merge multiple items of same category and entry text
+        polygon_wkt: str, optional
+            Area of interest, defaults to the area of this index
+        raw_geometry: bool, optional
+            Return the WKB of the clipped item geometry in EPSG:3857
+            instead of the longitude and latitude of the endpoints of
+            its longest line in EPSG:4326, as four float columns
 
         Returns
         -------
@@ -138,11 +152,11 @@ class GeneralIndex:
         # template string and iterating over the table names
         subquery_template = """
 SELECT %(columns)s,
-       ST_INTERSECTION(%(wkb_limits)s, %(aggregate)stab1.%%(way)s%(aggreg_end)s) AS contour
+       ST_INTERSECTION(%(wkb_limits)s, %(aggregate)s%%(way)s%(aggreg_end)s) AS contour
            FROM planet_osm_%(table)s tab1
            %(join)s
           WHERE %(where)s
-            AND ST_INTERSECTS(%%(way)s, %(wkb_limits)s)
+            AND %(area_filter)s
           %(order_group)s
 """
 
@@ -153,8 +167,9 @@ SELECT %(columns)s,
                     'table': table,
                     'columns': ",".join(column_expressions),
                     'where': where,
-                    'wkb_limits': ("ST_TRANSFORM(ST_GEOMFROMTEXT('%s' , 4326), 3857)"
-                                   % (self._polygon_wkt,)),
+                    'wkb_limits': datasource.area_sql(polygon_wkt or self._polygon_wkt),
+                    'area_filter': datasource.area_filter_sql(polygon_wkt or self._polygon_wkt,
+                                                              '%(way)s'),
                     'aggregate': "ST_LINEMERGE(ST_COLLECT(" if group else "",
                     'aggreg_end': "))" if group else "",
                     'order_group': ("GROUP BY %s" % (",".join(column_aliases))) if group else "",
@@ -166,48 +181,226 @@ SELECT %(columns)s,
         # and wrap them by the outer query returning the actual result
         subquery = ' UNION ' . join(subquery_parts)
 
-        query = """
+        if raw_geometry:
+            query = """
 SELECT %(columns)s,
-       ST_ASTEXT(ST_TRANSFORM(ST_LONGESTLINE(contour,contour),
-                              4326)) AS longest_linestring
+       ST_ASBINARY(contour) AS contour
   FROM ( %(subquery)s
      ) AS foo
  ORDER BY %(columns)s
- """ % {'columns': (",".join(column_aliases)), 'subquery': subquery}
+ """
+        else:
+            query = """
+SELECT %(columns)s,
+       ST_X(ST_STARTPOINT(longest_line)) AS lon1,
+       ST_Y(ST_STARTPOINT(longest_line)) AS lat1,
+       ST_X(ST_ENDPOINT(longest_line)) AS lon2,
+       ST_Y(ST_ENDPOINT(longest_line)) AS lat2
+  FROM ( SELECT %(columns)s,
+                ST_TRANSFORM(ST_LONGESTLINE(contour,contour),
+                             4326) AS longest_line
+           FROM ( %(subquery)s
+              ) AS foo
+       ) AS bar
+ ORDER BY %(columns)s
+ """
+
+        return query % {'columns': (",".join(column_aliases)),
+                        'subquery': subquery}
+
+    def _query_index_rows(self, db, tables, columns, where, group=False, join=None, debug=False):
+        """
+        Run an index query for the area of this index.
+
+        On multi page atlas pages the rows are taken from the query
+        for the whole atlas area shared by all pages instead, if the
+        renderer provides one.
+
+        Parameters
+        ----------
+        db : psycopg2 database connection
+            The database to retrieve the information from
+        tables, columns, where, group, join, debug :
+            See `_build_query()`
+
+        Returns
+        -------
+        list of tuple
+            Result rows with the given columns, followed by longitude
+            and latitude of both endpoints of the longest line within
+            the item geometry
+        """
+        index_queries = getattr(self._renderer, 'index_queries', None)
+        if index_queries is not None and self._page_number is not None:
+            return index_queries.fetch(self, db, tables, columns, where,
+                                       group, join, debug, self._polygon_wkt)
+
+        query = self._build_query(tables, columns, where, group, join=join)
+        return self._fetch_rows(db, query, self._polygon_wkt, debug)
+
+    def _query_index_rows_concurrently(self, db, queries):
+        """
+        Run several independent index queries at the same time.
+
+        Queries are distributed over the given connection and extra
+        connections from the renderer's connection pool, so that the
+        database server can work on them in parallel. Only connections
+        available right away are used, and queries run one after the
+        other on the given connection if there are none.
+
+        Parameters
+        ----------
+        db : psycopg2 database connection
+            The database to retrieve the information from
+        queries : list of dict
+            Keyword arguments of `_query_index_rows()` for each query
+
+        Returns
+        -------
+        list of list of tuple
+            Result rows of each query, in query order
+        """
+        rc = getattr(self._renderer, 'rc', None)
+        pool = getattr(rc, 'db_pool', None)
+        workers = min(getattr(rc, 'index_query_workers', None) or 1, len(queries))
+
+        extra_connections = []
+        if pool is not None:
+            for i in range(workers - 1):
+                try:
+                    extra_connections.append(pool.getconn(timeout=0))
+                except psycopg2.OperationalError:
+                    break
+
+        if not extra_connections:
+            return [self._query_index_rows(db, **query) for query in queries]
+
+        connections = queue.Queue()
+        for conn in [db] + extra_connections:
+            connections.put(conn)
+
+        def run(query):
+            conn = connections.get()
+            try:
+                return self._query_index_rows(conn, **query)
+            finally:
+                connections.put(conn)
+
+        try:
+            LOG.debug("Running %d index queries on %d connections"
+                      % (len(queries), len(extra_connections) + 1))
+            with concurrent.futures.ThreadPoolExecutor(
+                    max_workers=len(extra_connections) + 1) as executor:
+                return list(executor.map(run, queries))
+        finally:
+            for conn in extra_connections:
+                if not conn.closed:
+                    datasource.discard_areas(conn)
+                pool.putconn(conn)
+
+    def _fetch_rows(self, db, query, polygon_wkt, debug=False):
+        """
+        Run a query built by `_build_query()` and fetch all result rows,
+        using the index query cache if one is configured.
+
+        Parameters
+        ----------
+        db : psycopg2 database connection
+            The database to retrieve the information from
+        query : str
+            The query string, with '%(way)s' geometry column placeholder
+        polygon_wkt : str
+            The area of interest the query refers to
+
+        Returns
+        -------
+        list of tuple
+            All result rows
+        """
+        rc = getattr(self._renderer, 'rc', None)
+        index_cache = getattr(rc, 'index_cache', None)
+        if index_cache is not None:
+            rows = index_cache.fetch(query)
+            if rows is not None:
+                LOG.debug("Using cached index query result")
+                return rows
+
+        datasource.upload_area(db, polygon_wkt,
+                               getattr(rc, 'area_subdivide_max_vertices', None))
+        rows = self._run_query(db, query, debug)
+
+        if index_cache is not None:
+            index_cache.store(query, rows)
 
-        return query
+        return rows
 
     @staticmethod
-    def _run_query(cursor, query, debug=False):
+    def _run_query(db, query, debug=False):
         """
         Simple helper to execute a SQL query on the osm2pgsql tables
 
         First tries fast, but fragile way, falls back to stable but slower
-        alternative in case of problems
+        alternative in case of problems. Rows are transferred in batches
+        from a server side cursor.
 
         Parameters
         ----------
-        cursor: psycopg2 database cursor
-            Cursor to process the query with
+        db: psycopg2 database connection
+            Connection to process the query with
         query: str
             The actual query string to execute, with '%(way)s'
             placeholder fo the actual Geometry column
 
         Returns
         -------
-        void
+        list of tuple
+            All result rows
         """
+        def fetch(way):
+            # server side cursor, so that the client does not need to
+            # hold the complete result set on top of the row tuples
+            rows = []
+            with db.cursor(name='ocitysmap_index') as cursor:
+                cursor.itersize = INDEX_QUERY_BATCH_SIZE
+                cursor.execute(query % {'way': way})
+                while True:
+                    batch = cursor.fetchmany(INDEX_QUERY_BATCH_SIZE)
+                    if not batch:
+                        break
+                    rows.extend(batch)
+            return rows
+
+        if debug:
+            LOG.warning(query % {'way':'way'})
         try:
-            if debug:
-                LOG.warning(query % {'way':'way'})
-            cursor.execute(query % {'way':'way'})
+            return fetch('way')
         except psycopg2.InternalError:
             # This exception generaly occurs when inappropriate ways have
             # to be cleaned. Using a buffer of 0 generaly helps to clean
             # them. This operation is not applied by default for
             # performance reasons.
             db.rollback()
-            cursor.execute(query % {'way':'st_buffer(way, 0)'})
+            return fetch('st_buffer(way, 0)')
+
+    @staticmethod
+    def _endpoints(lon1, lat1, lon2, lat2):
+        """
+        Index item endpoints from the coordinate columns of an index query
+
+        Parameters
+        ----------
+        lon1, lat1, lon2, lat2 : float or None
+            Endpoint coordinates, None if the item has no geometry
+            within the area of interest
+
+        Returns
+        -------
+        tuple of Point or None
+            The two endpoints, or None if there are no coordinates
+        """
+        if lon1 is None or lat1 is None or lon2 is None or lat2 is None:
+            return None
+        return Point(lat1, lon1), Point(lat2, lon2)
 
     def get_index_entries(self, db, tables, columns, where, group=False, category_mapping=None, max_category_items=maxsize, join=None, debug=False):
         """
@@ -238,25 +431,39 @@ SELECT %(columns)s,
         dict
             A dictionary of IndexCategory objects with category name as key
         """
-        cursor = db.cursor()
-        result = {}
+        rows = self._query_index_rows(db, tables, columns, where, group,
+                                      join=join, debug=debug)
 
-        query = self._build_query(tables, columns, where, group, join=join)
+        return self._index_entries(rows, category_mapping, max_category_items)
 
-        self._run_query(cursor, query, debug)
+    def _index_entries(self, rows, category_mapping=None, max_category_items=maxsize):
+        """
+        Turn the result rows of an index query into index categories,
+        see `get_index_entries()`.
 
-        for amenity_type, amenity_name, linestring in cursor.fetchall():
-            # Parse the WKT from the largest linestring in shape
-            try:
-                s_endpoint1, s_endpoint2 = map(lambda s: s.split(),
-                                               linestring[11:-1].split(','))
-            except (ValueError, TypeError):
-                LOG.exception("Error parsing %s for %s"
-                              % (repr(linestring),
-                                 repr(amenity_name)))
+        Parameters
+        ----------
+        rows : list of tuple
+            Result rows as returned by `_query_index_rows()`, with the
+            category name and the entry text as first two columns
+        category_mapping: dict, optional
+            Map SQL category results to more readable values
+        max_category_items: int, optional
+            Maximum number of entries before a categorie is dismissed
+
+        Returns
+        -------
+        list of GeneralIndexCategory
+            Index categories, sorted by name
+        """
+        result = {}
+
+        for amenity_type, amenity_name, *coordinates in rows:
+            endpoints = self._endpoints(*coordinates)
+            if endpoints is None:
+                LOG.debug("No geometry for %s" % repr(amenity_name))
                 continue
-            endpoint1 = Point(s_endpoint1[1], s_endpoint1[0])
-            endpoint2 = Point(s_endpoint2[1], s_endpoint2[0])
+            endpoint1, endpoint2 = endpoints
 
             if category_mapping is not None and amenity_type in category_mapping:
                 catname = category_mapping[amenity_type]
@@ -397,10 +604,7 @@ class GeneralIndexCategory(IndexCategory):
         """
 
         # calculate header dimensions based on layout
-        layout.set_auto_dir(False)
-        layout.set_alignment(Pango.Alignment.CENTER)
-        layout.set_text(self.name, -1)
-        width, height = [x / Pango.SCALE for x in layout.get_size()]
+        height = self.drawing_height(layout)
         wrap_width = layout.get_width() / Pango.SCALE
 
         # draw the category header background bar
@@ -418,6 +622,25 @@ class GeneralIndexCategory(IndexCategory):
         # return total document height used
         return height
 
+    def drawing_height(self, layout):
+        """
+        Category header height, as drawn by draw()
+
+        Parameters
+        ----------
+           layout: pango.layout
+               Layout to use to render the header, with its wrap width set
+
+        Returns
+        -------
+        float
+            Category header height
+        """
+        layout.set_auto_dir(False)
+        layout.set_alignment(Pango.Alignment.CENTER)
+        layout.set_text(self.name, -1)
+        return float(layout.get_size()[1]) / Pango.SCALE
+
 class GeneralIndexItem(IndexItem):
     """
     An IndexItem represents one item in the index (a street or a POI). It
@@ -650,33 +873,36 @@ class GeneralIndexRenderer:
         LOG.debug("Determining index area within %dx%d+%d+%d aligned %s/%s..."
                   % (w,h,x,y, alignment, freedom_direction))
 
-        # Create a PangoCairo context for drawing to Cairo
-        ctx = cairo.Context(surface)
-        pc  = PangoCairo.create_context(ctx)
-
-        # Iterate over the rendering_styles until we find a suitable layout
-        rendering_style = None
-        for rs in self._rendering_styles:
+        # Rendering styles are ordered from largest to smallest fonts, so
+        # bisect for the first one that fits instead of trying them all
+        splits = {}
+        def fits(i):
+            rs = self._rendering_styles[i]
             LOG.debug("Trying index fit using %s..." % rs)
             try:
-                n_cols, min_dimension \
-                    = self._compute_columns_split(ctx, pc, rs, w, h,
-                                                  freedom_direction)
-
-                # Great: index did fit OK !
-                rendering_style = rs
-                break
-
+                splits[i] = self._compute_columns_split(surface, rs, w, h,
+                                                        freedom_direction)
+                return True
             except IndexDoesNotFitError:
-                # Index did not fit => try smaller...
                 LOG.debug("Index %s too large: should try a smaller one."
                         % rs)
-                continue
+                return False
+
+        low, high = 0, len(self._rendering_styles)
+        while low < high:
+            middle = (low + high) // 2
+            if fits(middle):
+                high = middle
+            else:
+                low = middle + 1
 
         # Index really did not fit with any of the rendering styles ?
-        if not rendering_style:
+        if low not in splits:
             raise IndexDoesNotFitError("Index does not fit in area")
 
+        rendering_style = self._rendering_styles[low]
+        n_cols, min_dimension = splits[low]
+
         # Realign at bottom/top left/right
         if freedom_direction == 'height':
             index_width  = w
@@ -699,7 +925,105 @@ class GeneralIndexRenderer:
         return area
 
 
-    def render(self, ctx, p_rendering_area, dpi = UTILS.PT_PER_INCH):
+    def plan_layout(self, surface, p_rendering_area):
+        """
+        Compute the position of all headers and items of the street and
+        amenities index within the given area. Nothing will be drawn on
+        surface.
+
+        Parameters
+        ----------
+            surface : cairo.Surface
+                The cairo surface the index will be rendered to, or
+                one with the same font options.
+            p_rendering_area : IndexRenderingArea
+                The result from precompute_occupation_area().
+
+        Returns
+        -------
+        IndexLayoutPlan
+            The index layout, to be passed to render() for every
+            surface the index is rendered to.
+        """
+
+        if not self._index_categories:
+            raise commons.IndexEmptyError
+
+        # leave room for the frame drawn around the index
+        rendering_area = copy(p_rendering_area)
+        rendering_area.x = rendering_area.x + 1
+        rendering_area.y = rendering_area.y + 1
+        rendering_area.w = rendering_area.w - 2
+        rendering_area.h = rendering_area.h - 2
+
+        LOG.debug("Planning the street index layout within %s..."
+                  % rendering_area)
+
+        ##
+        ## In the following, the algorithm only manipulates values
+        ## expressed in 'pt', layouts are measured at the default
+        ## resolution, see render()
+        ##
+
+        ctx = cairo.Context(surface)
+
+        header_layout, header_fascent, header_fheight, header_em = \
+                draw_utils.create_layout_with_font(ctx,
+                    rendering_area.rendering_style.header_font_spec)
+        label_layout, label_fascent, label_fheight, label_em = \
+                draw_utils.create_layout_with_font(ctx,
+                    rendering_area.rendering_style.label_font_spec)
+
+        margin = label_em
+        column_width = int(rendering_area.w / rendering_area.n_cols)
+
+        header_layout.set_width(int((column_width - margin) * Pango.SCALE))
+
+        plan = IndexLayoutPlan(rendering_area, column_width, margin)
+
+        if not self._i18n.isrtl():
+            offset_x = margin/2.
+            delta_x  = column_width
+        else:
+            offset_x = rendering_area.w - column_width + margin/2.
+            delta_x  = - column_width
+
+        actual_n_cols = 1
+        offset_y = margin/2.
+        for category_index, category in enumerate(self._index_categories):
+            if ( offset_y + header_fheight + label_fheight
+                 + margin/2. > rendering_area.h ):
+                offset_y       = margin/2.
+                offset_x      += delta_x
+                actual_n_cols += 1
+
+            height = category.drawing_height(header_layout)
+            plan.add(0, category_index, None, offset_x, offset_y, height)
+            offset_y += height
+
+            for item_index, street in enumerate(category.items):
+                if ( offset_y + label_fheight + margin/2.
+                     > rendering_area.h ):
+                    offset_y       = margin/2.
+                    offset_x      += delta_x
+                    actual_n_cols += 1
+
+                plan.add(0, category_index, item_index, offset_x, offset_y,
+                         label_fheight)
+                offset_y += label_fheight
+
+        plan.n_cols = actual_n_cols
+
+        # Simple verification...
+        if actual_n_cols < rendering_area.n_cols:
+            LOG.warning("Rounding/security margin lost some space (%d actual cols vs. allocated %d" % (actual_n_cols, rendering_area.n_cols))
+        if actual_n_cols > rendering_area.n_cols:
+            LOG.warning("Rounding/security margin used more space (%d actual cols vs. allocated %d" % (actual_n_cols, rendering_area.n_cols))
+
+        return plan
+
+    def render(self, ctx, p_rendering_area, dpi = UTILS.PT_PER_INCH,
+               plan = None):
         """
         Render the street and amenities index at the given (x,y)
         coordinates into the provided Cairo surface. The index must
@@ -711,26 +1035,18 @@ class GeneralIndexRenderer:
             rendering_area (IndexRenderingArea): the result from
                 precompute_occupation_area().
             dpi (number): resolution of the target device.
+            plan (IndexLayoutPlan): the result from plan_layout() for
+                the same rendering area, computed here if not given.
         """
 
-        rendering_area = p_rendering_area
-        rendering_area.x = rendering_area.x + 1
-        rendering_area.y = rendering_area.y + 1
-        rendering_area.w = rendering_area.w - 2
-        rendering_area.h = rendering_area.h - 2
+        if plan is None:
+            plan = self.plan_layout(ctx.get_target(), p_rendering_area)
 
-        if not self._index_categories:
-            raise commons.IndexEmptyError
+        rendering_area = plan.rendering_area
 
         LOG.debug("Rendering the street index within %s at %sdpi..."
                   % (rendering_area, dpi))
 
-        ##
-        ## In the following, the algorithm only manipulates values
-        ## expressed in 'pt'. Only the drawing-related functions will
-        ## translate them to cairo units
-        ##
-
         ctx.save()
         ctx.move_to(UTILS.convert_pt_to_dots(rendering_area.x, dpi),
                     UTILS.convert_pt_to_dots(rendering_area.y, dpi))
@@ -748,9 +1064,6 @@ class GeneralIndexRenderer:
         label_layout, label_fascent, label_fheight, label_em = \
                 draw_utils.create_layout_with_font(ctx, label_fd)
 
-        #print "RENDER", header_layout, header_fascent, header_fheight, header_em
-        #print "RENDER", label_layout, label_fascent, label_fheight, label_em
-
         # By OCitysmap's convention, the default resolution is 72 dpi,
         # which maps to the default pangocairo resolution (96 dpi
         # according to pangocairo docs). If we want to render with
@@ -766,49 +1079,26 @@ class GeneralIndexRenderer:
         # different font metrics which don't fit in the prepared
         # layout anymore...
 
-        margin = label_em
-        column_width = int(rendering_area.w / rendering_area.n_cols)
-
         label_layout.set_width(int(UTILS.convert_pt_to_dots(
-                    (column_width - margin) * Pango.SCALE, dpi)))
+                    (plan.column_width - plan.margin) * Pango.SCALE, dpi)))
         header_layout.set_width(int(UTILS.convert_pt_to_dots(
-                    (column_width - margin) * Pango.SCALE, dpi)))
-
-        if not self._i18n.isrtl():
-            offset_x = margin/2.
-            delta_x  = column_width
-        else:
-            offset_x = rendering_area.w - column_width + margin/2.
-            delta_x  = - column_width
-
-        actual_n_cols = 1
-        offset_y = margin/2.
-        for category in self._index_categories:
-            if ( offset_y + header_fheight + label_fheight
-                 + margin/2. > rendering_area.h ):
-                offset_y       = margin/2.
-                offset_x      += delta_x
-                actual_n_cols += 1
-
-            height = category.draw(self._i18n.isrtl(), ctx, pc, header_layout,
-                                   UTILS.convert_pt_to_dots(header_fascent, dpi),
-                                   UTILS.convert_pt_to_dots(header_fheight, dpi),
-                                   UTILS.convert_pt_to_dots(rendering_area.x
-                                                            + offset_x, dpi),
-                                   UTILS.convert_pt_to_dots(rendering_area.y
-                                                            + offset_y
-                                                            + header_fascent, dpi))
-
-            offset_y += height * 72.0 / dpi
-
-            for street in category.items:
-                if ( offset_y + label_fheight + margin/2.
-                     > rendering_area.h ):
-                    offset_y       = margin/2.
-                    offset_x      += delta_x
-                    actual_n_cols += 1
-
-                street.draw(self._i18n.isrtl(), ctx, pc, label_layout,
+                    (plan.column_width - plan.margin) * Pango.SCALE, dpi)))
+
+        for (page, category_index, item_index,
+             offset_x, offset_y, height) in plan.entries:
+            category = self._index_categories[category_index]
+            if item_index is None:
+                category.draw(self._i18n.isrtl(), ctx, pc, header_layout,
+                              UTILS.convert_pt_to_dots(header_fascent, dpi),
+                              UTILS.convert_pt_to_dots(header_fheight, dpi),
+                              UTILS.convert_pt_to_dots(rendering_area.x
+                                                       + offset_x, dpi),
+                              UTILS.convert_pt_to_dots(rendering_area.y
+                                                       + offset_y
+                                                       + header_fascent, dpi))
+            else:
+                category.items[item_index].draw(
+                            self._i18n.isrtl(), ctx, pc, label_layout,
                             UTILS.convert_pt_to_dots(label_fascent, dpi),
                             UTILS.convert_pt_to_dots(label_fheight, dpi),
                             UTILS.convert_pt_to_dots(rendering_area.x
@@ -817,27 +1107,19 @@ class GeneralIndexRenderer:
                                                      + offset_y
                                                      + label_fascent, dpi))
 
-                offset_y += label_fheight
-
         # Restore original context
         ctx.restore()
 
-        # Simple verification...
-        if actual_n_cols < rendering_area.n_cols:
-            LOG.warning("Rounding/security margin lost some space (%d actual cols vs. allocated %d" % (actual_n_cols, rendering_area.n_cols))
-        if actual_n_cols > rendering_area.n_cols:
-            LOG.warning("Rounding/security margin used more space (%d actual cols vs. allocated %d" % (actual_n_cols, rendering_area.n_cols))
-
 
-    def _compute_lines_occupation(self, ctx, pc, font_desc, n_em_padding,
+    def _compute_lines_occupation(self, surface, font_spec, n_em_padding,
                                   text_lines):
         """Compute the visual dimension parameters of the initial long column
         for the given text lines with the given font.
 
         Args:
-            pc (pangocairo.CairoContext): the PangoCairo context.
-            font_desc (pango.FontDescription): Pango font description,
-                representing the used font at a given size.
+            surface (cairo.Surface): the surface the index will be drawn on.
+            font_spec (str): Pango font specification, representing the
+                used font at a given size.
             n_em_padding (int): number of extra em space to account for.
             text_lines (list): the list of text labels.
 
@@ -849,33 +1131,27 @@ class GeneralIndexRenderer:
             fheight: scaled font height.
         """
 
-        layout, fascent, fheight, em = draw_utils.create_layout_with_font(ctx,
-                                                                     font_desc)
-        #print "PREPARE", layout, fascent, fheight, em
+        metrics = text_metrics.get_text_metrics(surface, font_spec)
 
         if len(text_lines):
-            width = max(map(lambda x: self._label_width(layout, x), text_lines))
+            width = metrics.max_width(text_lines)
             # Save some extra space horizontally
-            width += n_em_padding * em
+            width += n_em_padding * metrics.em
         else:
             width = 0
 
-        height = fheight * len(text_lines)
+        height = metrics.fheight * len(text_lines)
 
         return {'column_width': width, 'column_height': height,
-                'fascent': fascent, 'fheight': fheight, 'em': em}
-
-
-    def _label_width(self, layout, label):
-        layout.set_text(label, -1)
-        return float(layout.get_size()[0]) / Pango.SCALE
+                'fascent': metrics.fascent, 'fheight': metrics.fheight,
+                'em': metrics.em}
 
-    def _compute_column_occupation(self, ctx, pc, rendering_style):
+    def _compute_column_occupation(self, surface, rendering_style):
         """Returns the size of the tall column with all headers, labels and
         squares for the given font sizes.
 
         Args:
-            pc (pangocairo.CairoContext): the PangoCairo context.
+            surface (cairo.Surface): the surface the index will be drawn on.
             rendering_style (GeneralIndexRenderingStyle): how to render the
                 headers and labels.
 
@@ -883,16 +1159,15 @@ class GeneralIndexRenderer:
                         vertical margin to reserve after each small column).
         """
 
-        header_fd = Pango.FontDescription(rendering_style.header_font_spec)
-        label_fd  = Pango.FontDescription(rendering_style.label_font_spec)
-
         # Account for maximum square width (at worst " " + "Z99-Z99")
-        label_block = self._compute_lines_occupation(ctx, pc, label_fd, 1+7,
-                reduce(lambda x,y: x+y.get_all_item_labels(),
-                       self._index_categories, []))
+        label_block = self._compute_lines_occupation(
+                surface, rendering_style.label_font_spec, 1+7,
+                list(chain.from_iterable(category.get_all_item_labels()
+                                         for category in self._index_categories)))
 
         # Reserve a small margin around the category headers
-        headers_block = self._compute_lines_occupation(ctx, pc, header_fd, 2,
+        headers_block = self._compute_lines_occupation(
+                surface, rendering_style.header_font_spec, 2,
                 [x.name for x in self._index_categories])
 
         column_width = max(label_block['column_width'],
@@ -908,7 +1183,7 @@ class GeneralIndexRenderer:
         return column_width, column_height, vertical_extra
 
 
-    def _compute_columns_split(self, ctx, pc, rendering_style,
+    def _compute_columns_split(self, surface, rendering_style,
                                zone_width_dots, zone_height_dots,
                                freedom_direction):
         """Computes the columns split for this index. From the one tall column
@@ -919,7 +1194,7 @@ class GeneralIndexRenderer:
         commons.IndexDoesNotFitError is raised.
 
         Args:
-            pc (pangocairo.CairoContext): the PangoCairo context.
+            surface (cairo.Surface): the surface the index will be drawn on.
             rendering_style (GeneralIndexRenderingStyle): how to render the
                 headers and labels.
             zone_width_dots (float): maximum width of the Cairo zone dedicated
@@ -936,7 +1211,7 @@ class GeneralIndexRenderer:
         """
 
         tall_width, tall_height, vertical_extra = \
-                self._compute_column_occupation(ctx, pc, rendering_style)
+                self._compute_column_occupation(surface, rendering_style)
 
         if zone_width_dots < tall_width:
             raise IndexDoesNotFitError
@@ -977,6 +1252,9 @@ class MultiPageIndexRenderer:
     related to the rendering of the street index on multiple pages
     """
 
+    HEADER_FONT_SPEC = "Georgia Bold 12"
+    LABEL_FONT_SPEC  = "DejaVu 6"
+
     # ctx: Cairo context
     # surface: Cairo surface
     def __init__(self, i18n, ctx, surface, index_categories, paper_size, rendering_area,
@@ -1024,35 +1302,24 @@ class MultiPageIndexRenderer:
         self._draw_page_number()
         self.index_page_num = self.index_page_num + 1
 
-    def render(self, dpi = UTILS.PT_PER_INCH):
-        self.ctx.save()
-
-        LOG.warning("render multipage index")
-
-        # Create a PangoCairo context for drawing to Cairo
-        pc = PangoCairo.create_context(self.ctx)
+    def plan_layout(self):
+        """
+        Compute the position of all headers and items of the index,
+        distributed over as many pages as needed. Nothing will be drawn.
 
-        header_fd = Pango.FontDescription("Georgia Bold 12")
-        label_column_fd  = Pango.FontDescription("DejaVu 6")
+        Returns
+        -------
+        IndexLayoutPlan
+            The index layout, to be passed to render(), or None if
+            there is nothing to render
+        """
 
+        # layouts are measured at the default resolution, so that all
+        # values are in 'pt', see render()
         header_layout, header_fascent, header_fheight, header_em = \
-            draw_utils.create_layout_with_font(self.ctx, header_fd)
+            draw_utils.create_layout_with_font(self.ctx, self.HEADER_FONT_SPEC)
         label_layout, label_fascent, label_fheight, label_em = \
-            draw_utils.create_layout_with_font(self.ctx, label_column_fd)
-        column_layout, _, _, _ = \
-            draw_utils.create_layout_with_font(self.ctx, label_column_fd)
-
-        # By OCitysmap's convention, the default resolution is 72 dpi,
-        # which maps to the default pangocairo resolution (96 dpi
-        # according to pangocairo docs). If we want to render with
-        # another resolution (different from 72), we have to scale the
-        # pangocairo resolution accordingly:
-        PangoCairo.context_set_resolution(column_layout.get_context(),
-                                          96.*dpi/UTILS.PT_PER_INCH)
-        PangoCairo.context_set_resolution(label_layout.get_context(),
-                                          96.*dpi/UTILS.PT_PER_INCH)
-        PangoCairo.context_set_resolution(header_layout.get_context(),
-                                          96.*dpi/UTILS.PT_PER_INCH)
+            draw_utils.create_layout_with_font(self.ctx, self.LABEL_FONT_SPEC)
 
         margin = label_em
 
@@ -1071,7 +1338,7 @@ class MultiPageIndexRenderer:
 
         # No street to render, bail out
         if max_label_drawing_width == 0.0:
-            return
+            return None
 
         # Find best number of columns
         max_drawing_width = \
@@ -1086,14 +1353,20 @@ class MultiPageIndexRenderer:
         # We have now have several columns
         column_width = self.rendering_area_w / columns_count
 
-        column_layout.set_width(int(UTILS.convert_pt_to_dots(
-                    (column_width - margin) * Pango.SCALE, dpi)))
-        label_layout.set_width(int(UTILS.convert_pt_to_dots(
+        label_layout.set_width(int(
                     (column_width - margin - max_location_drawing_width
                      - 2 * label_em)
-                    * Pango.SCALE, dpi)))
-        header_layout.set_width(int(UTILS.convert_pt_to_dots(
-                    (column_width - margin) * Pango.SCALE, dpi)))
+                    * Pango.SCALE))
+        header_layout.set_width(int((column_width - margin) * Pango.SCALE))
+
+        plan = IndexLayoutPlan(IndexRenderingArea(None,
+                                                  self.rendering_area_x,
+                                                  self.rendering_area_y,
+                                                  self.rendering_area_w,
+                                                  self.rendering_area_h,
+                                                  columns_count),
+                               column_width, margin)
+        plan.location_width = max_location_drawing_width
 
         if not self._i18n.isrtl():
             orig_offset_x = offset_x = margin/2.
@@ -1103,12 +1376,11 @@ class MultiPageIndexRenderer:
                 self.rendering_area_w - column_width + margin/2.
             orig_delta_x  = delta_x  = - column_width
 
+        page = 0
         actual_n_cols = 0
         offset_y = margin/2.
 
-        self._new_page()
-
-        for category in self.index_categories:
+        for category_index, category in enumerate(self.index_categories):
             if ( offset_y + header_fheight + label_fheight
                  + margin/2. > max_drawing_height ):
                 offset_y       = margin/2.
@@ -1116,24 +1388,17 @@ class MultiPageIndexRenderer:
                 actual_n_cols += 1
 
                 if actual_n_cols == columns_count:
-                    self._new_page()
+                    page += 1
                     actual_n_cols = 0
                     offset_y = margin / 2.
                     offset_x = orig_offset_x
                     delta_x  = orig_delta_x
 
-            height = category.draw(self._i18n.isrtl(), self.ctx, pc, header_layout,
-                                   UTILS.convert_pt_to_dots(header_fascent, dpi),
-                                   UTILS.convert_pt_to_dots(header_fheight, dpi),
-                                   UTILS.convert_pt_to_dots(self.rendering_area_x
-                                                            + offset_x, dpi),
-                                   UTILS.convert_pt_to_dots(self.rendering_area_y
-                                                            + offset_y
-                                                            + header_fascent, dpi))
-
+            height = category.drawing_height(header_layout)
+            plan.add(page, category_index, None, offset_x, offset_y, height)
             offset_y += height
 
-            for item in category.items:
+            for item_index, item in enumerate(category.items):
                 label_height = item.label_drawing_height(label_layout)
                 if ( offset_y + label_height + margin/2.
                      > max_drawing_height ):
@@ -1142,13 +1407,102 @@ class MultiPageIndexRenderer:
                     actual_n_cols += 1
 
                     if actual_n_cols == columns_count:
-                        self._new_page()
+                        page += 1
                         actual_n_cols = 0
                         offset_y = margin / 2.
                         offset_x = orig_offset_x
                         delta_x  = orig_delta_x
 
-                item.draw(self._i18n.isrtl(), self.ctx, pc, column_layout,
+                plan.add(page, category_index, item_index, offset_x, offset_y,
+                         label_height)
+                offset_y += label_height
+
+        plan.n_cols = actual_n_cols + 1
+
+        return plan
+
+    def render(self, dpi = UTILS.PT_PER_INCH, plan = None):
+        """
+        Render the index pages.
+
+        Parameters
+        ----------
+            dpi : float, optional
+                Resolution of the target device
+            plan : IndexLayoutPlan, optional
+                The result from plan_layout() for the same index and
+                paper size, computed here if not given
+
+        Returns
+        -------
+            void
+        """
+        if plan is None:
+            plan = self.plan_layout()
+
+        # No street to render, bail out
+        if plan is None:
+            return
+
+        self.ctx.save()
+
+        LOG.warning("render multipage index")
+
+        # Create a PangoCairo context for drawing to Cairo
+        pc = PangoCairo.create_context(self.ctx)
+
+        header_fd = Pango.FontDescription(self.HEADER_FONT_SPEC)
+        label_column_fd  = Pango.FontDescription(self.LABEL_FONT_SPEC)
+
+        header_layout, header_fascent, header_fheight, header_em = \
+            draw_utils.create_layout_with_font(self.ctx, header_fd)
+        label_layout, label_fascent, label_fheight, label_em = \
+            draw_utils.create_layout_with_font(self.ctx, label_column_fd)
+        column_layout, _, _, _ = \
+            draw_utils.create_layout_with_font(self.ctx, label_column_fd)
+
+        # By OCitysmap's convention, the default resolution is 72 dpi,
+        # which maps to the default pangocairo resolution (96 dpi
+        # according to pangocairo docs). If we want to render with
+        # another resolution (different from 72), we have to scale the
+        # pangocairo resolution accordingly:
+        PangoCairo.context_set_resolution(column_layout.get_context(),
+                                          96.*dpi/UTILS.PT_PER_INCH)
+        PangoCairo.context_set_resolution(label_layout.get_context(),
+                                          96.*dpi/UTILS.PT_PER_INCH)
+        PangoCairo.context_set_resolution(header_layout.get_context(),
+                                          96.*dpi/UTILS.PT_PER_INCH)
+
+        column_width = plan.column_width
+        margin = plan.margin
+
+        column_layout.set_width(int(UTILS.convert_pt_to_dots(
+                    (column_width - margin) * Pango.SCALE, dpi)))
+        label_layout.set_width(int(UTILS.convert_pt_to_dots(
+                    (column_width - margin - plan.location_width
+                     - 2 * label_em)
+                    * Pango.SCALE, dpi)))
+        header_layout.set_width(int(UTILS.convert_pt_to_dots(
+                    (column_width - margin) * Pango.SCALE, dpi)))
+
+        for (page, category_index, item_index,
+             offset_x, offset_y, height) in plan.entries:
+            while self.index_page_num <= page:
+                self._new_page()
+
+            category = self.index_categories[category_index]
+            if item_index is None:
+                category.draw(self._i18n.isrtl(), self.ctx, pc, header_layout,
+                              UTILS.convert_pt_to_dots(header_fascent, dpi),
+                              UTILS.convert_pt_to_dots(header_fheight, dpi),
+                              UTILS.convert_pt_to_dots(self.rendering_area_x
+                                                       + offset_x, dpi),
+                              UTILS.convert_pt_to_dots(self.rendering_area_y
+                                                       + offset_y
+                                                       + header_fascent, dpi))
+            else:
+                category.items[item_index].draw(
+                            self._i18n.isrtl(), self.ctx, pc, column_layout,
                             UTILS.convert_pt_to_dots(label_fascent, dpi),
                             UTILS.convert_pt_to_dots(label_fheight, dpi),
                             UTILS.convert_pt_to_dots(self.rendering_area_x
@@ -1157,11 +1511,8 @@ class MultiPageIndexRenderer:
                                                      + offset_y
                                                      + label_fascent, dpi),
                             label_layout,
-                            UTILS.convert_pt_to_dots(label_height, dpi),
-                            UTILS.convert_pt_to_dots(max_location_drawing_width,
+                            UTILS.convert_pt_to_dots(height, dpi),
+                            UTILS.convert_pt_to_dots(plan.location_width,
                                                      dpi))
 
-                offset_y += label_height
-
-
         self.ctx.restore()
@@ -65,11 +65,17 @@ class StreetIndex(GeneralIndex):
     def __init__(self, db, renderer, bbox, polygon_wkt, i18n, page_number=None):
         GeneralIndex.__init__(self, db, renderer, bbox, polygon_wkt, i18n, page_number)
 
-        # Build the contents of the index
+        # Build the contents of the index, the queries for the
+        # different kinds of entries are independent of each other
+        streets, amenities, villages = self._query_index_rows_concurrently(
+            db, [self._streets_query(),
+                 self._amenities_query(),
+                 self._villages_query()])
+
         self._categories = \
-            (self._list_streets(db)
-             + self._list_amenities(db)
-             + self._list_villages(db))
+            (self._list_streets(streets)
+             + self._list_amenities(amenities)
+             + self._list_villages(villages))
 
     def _get_selected_amenities(self):
         """
@@ -111,10 +117,9 @@ class StreetIndex(GeneralIndex):
 
         Args:
             sl (list of tuple): list tuples of the form (street_name,
-                                linestring_wkt) where linestring_wkt
-                                is a WKT for the linestring between
-                                the 2 most distant point of the
-                                street, in 4326 SRID
+                                lon1, lat1, lon2, lat2) where the
+                                coordinates are the 2 most distant
+                                points of the street, in 4326 SRID
 
         Returns the list of IndexCategory objects. Each IndexItem will
         have its square location still undefined at that point
@@ -129,18 +134,19 @@ class StreetIndex(GeneralIndex):
         except Exception:
             LOG.warning('error while setting LC_COLLATE to "%s"' % self._i18n.language_code())
 
+        streets = [(name, coordinates) for name, *coordinates in sl]
         try:
             sorted_sl = sorted(
-                [(self._i18n.user_readable_street(name), linestring) for name,linestring in sl],
+                [(self._i18n.user_readable_street(name), coordinates) for name,coordinates in streets],
                 key = natsort_keygen(alg=ns.LOCALE|ns.IGNORECASE, key=lambda street: street[0]))
         except:
-            sorted_sl= sl
+            sorted_sl= streets
         finally:
             locale.setlocale(locale.LC_COLLATE, prev_locale)
 
         result = []
         current_category = None
-        for street_name, linestring in sorted_sl:
+        for street_name, coordinates in sorted_sl:
             # Create new category if needed
             cat_name = ""
             for c in street_name:
@@ -156,16 +162,11 @@ class StreetIndex(GeneralIndex):
                 current_category = StreetIndexCategory(cat_name)
                 result.append(current_category)
 
-            # Parse the WKT from the largest linestring in shape
-            try:
-                s_endpoint1, s_endpoint2 = map(lambda s: s.split(),
-                                               linestring[11:-1].split(','))
-            except (ValueError, TypeError):
-                LOG.exception("Error parsing %s for %s" % (repr(linestring),
-                                                         repr(street_name)))
+            endpoints = self._endpoints(*coordinates)
+            if endpoints is None:
+                LOG.debug("No geometry for %s" % repr(street_name))
                 continue
-            endpoint1 = ocitysmap.coords.Point(s_endpoint1[1], s_endpoint1[0])
-            endpoint2 = ocitysmap.coords.Point(s_endpoint2[1], s_endpoint2[0])
+            endpoint1, endpoint2 = endpoints
             current_category.items.append(GeneralIndexItem(street_name,
                                                            endpoint1,
                                                            endpoint2,
@@ -173,26 +174,26 @@ class StreetIndex(GeneralIndex):
 
         return result
 
-    def _list_streets(self, db):
+    def _streets_query(self):
+        """Arguments of the `_query_index_rows()` query for all streets
+        inside the given polygon."""
+        return { 'tables':  ["line"],
+                 'columns': ["name"],
+                 'where':   "TRIM(name) != '' AND highway IN ('primary','secondary','tertiary','unclassified','road','motorway','trunk','residential','living_street','pedestrian','track','construction')",
+                 'group':   True }
+
+    def _list_streets(self, sl):
         """Get the list of streets inside the given polygon. Don't
         try to map them onto the grid of squares (there location_str
         field remains undefined).
 
         Args:
-           db (psycopg2 DB): The GIS database
+           sl (list of tuple): result rows of the `_streets_query()`
 
         Returns a list of commons.IndexCategory objects, with their IndexItems
         having no specific grid square location
         """
 
-        cursor = db.cursor()
-        LOG.debug("Getting streets...")
-
-        query = self._build_query(["line"], ["name"], "TRIM(name) != '' AND highway IN ('primary','secondary','tertiary','unclassified','road','motorway','trunk','residential','living_street','pedestrian','track','construction')", True)
-        self._run_query(cursor, query)
-
-        sl = cursor.fetchall()
-
         LOG.debug("Got %d streets." % len(sl))
 
         if len(sl) > MAX_INDEX_STREETS:
@@ -201,47 +202,34 @@ class StreetIndex(GeneralIndex):
         return self._convert_street_index(sl)
 
 
-    def _list_amenities(self, db):
-        """Get the list of amenities inside the given polygon. Don't
-        try to map them onto the grid of squares (there location_str
-        field remains undefined).
+    def _amenities_query(self):
+        """Arguments of the `_query_index_rows()` query for the selected
+        amenities inside the given polygon."""
+        sep = "','"
+        amenities_in = "'" + sep.join(self._get_selected_amenities()) + "'"
 
-        Args:
-           db (psycopg2 DB): The GIS database
+        return { 'tables':  ["point","polygon"],
+                 'columns': ["amenity", "name"],
+                 'where':   ("TRIM(name) != '' AND amenity in (%s)" % amenities_in) }
 
-        Returns a list of commons.IndexCategory objects, with their IndexItems
-        having no specific grid square location
-        """
-
-        sep = "','"
-        amenities = self._get_selected_amenities()
-        amenities_in = "'" + sep.join(amenities) + "'"
-        
-        return self.get_index_entries(db,
-                                      ["point","polygon"],
-                                      ["amenity", "name"],
-                                      ("TRIM(name) != '' AND amenity in (%s)" % amenities_in),
-                                      category_mapping = amenities)
-
-    def _list_villages(self, db):
-        """Get the list of villages inside the given polygon. Don't
+    def _list_amenities(self, rows):
+        """Get the list of amenities inside the given polygon. Don't
         try to map them onto the grid of squares (there location_str
         field remains undefined).
 
         Args:
-           db (psycopg2 DB): The GIS database
+           rows (list of tuple): result rows of the `_amenities_query()`
 
         Returns a list of commons.IndexCategory objects, with their IndexItems
         having no specific grid square location
         """
 
-        cursor = db.cursor()
-
-        result = []
-        current_category = StreetIndexCategory(_(u"Villages"),
-                                               is_street=False)
-        result.append(current_category)
+        return self._index_entries(rows,
+                                   category_mapping = self._get_selected_amenities())
 
+    def _villages_query(self):
+        """Arguments of the `_query_index_rows()` query for all villages
+        inside the given polygon."""
         places = ['borough',
                   'suburb',
                   'quarter',
@@ -252,11 +240,23 @@ class StreetIndex(GeneralIndex):
         sep = "','"
         places_in = "'" + sep.join(places) + "'"
 
-        return self.get_index_entries(db,
-                                      ["point"],
-                                      ["'Village'", "name"],
-                                      ("TRIM(name) != '' AND place IN (%s)" % places_in),
-                                      max_category_items=100)
+        return { 'tables':  ["point"],
+                 'columns': ["'Village'", "name"],
+                 'where':   ("TRIM(name) != '' AND place IN (%s)" % places_in) }
+
+    def _list_villages(self, rows):
+        """Get the list of villages inside the given polygon. Don't
+        try to map them onto the grid of squares (there location_str
+        field remains undefined).
+
+        Args:
+           rows (list of tuple): result rows of the `_villages_query()`
+
+        Returns a list of commons.IndexCategory objects, with their IndexItems
+        having no specific grid square location
+        """
+
+        return self._index_entries(rows, max_category_items=100)
 
 
     
@@ -40,7 +40,7 @@ class TreeIndex(GeneralIndex):
     description = gettext(u"Tree genus / species index")
 
     def __init__(self, db, renderer, bbox, polygon_wkt, i18n, page_number=None):
-        GeneralIndex.__init__(self, renderer, db, bbox, polygon_wkt, i18n, page_number)
+        GeneralIndex.__init__(self, db, renderer, bbox, polygon_wkt, i18n, page_number)
         
         # Build the contents of the index
         self._categories = (self._list_amenities(db))
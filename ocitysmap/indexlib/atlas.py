@@ -0,0 +1,207 @@
+# -*- coding: utf-8 -*-
+
+# ocitysmap, city map and street index generator from OpenStreetMap data
+# Copyright (C) 2023  Hartmut Holzgraefe
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Single pass index queries for multi page atlases
+
+Multi page layouts create one index per map page, each of them limited
+to the part of the rendering area shown on its page. Instead of running
+the index queries of every page against the database, `AtlasIndexQueries`
+runs each distinct query only once for the whole rendering area, and
+returns the clipped feature geometries. The result rows for a single
+page are then derived from these in Python, by clipping the features
+to the page area and determining their longest line the same way as
+PostGIS' ST_LONGESTLINE does.
+"""
+
+import logging
+import math
+import numbers
+
+import shapely.ops
+import shapely.wkb
+import shapely.wkt
+from shapely.strtree import STRtree
+
+LOG = logging.getLogger('ocitysmap')
+
+# Radius used by the EPSG:3857 spherical mercator projection
+_EARTH_RADIUS = 6378137.0
+
+
+def _to_mercator(lon, lat):
+    x = math.radians(lon) * _EARTH_RADIUS
+    y = math.log(math.tan(math.pi / 4 + math.radians(lat) / 2)) * _EARTH_RADIUS
+    return x, y
+
+def _from_mercator(x, y):
+    lon = math.degrees(x / _EARTH_RADIUS)
+    lat = math.degrees(2 * math.atan(math.exp(y / _EARTH_RADIUS)) - math.pi / 2)
+    return lon, lat
+
+def _point_arrays(geometry):
+    """ Point arrays of a geometry as compared by PostGIS' ST_LONGESTLINE
+
+    Multi geometries and collections are flattened into their parts,
+    polygons are only represented by their exterior ring, and only the
+    x and y coordinates of the vertices are taken into account.
+    """
+    if geometry.is_empty:
+        return
+    if hasattr(geometry, 'geoms'):
+        for part in geometry.geoms:
+            yield from _point_arrays(part)
+    elif geometry.geom_type == 'Polygon':
+        yield [c[:2] for c in geometry.exterior.coords]
+    else:
+        yield [c[:2] for c in geometry.coords]
+
+def longest_line(geometry):
+    """ The two most distant vertices of a geometry
+
+    Equivalent to PostGIS' ST_LONGESTLINE(geometry, geometry). The most
+    distant vertices are always part of the convex hull, so only these
+    are compared. Pairs of vertices are compared part by part, and in
+    vertex order within the parts, like PostGIS does, so that ties
+    between equally long lines are resolved the same way.
+
+    Parameters
+    ----------
+    geometry : shapely geometry
+        Non-empty geometry
+
+    Returns
+    -------
+    tuple
+        Two (x, y) coordinate tuples
+    """
+    hull_vertices = set()
+    for points in _point_arrays(geometry.convex_hull):
+        hull_vertices.update(points)
+    parts = [[vertex for vertex in points if vertex in hull_vertices]
+             for points in _point_arrays(geometry)]
+    parts = [part for part in parts if part]
+
+    best = None
+    best_distance = -1.0
+    for part1 in parts:
+        for part2 in parts:
+            for p1 in part1:
+                for p2 in part2:
+                    distance = (p1[0] - p2[0]) ** 2 + (p1[1] - p2[1]) ** 2
+                    if distance > best_distance:
+                        best, best_distance = (p1, p2), distance
+    return best
+
+
+class _AreaResult:
+    """
+    Result rows of one index query for the whole atlas area.
+    """
+
+    def __init__(self, rows):
+        self.columns = []
+        self.geometries = []
+        for row in rows:
+            if row[-1] is None:
+                continue
+            geometry = shapely.wkb.loads(bytes(row[-1]))
+            if geometry.is_empty:
+                continue
+            self.columns.append(tuple(row[:-1]))
+            self.geometries.append(geometry)
+
+        self._tree = STRtree(self.geometries) if self.geometries else None
+        self._index_by_id = dict((id(g), i) for i, g in enumerate(self.geometries))
+
+    def candidates(self, area):
+        """ Indexes of all rows whose geometry bounding box intersects area """
+        if self._tree is None:
+            return []
+        found = self._tree.query(area)
+        # Shapely 2 returns indexes, Shapely 1.x the geometries themselves
+        if len(found) and not isinstance(found[0], numbers.Integral):
+            found = [self._index_by_id[id(g)] for g in found]
+        return sorted(int(i) for i in found)
+
+
+class AtlasIndexQueries:
+    """
+    Index queries shared by all pages of a multi page atlas.
+    """
+
+    def __init__(self, polygon_wkt):
+        """
+        Parameters
+        ----------
+        polygon_wkt : str
+            WKT of the whole atlas area of interest, in EPSG:4326
+        """
+        self._polygon_wkt = polygon_wkt
+        self._results = {}
+
+    def fetch(self, index, db, tables, columns, where, group, join, debug,
+              page_polygon_wkt):
+        """ Index query result rows for one atlas page
+
+        Runs the query for the whole atlas area on first use, and then
+        derives the result rows for the given page area from it.
+
+        Parameters
+        ----------
+        index : GeneralIndex
+            The page index requesting the rows, used to build the query
+        db : psycopg2 database connection
+            The database to run the area query on
+        tables, columns, where, group, join, debug :
+            Query parameters as taken by `GeneralIndex._build_query()`
+        page_polygon_wkt : str
+            WKT of the page area of interest, in EPSG:4326
+
+        Returns
+        -------
+        list of tuple
+            Rows with the query's columns and the endpoint coordinates
+            of the longest line of each feature within the page area,
+            like the rows returned by the query for the page area itself
+        """
+        query = index._build_query(tables, columns, where, group, join=join,
+                                   polygon_wkt=self._polygon_wkt,
+                                   raw_geometry=True)
+
+        result = self._results.get(query)
+        if result is None:
+            result = _AreaResult(index._fetch_rows(db, query,
+                                                   self._polygon_wkt, debug))
+            LOG.debug("Atlas index query returned %d features"
+                      % len(result.geometries))
+            self._results[query] = result
+
+        page_area = shapely.ops.transform(
+            lambda x, y, z=None: _to_mercator(x, y),
+            shapely.wkt.loads(page_polygon_wkt))
+
+        rows = []
+        for i in result.candidates(page_area):
+            contour = page_area.intersection(result.geometries[i])
+            if contour.is_empty:
+                continue
+            p1, p2 = longest_line(contour)
+            rows.append(result.columns[i]
+                        + _from_mercator(*p1) + _from_mercator(*p2))
+
+        return rows
@@ -0,0 +1,128 @@
+# -*- coding: utf-8; mode: Python -*-
+import unittest
+
+import shapely.ops
+import shapely.wkt
+
+from ocitysmap.indexlib.atlas import (AtlasIndexQueries, longest_line,
+                                      _to_mercator)
+
+# Expected results follow what the per page index queries returned with
+# ST_ASTEXT(ST_TRANSFORM(ST_LONGESTLINE(contour, contour), 4326)), with
+# contour being ST_INTERSECTION() of the page area and the item geometry:
+# the first pair of vertices with the largest distance, comparing the
+# parts of multi geometries pairwise, and only the exterior rings of
+# polygons.
+
+class longest_line_test(unittest.TestCase):
+    def check(self, wkt, expected):
+        self.assertEqual(longest_line(shapely.wkt.loads(wkt)), expected)
+
+    def test_linestring(self):
+        self.check('LINESTRING(0 0, 1 0, 3 0, 2 0)', ((0, 0), (3, 0)))
+
+    def test_multilinestring(self):
+        self.check('MULTILINESTRING((0 0, 1 1), (4 0, 5 -1))',
+                   ((0, 0), (5, -1)))
+
+    def test_multilinestring_tie(self):
+        # (1 0)-(0 1) is as long as (0 0)-(1 1), but comes in a later
+        # pair of parts, while a flat vertex order would list it first
+        self.check('MULTILINESTRING((1 0, 0 0, 1 1), (0 1, 0.5 1))',
+                   ((0, 0), (1, 1)))
+
+    def test_polygon_with_hole(self):
+        self.check('POLYGON((0 0, 4 0, 4 3, 0 3, 0 0),'
+                   '        (1 1, 2 1, 2 2, 1 2, 1 1))',
+                   ((0, 0), (4, 3)))
+
+    def test_polygon_tie(self):
+        self.check('POLYGON((0 0, 0 1, 1 1, 1 0, 0 0))', ((0, 0), (1, 1)))
+        self.check('POLYGON((1 0, 1 1, 0 1, 0 0, 1 0))', ((1, 0), (0, 1)))
+
+    def test_multipolygon(self):
+        self.check('MULTIPOLYGON(((0 0, 1 0, 1 1, 0 0)),'
+                   '             ((3 3, 4 3, 4 4, 3 3)))',
+                   ((0, 0), (4, 4)))
+
+    def test_point(self):
+        self.check('POINT(2 3)', ((2, 3), (2, 3)))
+
+    def test_multipoint(self):
+        self.check('MULTIPOINT((0 0), (3 4), (0 0))', ((0, 0), (3, 4)))
+
+    def test_collection(self):
+        self.check('GEOMETRYCOLLECTION(POINT(5 5), LINESTRING(0 0, 1 0))',
+                   ((5, 5), (0, 0)))
+
+
+class _Index:
+    """ Stand-in for a GeneralIndex with canned area query results """
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.fetched = []
+
+    def _build_query(self, tables, columns, where, group, join=None,
+                     polygon_wkt=None, raw_geometry=False):
+        return "%s|%s|%s" % (tables, where, polygon_wkt)
+
+    def _fetch_rows(self, db, query, polygon_wkt, debug=False):
+        self.fetched.append(query)
+        return self.rows
+
+
+def _mercator_wkb(wkt):
+    geometry = shapely.ops.transform(lambda x, y, z=None: _to_mercator(x, y),
+                                     shapely.wkt.loads(wkt))
+    return geometry.wkb
+
+
+def _page(lon1, lat1, lon2, lat2):
+    return ('POLYGON((%f %f, %f %f, %f %f, %f %f, %f %f))'
+            % (lon1, lat1, lon2, lat1, lon2, lat2, lon1, lat2, lon1, lat1))
+
+
+class AtlasIndexQueries_test(unittest.TestCase):
+    def setUp(self):
+        self.index = _Index([
+            ('street', 'Across', _mercator_wkb('LINESTRING(-1 0.5, 2 0.5)')),
+            ('street', 'Elsewhere', _mercator_wkb('LINESTRING(5 5, 6 5)')),
+            ('amenity', 'Point', _mercator_wkb('POINT(0.25 0.75)')),
+            ('amenity', 'Triangle',
+             _mercator_wkb('POLYGON((0.5 0.5, 3 0.5, 0.5 0.9, 0.5 0.5))')),
+            ('amenity', 'Unknown', None),
+        ])
+        self.queries = AtlasIndexQueries(_page(-1, -1, 3, 2))
+
+    def fetch(self, page_wkt):
+        rows = self.queries.fetch(self.index, None, 'planet_osm_line',
+                                  [], 'true', False, None, False, page_wkt)
+        return dict((row[1], row) for row in rows)
+
+    def assertEndpoints(self, row, expected):
+        endpoints = [(round(row[2], 6), round(row[3], 6)),
+                     (round(row[4], 6), round(row[5], 6))]
+        self.assertEqual(sorted(endpoints), sorted(expected))
+
+    def test_partitioning(self):
+        rows = self.fetch(_page(0, 0, 1, 1))
+        self.assertEqual(sorted(rows), ['Across', 'Point', 'Triangle'])
+        self.assertEqual(rows['Across'][:2], ('street', 'Across'))
+        self.assertEndpoints(rows['Across'], [(0, 0.5), (1, 0.5)])
+        self.assertEndpoints(rows['Point'], [(0.25, 0.75), (0.25, 0.75)])
+        self.assertEndpoints(rows['Triangle'], [(1, 0.5), (0.5, 0.9)])
+
+        rows = self.fetch(_page(1, 0, 2, 1))
+        self.assertEqual(sorted(rows), ['Across', 'Triangle'])
+        self.assertEndpoints(rows['Across'], [(1, 0.5), (2, 0.5)])
+
+        rows = self.fetch(_page(10, 10, 11, 11))
+        self.assertEqual(rows, {})
+
+        # the area query only runs once for all pages
+        self.assertEqual(len(self.index.fetched), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
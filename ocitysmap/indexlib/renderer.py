@@ -36,6 +36,7 @@ from functools import reduce
 
 from . import commons
 import ocitysmap.layoutlib.commons as UTILS
+from ocitysmap.cachelib.commons import hash_key
 
 from colour import Color
 
@@ -78,6 +79,74 @@ class IndexRenderingArea:
                self.w, self.h, self.x, self.y, self.n_cols)
 
 
+class IndexLayoutPlan:
+    """
+    The IndexLayoutPlan class holds the precomputed position of every
+    header and item of an index. It is returned by the plan_layout()
+    methods of the index renderers and replayed by their render()
+    methods, so that an index only needs to be laid out once per job,
+    no matter how many surfaces it is drawn on. It only holds plain
+    values, all positions are in pt relative to the rendering area.
+    """
+
+    def __init__(self, rendering_area, column_width, margin):
+        """
+        Args:
+             rendering_area (IndexRenderingArea): the actual area to
+                   render the index into.
+             column_width (float): width of a single column (pt).
+             margin (float): horizontal margin within columns (pt).
+        """
+        self.rendering_area = rendering_area
+        self.column_width   = column_width
+        self.margin         = margin
+
+        # Number of columns actually used, of the last page for
+        # layouts spanning several pages
+        self.n_cols = 0
+
+        # Width reserved for item locations, for layouts wrapping labels
+        self.location_width = 0
+
+        # (page, category index, item index or None for the category
+        #  header, x offset, y offset, height) tuples in drawing order
+        self.entries = []
+
+    def add(self, page, category_index, item_index, offset_x, offset_y,
+            height):
+        """ Add the position of a category header or index item """
+        self.entries.append((page, category_index, item_index,
+                             offset_x, offset_y, height))
+
+    @property
+    def page_count(self):
+        """ Number of pages the index spans """
+        if not self.entries:
+            return 0
+        return self.entries[-1][0] + 1
+
+    def __str__(self):
+        return "Plan(%s, %d entries, %d pages)" \
+            % (self.rendering_area, len(self.entries), self.page_count)
+
+
+def index_fingerprint(categories):
+    """ Identify the contents of an index
+
+    Layouts computed for one index can be reused for any other index
+    with the same fingerprint.
+
+    Args:
+         categories (list of IndexCategory): the index contents.
+
+    Returns a str hash of all category names, item labels and item
+    locations.
+    """
+    return hash_key([[category.name,
+                      [[item.label, item.location_str] for item in category.items]]
+                     for category in categories])
+
+
 
 if __name__ == '__main__':
     import random
@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+
+# ocitysmap, city map and street index generator from OpenStreetMap data
+# Copyright (C) 2023  Hartmut Holzgraefe
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Process wide cache of index text measurements
+
+Laying out an index measures the width of every index label and header
+with each rendering style tried, and the same index is laid out again
+for every output format. Text widths only depend on the font and on the
+font options of the target surface though, so they are measured once
+per process into `TextMetrics` objects, one per font specification and
+set of font options, and reused from there.
+"""
+
+import collections
+import threading
+
+import cairo
+import gi
+gi.require_version('Pango', '1.0')
+gi.require_version('PangoCairo', '1.0')
+from gi.repository import Pango, PangoCairo
+
+# Maximum number of fonts to keep measurements for
+MAX_FONTS = 64
+
+# Maximum number of text widths to keep per font
+MAX_TEXTS_PER_FONT = 100000
+
+_cache = collections.OrderedDict()
+_cache_lock = threading.Lock()
+
+
+class TextMetrics:
+    """
+    Font metrics and memoized text widths of one font.
+    """
+
+    def __init__(self, font_spec, font_options):
+        """
+        Parameters
+        ----------
+        font_spec : str
+            Pango font specification, like "DejaVu Sans Condensed Bold 12"
+        font_options : cairo.FontOptions
+            Font options of the surface the text will be drawn on
+        """
+        self.font_spec = font_spec
+
+        # measure on a private surface, so that no reference to the
+        # caller's surface is kept beyond its lifetime
+        self._surface = cairo.RecordingSurface(cairo.CONTENT_COLOR_ALPHA, None)
+        ctx = cairo.Context(self._surface)
+        ctx.set_font_options(font_options)
+
+        font_desc = Pango.FontDescription(font_spec)
+        self._layout = PangoCairo.create_layout(ctx)
+        self._layout.set_font_description(font_desc)
+        font_metric = self._layout.get_context().load_font(font_desc).get_metrics()
+
+        self.fascent = float(font_metric.get_ascent()) / Pango.SCALE
+        self.fheight = float((font_metric.get_ascent() + font_metric.get_descent())
+                             / Pango.SCALE)
+        self.em = float(font_metric.get_approximate_char_width()) / Pango.SCALE
+
+        self._widths = {}
+        self._lock = threading.Lock()
+
+    def width(self, text):
+        """ Width of a single line of text
+
+        Parameters
+        ----------
+        text : str
+            Text to measure
+
+        Returns
+        -------
+        float
+            Text width in Cairo units
+        """
+        width = self._widths.get(text)
+        if width is None:
+            with self._lock:
+                self._layout.set_text(text, -1)
+                width = float(self._layout.get_size()[0]) / Pango.SCALE
+                if len(self._widths) >= MAX_TEXTS_PER_FONT:
+                    self._widths.clear()
+                self._widths[text] = width
+        return width
+
+    def max_width(self, texts):
+        """ Width of the widest of several lines of text
+
+        Parameters
+        ----------
+        texts : iterable of str
+            Texts to measure
+
+        Returns
+        -------
+        float
+            Largest text width in Cairo units, 0 if there are no texts
+        """
+        return max(map(self.width, texts), default=0.0)
+
+
+def get_text_metrics(surface, font_spec):
+    """ Get the metrics of a font for drawing on a surface
+
+    Parameters
+    ----------
+    surface : cairo.Surface
+        Surface the text will be drawn on, only its font options matter
+    font_spec : str
+        Pango font specification
+
+    Returns
+    -------
+    TextMetrics
+        Metrics of the font, shared within this process
+    """
+    font_options = surface.get_font_options()
+    key = (font_spec, font_options.hash())
+
+    with _cache_lock:
+        metrics = _cache.get(key)
+        if metrics is None:
+            metrics = TextMetrics(font_spec, font_options)
+            _cache[key] = metrics
+            while len(_cache) > MAX_FONTS:
+                _cache.popitem(last=False)
+        _cache.move_to_end(key)
+
+    return metrics
+
+def clear():
+    """ Forget all measurements """
+    with _cache_lock:
+        _cache.clear()
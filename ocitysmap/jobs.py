@@ -0,0 +1,253 @@
+# -*- coding: utf-8 -*-
+
+# ocitysmap, city map and street index generator from OpenStreetMap data
+# Copyright (C) 2023  Hartmut Holzgraefe
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Rendering job descriptions
+
+Conversion of job descriptions, as read from JSON by the batch mode of
+render.py and by the render worker daemon, or built from the command
+line options of render.py, into rendering configurations.
+A job description is a dictionary with the following keys, only
+`prefix` and one of `osmid`, `bbox` or `import_files` are required:
+
+    osmid        : OSM id of the area to render
+    bbox         : [lat1, lon1, lat2, lon2]
+    title        : map title
+    language     : locale to use, defaults to en_US.UTF-8
+    stylesheet   : stylesheet name, defaults to the first configured one
+    overlays     : list of overlay names
+    layout       : renderer name, defaults to the first available one
+    indexer      : indexer name, defaults to 'Street'
+    paper        : 'default', a paper size name, 'WxH' or [W, H] in mm
+    orientation  : 'portrait' or 'landscape' for named paper sizes
+    formats      : list of output formats, defaults to ['pdf']
+    prefix       : output file name prefix
+    import_files : list of GPX, Umap or POI file paths
+    logo, extra_logo, extra_text, qrcode_text : see RenderingConfiguration
+"""
+
+import os
+import re
+
+from . import coords
+from .layoutlib import renderers
+
+KNOWN_PAPER_ORIENTATIONS = ['portrait', 'landscape']
+
+
+class JobError(ValueError):
+    """Raised for invalid or unsatisfiable job descriptions."""
+    pass
+
+
+def _import_file_bbox(file_type, import_file):
+    """ Bounding box and title of an import file """
+    from .stylelib.Gpx  import GpxProcessor
+    from .stylelib.Umap import UmapProcessor
+    from .stylelib.Poi  import PoiProcessor
+
+    processors = { 'gpx': GpxProcessor, 'umap': UmapProcessor, 'poi': PoiProcessor }
+    if file_type not in processors:
+        return None, None
+    processor = processors[file_type](import_file)
+    return processor.getBoundingBox(), processor.getTitle()
+
+def create_job_configuration(mapper, job):
+    """ Create a rendering configuration from a job description
+
+    Parameters
+    ----------
+    mapper : ocitysmap.OCitySMap
+        The OCitySMap instance to render the job with
+    job : dict
+        Job description, see module documentation
+
+    Returns
+    -------
+    list
+        * RenderingConfiguration for the job
+        * renderer name
+        * list of output formats
+        * output file prefix
+
+    Throws
+    ------
+    JobError
+        When the job description is invalid or can't be rendered
+    """
+    import ocitysmap
+
+    if 'prefix' not in job:
+        raise JobError("No output file prefix given")
+
+    # Stylesheet and overlays
+    try:
+        if job.get('stylesheet'):
+            stylesheet = mapper.get_stylesheet_by_name(job['stylesheet'])
+        else:
+            stylesheet = mapper.get_all_style_configurations()[0]
+        overlays = [mapper.get_overlay_by_name(name)
+                    for name in job.get('overlays', [])]
+    except LookupError as e:
+        raise JobError("%s. Available stylesheets: %s. Available overlays: %s."
+                       % (e, ', '.join(mapper.get_all_style_names()),
+                          ', '.join(mapper.get_all_overlay_names())))
+
+    # Rendering layout
+    try:
+        if job.get('layout'):
+            cls_renderer = renderers.get_renderer_class_by_name(job['layout'])
+        else:
+            cls_renderer = renderers.get_renderers()[0]
+    except LookupError as e:
+        raise JobError("%s. Available layouts: %s."
+                       % (e, ', '.join(map(lambda lo: "%s (%s)"
+                                           % (lo.name, lo.description),
+                                           renderers.get_renderers()))))
+
+    indexer = job.get('indexer') or 'Street'
+    if indexer not in mapper.get_all_indexer_names():
+        raise JobError("Unknown indexer '%s'. Available indexers: %s"
+                       % (indexer, ', '.join(mapper.get_all_indexer_names())))
+
+    # Output formats
+    output_formats = job.get('formats') or ['pdf']
+    for output_format in output_formats:
+        if output_format not in cls_renderer.get_compatible_output_formats():
+            raise JobError("Output format %s not supported by layout %s"
+                           % (output_format, cls_renderer.name))
+
+    # Import files, which may also define bounding box and title
+    bbox = None
+    title = None
+    import_files = []
+    for import_file in job.get('import_files', []):
+        import_file = os.path.realpath(import_file)
+        try:
+            file_type = ocitysmap.guess_filetype(import_file)
+        except RuntimeError as e:
+            raise JobError(str(e))
+        import_files.append((file_type, import_file))
+
+        file_bbox, file_title = _import_file_bbox(file_type, import_file)
+        if file_bbox:
+            file_bbox = file_bbox.create_padded(0.1)
+            if bbox:
+                bbox.merge(file_bbox)
+            else:
+                bbox = file_bbox
+            if title:
+                title = title + "; " + file_title
+            else:
+                title = file_title
+
+    # Explicit bounding box overrides the one derived from import files
+    if job.get('bbox'):
+        try:
+            (lat1, lon1, lat2, lon2) = job['bbox']
+            bbox = coords.BoundingBox(lat1, lon1, lat2, lon2)
+        except (TypeError, ValueError):
+            raise JobError("Invalid bounding box: %s" % job['bbox'])
+        if bbox.get_top() == bbox.get_bottom():
+            raise JobError('Same latitude in bounding box corners')
+        if bbox.get_left() == bbox.get_right():
+            raise JobError('Same longitude in bounding box corners')
+
+    osmid = job.get('osmid')
+    if osmid:
+        try:
+            osmid_bbox = coords.BoundingBox.parse_wkt(
+                mapper.get_geographic_info(int(osmid))[0])
+        except LookupError:
+            raise JobError('No such OSM id: %s' % osmid)
+        if not job.get('bbox'):
+            bbox = osmid_bbox
+
+    if bbox is None:
+        raise JobError('No bounding box found')
+
+    if job.get('title'):
+        title = job['title']
+
+    # Determine actual paper size
+    paper = job.get('paper') or 'default'
+    orientation = job.get('orientation') or 'portrait'
+    if orientation not in KNOWN_PAPER_ORIENTATIONS:
+        raise JobError("Invalid paper orientation '%s'" % orientation)
+
+    paper_width = paper_height = None
+    if isinstance(paper, (list, tuple)):
+        (paper_width, paper_height) = map(int, paper)
+    else:
+        matches = re.search(r'^(\d+)[x\*](\d+)$', paper)
+        if matches:
+            paper_width  = int(matches.group(1))
+            paper_height = int(matches.group(2))
+
+    if paper_width and paper_height:
+        min_width, min_height = cls_renderer.get_minimal_paper_size(bbox)
+        if paper_width < min_width or paper_height < min_height:
+            raise JobError("Given paper size %dmm x %dmm is too small, minimal required size is: %dmm x %dmm" %
+                           (paper_width, paper_height, min_width, min_height))
+    else:
+        compat_papers = cls_renderer.get_compatible_paper_sizes(bbox, mapper)
+        if not compat_papers:
+            raise JobError("No paper size compatible with this rendering.")
+
+        paper_descr = None
+        for p in compat_papers:
+            if paper == 'default':
+                if p['landscape_ok'] and p['portrait_ok']:
+                    paper_descr = p
+                    break
+            elif (p['name'].lower().replace(" ", "")
+                  == paper.lower().replace(" ", "")):
+                paper_descr = p
+                break
+        if not paper_descr:
+            raise JobError("Requested paper format '%s' not compatible with rendering. Compatible paper formats are:\n\t%s."
+                           % (paper, ',\n\t'.join(map(lambda p: "%s (%.1fx%.1fcm²)"
+                                                  % (p['name'], p['width']/10., p['height']/10.),
+                                                  compat_papers))))
+
+        if (orientation == 'portrait' and not paper_descr['portrait_ok']) or \
+           (orientation == 'landscape' and not paper_descr['landscape_ok']):
+            raise JobError("Requested paper orientation %s not compatible with this rendering at this paper size." % orientation)
+
+        if orientation == 'portrait':
+            paper_width, paper_height = paper_descr['width'], paper_descr['height']
+        else:
+            paper_width, paper_height = paper_descr['height'], paper_descr['width']
+
+    # Prepare the rendering config
+    rc                 = ocitysmap.RenderingConfiguration()
+    rc.title           = title
+    rc.osmid           = int(osmid) if osmid else None
+    rc.bounding_box    = bbox
+    rc.indexer         = indexer
+    rc.language        = job.get('language') or 'en_US.UTF-8'
+    rc.stylesheet      = stylesheet
+    rc.overlays        = overlays
+    rc.import_files    = import_files
+    rc.paper_width_mm  = paper_width
+    rc.paper_height_mm = paper_height
+
+    for key in ['logo', 'extra_logo', 'extra_text', 'qrcode_text']:
+        if job.get(key):
+            setattr(rc, key, job[key])
+
+    return rc, cls_renderer.name, output_formats, job['prefix']
@@ -47,7 +47,7 @@ from babel.dates import format_date
 from . import commons
 from ocitysmap.maplib.map_canvas import MapCanvas
 from ocitysmap.maplib.grid import Grid
-from ocitysmap import draw_utils, maplib
+from ocitysmap import draw_utils, maplib, output_writers
 
 from pluginbase import PluginBase
 
@@ -80,6 +80,11 @@ class Renderer:
     # see entities.xml.inc file from osm style sheet
     DEFAULT_SCALE           = 7000000
 
+    # Whether the renderer output is a single page that does not depend on
+    # the output format, so that it can be drawn into a recording surface
+    # once and then be replayed onto all requested output formats
+    supports_recording = False
+
     def __init__(self, db, rc, tmpdir, dpi):
         """
         Create the renderer.
@@ -95,6 +100,7 @@ class Renderer:
         self.rc           = rc
         self.tmpdir       = tmpdir
         self.grid         = None # The implementation is in charge of it
+        self.index_queries = None # Index queries shared by all pages, if any
 
         self.paper_width_pt = \
                 commons.convert_mm_to_pt(self.rc.paper_width_mm)
@@ -335,7 +341,7 @@ class Renderer:
 
     @staticmethod
     def get_compatible_output_formats():
-        return [ "png", "svgz", "pdf", "csv" ]
+        return [ "png", "svgz", "pdf", "csv" ] + output_writers.EXTRA_RASTER_FORMATS
 
     def _has_multipage_format(self):
         if self.rc.output_format == 'pdf':
@@ -22,6 +22,9 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import cairo
+import math
+
 # PT/metrics conversion routines
 PT_PER_INCH = 72.0
 MM_PER_INCH = 25.4
@@ -37,3 +40,48 @@ def convert_mm_to_dots(mm, dpi = PT_PER_INCH):
 
 def convert_pt_to_mm(pt):
     return float(pt) * MM_PER_INCH / PT_PER_INCH
+
+def device_independent_font_options():
+    """ Font options giving the same text metrics on all surface types
+
+    Layouts are computed on vector surfaces, where glyph outlines and
+    metrics are never hinted. Drawing with hinting disabled gives raster
+    surfaces the same metrics, at any resolution.
+    """
+    options = cairo.FontOptions()
+    options.set_hint_style(cairo.HINT_STYLE_NONE)
+    options.set_hint_metrics(cairo.HINT_METRICS_OFF)
+    return options
+
+def create_context(surface):
+    """ Create a Cairo context drawing text the same way on all surfaces
+
+    See device_independent_font_options().
+    """
+    ctx = cairo.Context(surface)
+    ctx.set_font_options(device_independent_font_options())
+    return ctx
+
+def split_map_tiles(width, height, tile_size):
+    """ Split a map into tiles of roughly equal size
+
+    Parameters
+    ----------
+    width, height : int
+        Map size in pixels
+    tile_size : int
+        Maximum tile width and height in pixels
+
+    Returns
+    -------
+    list of tuple
+        (x, y, width, height) pixel rectangles covering the map
+    """
+    cols = max(1, math.ceil(width / tile_size))
+    rows = max(1, math.ceil(height / tile_size))
+
+    xs = [round(i * width / cols) for i in range(cols + 1)]
+    ys = [round(i * height / rows) for i in range(rows + 1)]
+
+    return [(xs[i], ys[j], xs[i + 1] - xs[i], ys[j + 1] - ys[j])
+            for j in range(rows) for i in range(cols)]
@@ -20,6 +20,7 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import cairo
+import concurrent.futures
 import datetime
 from itertools import groupby
 import locale
@@ -29,12 +30,19 @@ assert mapnik.mapnik_version() >= 300000, \
     "Mapnik module version %s is too old, see ocitysmap's INSTALL " \
     "for more details." % mapnik.mapnik_version_string()
 import math
+import multiprocessing
 import os
 import gi
 gi.require_version('Rsvg', '2.0')
 gi.require_version('Pango', '1.0')
 gi.require_version('PangoCairo', '1.0')
 from gi.repository import Rsvg, Pango, PangoCairo
+try:
+    # optional, needed to assemble pages rendered by page workers
+    gi.require_version('Poppler', '0.18')
+    from gi.repository import GLib, Poppler
+except (ImportError, ValueError):
+    Poppler = None
 import shapely.wkt
 import sys
 from string import Template
@@ -56,10 +64,13 @@ from ocitysmap.indexlib.StreetIndex import StreetIndex
 from ocitysmap.indexlib.HealthIndex import HealthIndex
 from ocitysmap.indexlib.NotesIndex import NotesIndex
 from ocitysmap.indexlib.TreeIndex import TreeIndex
+from ocitysmap.indexlib.atlas import AtlasIndexQueries
+from ocitysmap.indexlib.renderer import index_fingerprint
 from ocitysmap import draw_utils, maplib
 from ocitysmap.maplib.map_canvas import MapCanvas
 from ocitysmap.maplib.grid import Grid
 from ocitysmap.maplib.overview_grid import OverviewGrid
+from ocitysmap.metrics import RenderMetrics
 from ocitysmap.stylelib import GpxStylesheet, UmapStylesheet
 
 LOG = logging.getLogger('ocitysmap')
@@ -81,6 +92,176 @@ def font_extents(ctx, font_face, font_size):
     ctx.set_font_size (font_size)
     return ctx.font_extents ()
 
+def _create_page_shade(number, bb, bb_inner, tmpdir):
+    """ Create the gray shape around the map of one atlas map page
+
+    Parameters
+    ----------
+    number : int
+        Zero based map page number, used for temporary file names
+    bb : coords.BoundingBox
+        Area covered by the page, including the grayed margin
+    bb_inner : coords.BoundingBox
+        Area covered by the page, without the grayed margin
+    tmpdir : str
+        Directory to create shape files in
+
+    Returns
+    -------
+    maplib.shapes.PolyShapeFile
+        The grayed margin of the page
+    """
+    exterior = shapely.wkt.loads(bb.as_wkt())
+    interior = shapely.wkt.loads(bb_inner.as_wkt())
+    shade_wkt = exterior.difference(interior).wkt
+    shade = maplib.shapes.PolyShapeFile(
+        bb, os.path.join(tmpdir, 'shade%d.shp' % number),
+        'shade%d' % number)
+    shade.add_shade_from_wkt(shade_wkt)
+    return shade
+
+def _prepare_map_page(number, stylesheet, overlays, bb, bb_inner,
+                      polygon_wkt, shade_contour, width_pt, height_pt,
+                      dpi, tmpdir, rtl, metrics):
+    """ Prepare the map and overlay canvases of one atlas map page
+
+    Parameters
+    ----------
+    number : int
+        Zero based map page number, used for temporary file names
+    stylesheet : Stylesheet
+        The map stylesheet
+    overlays : list of Stylesheet
+        Overlay stylesheets, overlay plugins are skipped
+    bb : coords.BoundingBox
+        Area covered by the page, including the grayed margin
+    bb_inner : coords.BoundingBox
+        Area covered by the page, without the grayed margin
+    polygon_wkt : str
+        Area of interest, everything outside gets shaded
+    shade_contour : bool
+        Whether to shade the parts of the page outside the area of interest
+    width_pt, height_pt : float
+        Map size in points
+    dpi : int
+        Map resolution
+    tmpdir : str
+        Directory to create shape files in
+    rtl : bool
+        Whether grid labels are right to left
+    metrics : RenderMetrics
+        Metrics to record the canvas preparation time in
+
+    Returns
+    -------
+    tuple
+        The map canvas, its Grid, and a list of overlay canvases
+    """
+    # Create the gray shape around the map
+    shade = _create_page_shade(number, bb, bb_inner, tmpdir)
+    interior = shapely.wkt.loads(bb_inner.as_wkt())
+
+    # Create the contour shade
+
+    # Area to keep visible
+    interior_contour = shapely.wkt.loads(polygon_wkt)
+    # Determine the shade WKT
+    shade_contour_wkt = interior.difference(interior_contour).wkt
+    # Prepare the shade SHP
+    shade_contour_shape = maplib.shapes.PolyShapeFile(bb,
+        os.path.join(tmpdir, 'shade_contour%d.shp' % number),
+        'shade_contour%d' % number)
+    shade_contour_shape.add_shade_from_wkt(shade_contour_wkt)
+
+    # Create one canvas for the current page
+    with metrics.phase('map_canvas'):
+        map_canvas = MapCanvas(stylesheet, bb, width_pt, height_pt, dpi,
+                               extend_bbox_to_ratio=False)
+
+    # Create canvas for overlay on current page
+    overlay_canvases = []
+    for overlay in overlays:
+        if not overlay.path.strip().startswith('internal:'):
+            with metrics.phase('map_canvas'):
+                overlay_canvases.append(MapCanvas(overlay, bb, width_pt,
+                                                  height_pt, dpi,
+                                                  extend_bbox_to_ratio=False))
+
+    # Create the grid
+    map_grid = Grid(bb_inner, map_canvas.get_actual_scale(), rtl)
+    grid_shape = map_grid.generate_shape_file(
+        os.path.join(tmpdir, 'grid%d.shp' % number))
+
+    map_canvas.add_shape_file(shade)
+    if shade_contour:
+        map_canvas.add_shape_file(shade_contour_shape,
+                                  stylesheet.shade_color_2,
+                                  stylesheet.shade_alpha_2)
+    map_canvas.add_shape_file(grid_shape,
+                              stylesheet.grid_line_color,
+                              stylesheet.grid_line_alpha,
+                              stylesheet.grid_line_width)
+
+    with metrics.phase('map_canvas'):
+        map_canvas.render()
+        for overlay_canvas in overlay_canvases:
+            overlay_canvas.render()
+
+    return map_canvas, map_grid, overlay_canvases
+
+def _render_map_page(task):
+    """ Prepare and render one atlas map page in a page worker process
+
+    Parameters
+    ----------
+    task : tuple
+        The `_prepare_map_page()` arguments, without the metrics
+
+    Returns
+    -------
+    tuple
+        Name of the single page PDF file containing the page map and
+        its overlays, and the list of phase timings as in
+        `RenderMetrics.as_dict()`
+    """
+    number, tmpdir = task[0], task[10]
+    page_metrics = RenderMetrics()
+
+    map_canvas, map_grid, overlay_canvases = \
+        _prepare_map_page(*task, metrics=page_metrics)
+
+    filename = os.path.join(tmpdir, 'map_page%d.pdf' % number)
+    rendered_map = map_canvas.get_rendered_map()
+    surface = cairo.PDFSurface(filename, rendered_map.width, rendered_map.height)
+    ctx = cairo.Context(surface)
+    for canvas in [map_canvas] + overlay_canvases:
+        with page_metrics.phase('mapnik_render', canvas.get_style_name()):
+            mapnik.render(canvas.get_rendered_map(), ctx)
+    surface.finish()
+
+    return filename, page_metrics.as_dict()['phases']
+
+def _create_page_executor(workers):
+    """ Create a pool of page worker processes
+
+    The workers are not forked from the current process, as it may hold
+    open database connections of already loaded Mapnik stylesheets, but
+    from a fork server process that only has the modules preloaded.
+
+    Parameters
+    ----------
+    workers : int
+        Number of worker processes
+
+    Returns
+    -------
+    concurrent.futures.ProcessPoolExecutor
+    """
+    mp_context = multiprocessing.get_context('forkserver')
+    mp_context.set_forkserver_preload([__name__])
+    return concurrent.futures.ProcessPoolExecutor(max_workers=workers,
+                                                  mp_context=mp_context)
+
 class MultiPageRenderer(Renderer):
     """
     This Renderer creates a multi-pages map, with all the classic overlayed
@@ -282,6 +463,7 @@ class MultiPageRenderer(Renderer):
         # paper.
         area_polygon = shapely.wkt.loads(self.rc.polygon_wkt)
         bboxes = []
+        page_envelopes = []
         self.page_disposition = {}
         map_number = 0
         for j in reversed(range(0, self.nb_pages_height)):
@@ -314,6 +496,7 @@ class MultiPageRenderer(Renderer):
                     map_number += 1
                     bboxes.append((self._inverse_envelope(envelope),
                                    inner_bb))
+                    page_envelopes.append(envelope)
                 else:
                     self.page_disposition[col].append(None)
 
@@ -332,11 +515,12 @@ class MultiPageRenderer(Renderer):
                     os.path.join(self.tmpdir, 'grid_overview.shp'))
 
         # Create a canvas for the overview page
-        self.overview_canvas = MapCanvas(self.rc.stylesheet,
-                                         overview_bb, self._usable_area_width_pt,
-                                         self._usable_area_height_pt, dpi,
-                                         extend_bbox_to_ratio=True,
-                                         )
+        with self.rc.metrics.phase('map_canvas'):
+            self.overview_canvas = MapCanvas(self.rc.stylesheet,
+                                             overview_bb, self._usable_area_width_pt,
+                                             self._usable_area_height_pt, dpi,
+                                             extend_bbox_to_ratio=True,
+                                             )
 
         # Create the gray shape around the overview map
         exterior = shapely.wkt.loads(self.overview_canvas.get_actual_bounding_box()\
@@ -355,7 +539,8 @@ class MultiPageRenderer(Renderer):
                                   self.rc.stylesheet.grid_line_width)
 
         self.rc.status_update(_("Preparing overview page: base map"))
-        self.overview_canvas.render()
+        with self.rc.metrics.phase('map_canvas'):
+            self.overview_canvas.render()
 
         self.overview_overlay_canvases = []
         self.overview_overlay_effects  = {}
@@ -372,120 +557,284 @@ class MultiPageRenderer(Renderer):
                     self.overview_overlay_effects[plugin_name] = self.get_plugin(plugin_name)
             else:
                 self.rc.status_update(_("Preparing overview page: %s") % overlay.name)
-                ov_canvas = MapCanvas(overlay,
-                                      overview_bb,
-                                      self._usable_area_width_pt,
-                                      self._usable_area_height_pt,
-                                      dpi,
-                                      extend_bbox_to_ratio=True)
-                ov_canvas.render()
+                with self.rc.metrics.phase('map_canvas'):
+                    ov_canvas = MapCanvas(overlay,
+                                          overview_bb,
+                                          self._usable_area_width_pt,
+                                          self._usable_area_height_pt,
+                                          dpi,
+                                          extend_bbox_to_ratio=True)
+                    ov_canvas.render()
                 self.overview_overlay_canvases.append(ov_canvas)
 
-        # Create the map canvas for each page
-        indexes = []
-        for i, (bb, bb_inner) in enumerate(bboxes):
-            self.rc.status_update(_("Preparing map page %(page)d of %(total)d: base map")
-                                  % {'page':  i + 1,
-                                     'total': len(bboxes),
-                                     })
-
-            # Create the gray shape around the map
-            exterior = shapely.wkt.loads(bb.as_wkt())
-            interior = shapely.wkt.loads(bb_inner.as_wkt())
-            shade_wkt = exterior.difference(interior).wkt
-            shade = maplib.shapes.PolyShapeFile(
-                bb, os.path.join(self.tmpdir, 'shade%d.shp' % i),
-                'shade%d' % i)
-            shade.add_shade_from_wkt(shade_wkt)
-
-            # Create the contour shade
-
-            # Area to keep visible
+        # Map pages are either prepared here one by one, or prepared
+        # and rendered into single page PDF files by a pool of page
+        # worker processes, or cut out of a single rendering of the
+        # whole atlas area
+        atlas_render_once = bool(self.rc.atlas_render_once) and len(bboxes) > 1
+        self._atlas_chunks = []
+        self._page_slices = {}
+        if atlas_render_once:
+            self._render_atlas(total_width_pt_after_extension,
+                               total_height_pt_after_extension, dpi)
+
+        page_workers = min(self.rc.page_workers or 1, len(bboxes))
+        if atlas_render_once:
+            page_workers = 1
+        elif page_workers > 1 and Poppler is None:
+            LOG.warning("Poppler GObject introspection bindings not available, "
+                        "rendering map pages without page workers")
+            page_workers = 1
+        page_futures = []
+        page_executor = None
+        if page_workers > 1:
+            LOG.debug("Rendering %d map pages with %d page workers"
+                      % (len(bboxes), page_workers))
+            page_executor = _create_page_executor(page_workers)
+            page_overlays = [overlay for overlay in self._overlays
+                             if not overlay.path.strip().startswith('internal:')]
+            for i, (bb, bb_inner) in enumerate(bboxes):
+                page_futures.append(page_executor.submit(_render_map_page, (
+                    i, self.rc.stylesheet, page_overlays, bb, bb_inner,
+                    self.rc.polygon_wkt, self.rc.osmid != None,
+                    self._usable_area_width_pt, self._usable_area_height_pt,
+                    dpi, self.tmpdir, self.rc.i18n.isrtl())))
+
+        # Run the index queries only once for the whole area,
+        # the page indexes then pick their part from the results
+        self.index_queries = AtlasIndexQueries(self.rc.polygon_wkt)
+
+        try:
+            # Create the map canvas for each page
+            indexes = []
             interior_contour = shapely.wkt.loads(self.rc.polygon_wkt)
-            # Determine the shade WKT
-            shade_contour_wkt = interior.difference(interior_contour).wkt
-            # Prepare the shade SHP
-            shade_contour = maplib.shapes.PolyShapeFile(bb,
-                os.path.join(self.tmpdir, 'shade_contour%d.shp' % i),
-                'shade_contour%d' % i)
-            shade_contour.add_shade_from_wkt(shade_contour_wkt)
-
-
-            # Create one canvas for the current page
-            map_canvas = MapCanvas(self.rc.stylesheet,
-                                   bb, self._usable_area_width_pt,
-                                   self._usable_area_height_pt, dpi,
-                                   extend_bbox_to_ratio=False)
-
-            # Create canvas for overlay on current page
-            overlay_canvases = []
-            overlay_effects  = {}
-            for overlay in self._overlays:
-                path = overlay.path.strip()
-                if path.startswith('internal:'):
-                    plugin_name = path.lstrip('internal:')
-                    overlay_effects[plugin_name] = self.get_plugin(plugin_name)
-                else:
-                    overlay_canvases.append(MapCanvas(overlay,
+            for i, (bb, bb_inner) in enumerate(bboxes):
+                self.rc.status_update(_("Preparing map page %(page)d of %(total)d: base map")
+                                      % {'page':  i + 1,
+                                         'total': len(bboxes),
+                                         })
+
+                overlay_effects  = {}
+                for overlay in self._overlays:
+                    path = overlay.path.strip()
+                    if path.startswith('internal:'):
+                        plugin_name = path.lstrip('internal:')
+                        overlay_effects[plugin_name] = self.get_plugin(plugin_name)
+
+                if page_executor or atlas_render_once:
+                    # The page workers or the atlas rendering provide the
+                    # actual map, this canvas only provides the page scale
+                    # and extent to the grid and to overlay plugins
+                    with self.rc.metrics.phase('map_canvas'):
+                        map_canvas = MapCanvas(self.rc.stylesheet,
                                                bb, self._usable_area_width_pt,
                                                self._usable_area_height_pt, dpi,
-                                               extend_bbox_to_ratio=False))
-
-            # Create the grid
-            map_grid = Grid(bb_inner, map_canvas.get_actual_scale(), self.rc.i18n.isrtl())
-            grid_shape = map_grid.generate_shape_file(
-                os.path.join(self.tmpdir, 'grid%d.shp' % i))
-
-            map_canvas.add_shape_file(shade)
-            if self.rc.osmid != None:
-                map_canvas.add_shape_file(shade_contour,
-                                          self.rc.stylesheet.shade_color_2,
-                                          self.rc.stylesheet.shade_alpha_2)
-            map_canvas.add_shape_file(grid_shape,
-                                      self.rc.stylesheet.grid_line_color,
-                                      self.rc.stylesheet.grid_line_alpha,
-                                      self.rc.stylesheet.grid_line_width)
+                                               extend_bbox_to_ratio=False)
+                    map_grid = Grid(bb_inner, map_canvas.get_actual_scale(),
+                                    self.rc.i18n.isrtl())
+                    overlay_canvases = []
+
+                    if atlas_render_once:
+                        # the grayed margin and the grid differ from page
+                        # to page, so they are drawn on top of each slice
+                        grid_shape = map_grid.generate_shape_file(
+                            os.path.join(self.tmpdir, 'grid%d.shp' % i))
+                        self._page_slices[i] = (page_envelopes[i], [
+                            (_create_page_shade(i, bb, bb_inner, self.tmpdir),
+                             'grey', 0.5, 1.0),
+                            (grid_shape,
+                             self.rc.stylesheet.grid_line_color,
+                             self.rc.stylesheet.grid_line_alpha,
+                             self.rc.stylesheet.grid_line_width),
+                        ])
+                else:
+                    map_canvas, map_grid, overlay_canvases = \
+                        _prepare_map_page(i, self.rc.stylesheet, self._overlays,
+                                          bb, bb_inner, self.rc.polygon_wkt,
+                                          self.rc.osmid != None,
+                                          self._usable_area_width_pt,
+                                          self._usable_area_height_pt,
+                                          dpi, self.tmpdir, self.rc.i18n.isrtl(),
+                                          self.rc.metrics)
 
-            map_canvas.render()
+                self.pages.append((map_canvas, map_grid, overlay_canvases, overlay_effects))
 
-            for overlay_canvas in overlay_canvases:
-                self.rc.status_update(_("Preparing map page %(page)d of %(total)d: %(style)s")
+                # Create the index for the current page
+                interior = shapely.wkt.loads(bb_inner.as_wkt())
+                inside_contour_wkt = interior_contour.intersection(interior).wkt
+                # TODO: other index types
+                self.rc.status_update(_("Preparing map page %(page)d of %(total)d: collecting index data")
                                       % { 'page':  i + 1,
                                           'total': len(bboxes),
-                                          'style': overlay_canvas._style_name,
                                          })
-                overlay_canvas.render()
-
-            self.pages.append((map_canvas, map_grid, overlay_canvases, overlay_effects))
-
-            # Create the index for the current page
-            inside_contour_wkt = interior_contour.intersection(interior).wkt
-            # TODO: other index types
-            self.rc.status_update(_("Preparing map page %(page)d of %(total)d: collecting index data")
-                                  % { 'page':  i + 1,
-                                      'total': len(bboxes),
-                                     })
-            try:
-                indexer_class = globals()[self.rc.indexer+"Index"]
-                # TODO: check that it actually implements a working indexer class
-            except:
-                LOG.warning("Indexer class '%s' not found" % self.rc.indexer)
-            else:
-                index = indexer_class(self.db,
-                                      self,
-                                      bb_inner,
-                                      inside_contour_wkt,
-                                      self.rc.i18n, page_number=(i + self._first_map_page_number))
-
-                index.apply_grid(map_grid)
-                indexes.append(index)
+                try:
+                    indexer_class = globals()[self.rc.indexer+"Index"]
+                    # TODO: check that it actually implements a working indexer class
+                except:
+                    LOG.warning("Indexer class '%s' not found" % self.rc.indexer)
+                else:
+                    with self.rc.metrics.phase('index_query', self.rc.indexer):
+                        index = indexer_class(self.db,
+                                              self,
+                                              bb_inner,
+                                              inside_contour_wkt,
+                                              self.rc.i18n, page_number=(i + self._first_map_page_number))
+
+                    index.apply_grid(map_grid)
+                    indexes.append(index)
+
+            self.index_queries = None
+
+            # Collect the map pages rendered by the page workers
+            self._page_images = {}
+            for i, future in enumerate(page_futures):
+                self.rc.status_update(_("Preparing map page %(page)d of %(total)d: waiting for page worker")
+                                      % { 'page':  i + 1,
+                                          'total': len(bboxes),
+                                         })
+                filename, phases = future.result()
+                self._page_images[i] = filename
+                for phase in phases:
+                    self.rc.metrics.add(phase['phase'], phase['detail'],
+                                        phase['wall'], phase['cpu'])
+        finally:
+            if page_executor:
+                for future in page_futures:
+                    future.cancel()
+                page_executor.shutdown()
 
         # Merge all indexes
-        self.index_categories = self._merge_page_indexes(indexes)
+        with self.rc.metrics.phase('index_layout'):
+            self.index_categories = self._merge_page_indexes(indexes)
 
         # Prepare the small map for the front page
         self._prepare_front_page_map(dpi)
 
+    def _render_atlas(self, width_pt, height_pt, dpi):
+        """ Render the map of the whole atlas area once
+
+        The map and its overlays are rendered in chunks, each of them with
+        a margin of its neighbours, into vector recordings that the map
+        pages are then cut out of, see `_render_page_slice()`. This runs
+        a few large stylesheet queries instead of a round of queries per
+        page, and places labels the same way on overlapping pages.
+
+        Parameters
+        ----------
+        width_pt, height_pt : float
+            Size of the whole atlas map area in points
+        dpi : int
+            Map resolution
+
+        Returns
+        -------
+        void
+        """
+        self.rc.status_update(_("Preparing atlas map"))
+
+        with self.rc.metrics.phase('map_canvas'):
+            atlas_canvas = MapCanvas(self.rc.stylesheet, self._geo_bbox,
+                                     width_pt, height_pt, dpi,
+                                     extend_bbox_to_ratio=False)
+
+        if self.rc.osmid != None:
+            # Shade everything outside of the area of interest
+            exterior = shapely.wkt.loads(
+                atlas_canvas.get_actual_bounding_box().as_wkt())
+            interior = shapely.wkt.loads(self.rc.polygon_wkt)
+            shade_contour = maplib.shapes.PolyShapeFile(self._geo_bbox,
+                os.path.join(self.tmpdir, 'shade_contour_atlas.shp'),
+                'shade_contour_atlas')
+            shade_contour.add_shade_from_wkt(exterior.difference(interior).wkt)
+            atlas_canvas.add_shape_file(shade_contour,
+                                        self.rc.stylesheet.shade_color_2,
+                                        self.rc.stylesheet.shade_alpha_2)
+
+        canvases = [atlas_canvas]
+        with self.rc.metrics.phase('map_canvas'):
+            for overlay in self._overlays:
+                if not overlay.path.strip().startswith('internal:'):
+                    canvases.append(MapCanvas(overlay, self._geo_bbox,
+                                              width_pt, height_pt, dpi,
+                                              extend_bbox_to_ratio=False))
+            for canvas in canvases:
+                canvas.render()
+
+        tasks = [canvas.get_tile_task() for canvas in canvases]
+        self._atlas_size = (tasks[0][1], tasks[0][2])
+        self._atlas_envelope = tasks[0][3]
+        self._atlas_margin = self.rc.map_tile_margin
+
+        margin = self._atlas_margin
+        chunks = commons.split_map_tiles(self._atlas_size[0],
+                                         self._atlas_size[1],
+                                         self.rc.map_tile_size)
+        LOG.debug("Rendering %dx%d atlas map in %d chunks"
+                  % (self._atlas_size[0], self._atlas_size[1], len(chunks)))
+
+        for number, (x, y, w, h) in enumerate(chunks):
+            self.rc.status_update(_("Rendering atlas map part %(part)d of %(total)d")
+                                  % { 'part':  number + 1,
+                                      'total': len(chunks),
+                                     })
+            recording = cairo.RecordingSurface(
+                cairo.Content.COLOR_ALPHA,
+                cairo.Rectangle(0, 0, w + 2 * margin, h + 2 * margin))
+            ctx = cairo.Context(recording)
+            ctx.rectangle(margin, margin, w, h)
+            ctx.clip()
+            for canvas, task in zip(canvases, tasks):
+                with self.rc.metrics.phase('mapnik_render', canvas.get_style_name()):
+                    MapCanvas.render_tile(task, ctx, x - margin, y - margin,
+                                          w + 2 * margin, h + 2 * margin,
+                                          1.0, margin)
+            recording.flush()
+            self._atlas_chunks.append((x, y, w, h, recording))
+
+    def _render_page_slice(self, ctx, envelope, width, height, shapes):
+        """ Draw the map of one page, cut out of the atlas map
+
+        Parameters
+        ----------
+        ctx : cairo.Context
+            Context to draw into, with the page map origin at (0, 0)
+        envelope : mapnik.Box2d
+            Projected area shown on the page
+        width, height : int
+            Page map size in pixels
+        shapes : list of tuple
+            Page specific shapes to draw on top of the map, as taken by
+            `MapCanvas.render_shapes()`
+
+        Returns
+        -------
+        void
+        """
+        minx, miny, maxx, maxy = self._atlas_envelope
+        res_x = (maxx - minx) / self._atlas_size[0]
+        res_y = (maxy - miny) / self._atlas_size[1]
+
+        # page position and size in atlas map pixels
+        x0 = (envelope.minx - minx) / res_x
+        y0 = (maxy - envelope.maxy) / res_y
+        w0 = envelope.width() / res_x
+        h0 = envelope.height() / res_y
+
+        for x, y, w, h, recording in self._atlas_chunks:
+            if x >= x0 + w0 or x + w <= x0 or y >= y0 + h0 or y + h <= y0:
+                continue
+            ctx.save()
+            ctx.scale(width / w0, height / h0)
+            ctx.translate(-x0, -y0)
+            ctx.rectangle(x, y, w, h)
+            ctx.clip()
+            ctx.set_source_surface(recording, x - self._atlas_margin,
+                                   y - self._atlas_margin)
+            ctx.paint()
+            ctx.restore()
+
+        MapCanvas.render_shapes(ctx, envelope, width, height, shapes)
+
     def _merge_page_indexes(self, indexes):
         # First, we split street categories and "other" categories,
         # because we sort them and we don't want to have the "other"
@@ -617,13 +966,14 @@ class MultiPageRenderer(Renderer):
             (self._usable_area_height_pt - 2 * Renderer.PRINT_SAFE_MARGIN_PT) / 2
 
         # Create the nice small map
-        front_page_map = \
-            MapCanvas(self.rc.stylesheet,
-                      self.rc.bounding_box,
-                      front_page_map_w,
-                      front_page_map_h,
-                      dpi,
-                      extend_bbox_to_ratio=True)
+        with self.rc.metrics.phase('map_canvas'):
+            front_page_map = \
+                MapCanvas(self.rc.stylesheet,
+                          self.rc.bounding_box,
+                          front_page_map_w,
+                          front_page_map_h,
+                          dpi,
+                          extend_bbox_to_ratio=True)
 
         # Add the shape that greys out everything that is outside of
         # the administrative boundary.
@@ -636,7 +986,8 @@ class MultiPageRenderer(Renderer):
         shade.add_shade_from_wkt(shade_wkt)
         front_page_map.add_shape_file(shade)
         self.rc.status_update(_("Preparing front page: base map"))
-        front_page_map.render()
+        with self.rc.metrics.phase('map_canvas'):
+            front_page_map.render()
         self._front_page_map = front_page_map
 
         self._frontpage_overlay_canvases = []
@@ -647,14 +998,15 @@ class MultiPageRenderer(Renderer):
                 plugin_name = path.lstrip('internal:')
                 self._frontpage_overlay_effects[plugin_name] = self.get_plugin(plugin_name)
             else:
-                ov_canvas = MapCanvas(overlay,
-                                      self.rc.bounding_box,
-                                      front_page_map_w,
-                                      front_page_map_h,
-                                      dpi,
-                                      extend_bbox_to_ratio=True)
-                self.rc.status_update(_("Preparing front page: %s") % ov_canvas._style_name)
-                ov_canvas.render()
+                with self.rc.metrics.phase('map_canvas'):
+                    ov_canvas = MapCanvas(overlay,
+                                          self.rc.bounding_box,
+                                          front_page_map_w,
+                                          front_page_map_h,
+                                          dpi,
+                                          extend_bbox_to_ratio=True)
+                    self.rc.status_update(_("Preparing front page: %s") % ov_canvas._style_name)
+                    ov_canvas.render()
                 self._frontpage_overlay_canvases.append(ov_canvas)
 
     def _render_front_page_header(self, ctx, w, h):
@@ -681,12 +1033,14 @@ class MultiPageRenderer(Renderer):
 
         # Render the map !
         self.rc.status_update(_("Rendering front page: base map"))
-        mapnik.render(self._front_page_map.get_rendered_map(), ctx)
+        with self.rc.metrics.phase('mapnik_render', self._front_page_map.get_style_name()):
+            mapnik.render(self._front_page_map.get_rendered_map(), ctx)
 
         for ov_canvas in self._frontpage_overlay_canvases:
             self.rc.status_update(_("Rendering front page: %s") % ov_canvas._style_name)
             rendered_map = ov_canvas.get_rendered_map()
-            mapnik.render(rendered_map, ctx)
+            with self.rc.metrics.phase('mapnik_render', ov_canvas.get_style_name()):
+                mapnik.render(rendered_map, ctx)
 
         # TODO offsets are not correct here, so we skip overlay plugins for now
         # apply effect overlays
@@ -897,19 +1251,22 @@ class MultiPageRenderer(Renderer):
 
         rendered_map = self.overview_canvas.get_rendered_map()
         self.rc.status_update(_("Rendering overview page: base map"))
-        mapnik.render(rendered_map, ctx)
+        with self.rc.metrics.phase('mapnik_render', self.overview_canvas.get_style_name()):
+            mapnik.render(rendered_map, ctx)
 
         for ov_canvas in self.overview_overlay_canvases:
             self.rc.status_update(_("Rendering overview page: %s") % ov_canvas._style_name)
             rendered_map = ov_canvas.get_rendered_map()
-            mapnik.render(rendered_map, ctx)
+            with self.rc.metrics.phase('mapnik_render', ov_canvas.get_style_name()):
+                mapnik.render(rendered_map, ctx)
 
         # apply effect overlays
         ctx.save()
         self._map_canvas = self.overview_canvas;
         for plugin_name, effect in self.overview_overlay_effects.items():
             try:
-                effect.render(self, ctx)
+                with self.rc.metrics.phase('plugin_effect', plugin_name):
+                    effect.render(self, ctx)
             except Exception as e:
                 # TODO better logging
                 LOG.warning("Error while rendering overlay: %s\n%s" % (plugin_name, e))
@@ -1113,7 +1470,8 @@ class MultiPageRenderer(Renderer):
 
 
     def render(self, cairo_surface, dpi, osm_date):
-        ctx = cairo.Context(cairo_surface)
+        ctx = commons.create_context(cairo_surface)
+        self._page_documents = []
 
         self._render_front_page(ctx, cairo_surface, dpi, osm_date)
         self._render_contents_page(ctx, cairo_surface, dpi, osm_date)
@@ -1143,7 +1501,26 @@ class MultiPageRenderer(Renderer):
                                       'total': len(self.pages),
                                      })
 
-            mapnik.render(rendered_map, ctx)
+            if map_number in self._page_images:
+                # map and overlays were rendered by a page worker, replay
+                # them in printing mode so that labels are kept as text
+                with self.rc.metrics.phase('page_assembly'):
+                    document = Poppler.Document.new_from_file(
+                        GLib.filename_to_uri(self._page_images[map_number], None),
+                        None)
+                    document.get_page(0).render_for_printing(ctx)
+                    # fonts of the page are only written out when the
+                    # output surface is finished, keep them around
+                    self._page_documents.append(document)
+            elif map_number in self._page_slices:
+                # map and overlays are part of the atlas map
+                envelope, shapes = self._page_slices[map_number]
+                with self.rc.metrics.phase('page_assembly'):
+                    self._render_page_slice(ctx, envelope, rendered_map.width,
+                                            rendered_map.height, shapes)
+            else:
+                with self.rc.metrics.phase('mapnik_render', canvas.get_style_name()):
+                    mapnik.render(rendered_map, ctx)
 
             for overlay_canvas in overlay_canvases:
                 self.rc.status_update(_("Rendering map page %(page)d of %(total)d: %(style)s") %
@@ -1153,7 +1530,8 @@ class MultiPageRenderer(Renderer):
                                        })
 
                 rendered_overlay = overlay_canvas.get_rendered_map()
-                mapnik.render(rendered_overlay, ctx)
+                with self.rc.metrics.phase('mapnik_render', overlay_canvas.get_style_name()):
+                    mapnik.render(rendered_overlay, ctx)
 
             # Place the vertical and horizontal square labels
             ctx.save()
@@ -1174,7 +1552,8 @@ class MultiPageRenderer(Renderer):
                 self.grid = grid
                 self._map_canvas = canvas
                 try:
-                    effect.render(self, ctx)
+                    with self.rc.metrics.phase('plugin_effect', plugin_name):
+                        effect.render(self, ctx)
                 except Exception as e:
                     # TODO better logging
                     LOG.warning("Error while rendering overlay: %s\n%s" % (plugin_name, e))
@@ -1208,7 +1587,13 @@ class MultiPageRenderer(Renderer):
                                         self._usable_area_height_pt),
                                        map_number + 2) # TODO: actually calc. the page offset here
 
-        mpsir.render()
+        with self.rc.metrics.phase('index_layout'):
+            # lay out the index pages only once per job
+            key = ('multi_page', self.paper_width_pt, self.paper_height_pt,
+                   index_fingerprint(self.index_categories))
+            if key not in self.rc.index_layouts:
+                self.rc.index_layouts[key] = mpsir.plan_layout()
+            mpsir.render(plan=self.rc.index_layouts[key])
 
         cairo_surface.flush()
 
@@ -5,6 +5,8 @@ import os
 import psycopg2
 import logging
 
+from ocitysmap import datasource
+
 LOG = logging.getLogger('ocitysmap')
 
 def _camera_view(renderer, ctx, map_scale, surveillance, lat, lon, camera_type, direction, angle, height):
@@ -140,7 +142,7 @@ def render(renderer, ctx):
                     , tags->'height'            AS camera_height
                  FROM planet_osm_point
                 WHERE tags->'man_made' = 'surveillance'
-                  AND ST_CONTAINS(ST_TRANSFORM(ST_GeomFromText('%s', 4326), 3857), way)
+                  AND %(area_filter)s
          UNION SELECT ST_Y(ST_TRANSFORM(way, 4326)) AS lat
                     , ST_X(ST_TRANSFORM(way, 4326)) AS lon
                     , tags->'surveillance'      AS surveillance
@@ -151,9 +153,11 @@ def render(renderer, ctx):
                     , tags->'height'            AS camera_height
                  FROM planet_osm_point
                 WHERE tags->'surveillance' IS NOT NULL
-                  AND ST_CONTAINS(ST_TRANSFORM(ST_GeomFromText('%s', 4326), 3857), way)
-             """ % ( renderer.rc.polygon_wkt, renderer.rc.polygon_wkt)
+                  AND %(area_filter)s
+             """ % { 'area_filter': datasource.area_filter_sql(renderer.rc.polygon_wkt, 'way') }
 
+    datasource.upload_area(renderer.db, renderer.rc.polygon_wkt,
+                           renderer.rc.area_subdivide_max_vertices)
     cursor = renderer.db.cursor()
     cursor.execute(query)
 
@@ -12,6 +12,9 @@ class SinglePageRendererIndexExtraPage(SinglePageRenderer):
     name = 'single_page_index_extra_page'
     description = gettext(u'Full-page layout with index on extra page (PDF only).')
 
+    # output differs between single and multi page formats
+    supports_recording = False
+
     def __init__(self, db, rc, tmpdir, dpi, file_prefix):
         """
         Create the renderer.
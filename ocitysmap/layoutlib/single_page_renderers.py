@@ -23,6 +23,8 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import concurrent.futures
+import multiprocessing
 import os
 from string import Template
 import cairo
@@ -52,8 +54,11 @@ from ocitysmap.indexlib.NotesIndex import NotesIndex
 from ocitysmap.indexlib.TreeIndex import TreeIndex
 from ocitysmap.indexlib.PoiIndex import PoiIndexRenderer, PoiIndex
 from ocitysmap.indexlib.commons import IndexDoesNotFitError, IndexEmptyError
+from ocitysmap.indexlib.renderer import index_fingerprint
 import draw_utils
 from ocitysmap.maplib.map_canvas import MapCanvas
+from ocitysmap.metrics import RenderMetrics
+from ocitysmap import output_writers
 from ocitysmap.stylelib import GpxStylesheet, UmapStylesheet
 
 
@@ -63,6 +68,67 @@ import time
 LOG = logging.getLogger('ocitysmap')
 
 
+def _render_map_tile(task):
+    """ Render one tile of a map and its overlays in a tile worker process
+
+    The tile is rendered with a margin of extra pixels on all sides, so
+    that labels close to the tile border are placed the same way as on
+    the neighbouring tiles, which are rendered with the same margin.
+
+    Parameters
+    ----------
+    task : tuple
+        Number of the tile, list of canvas descriptions as returned by
+        `MapCanvas.get_tile_task()`, the tile's (x, y, width, height)
+        rectangle, margin in pixels, Mapnik scale factor, and directory
+        to create the tile PNG file in
+
+    Returns
+    -------
+    tuple
+        Name of the tile file, including the margin, and the list of
+        phase timings as in `RenderMetrics.as_dict()`
+    """
+    number, canvas_tasks, (x, y, w, h), margin, scale_factor, tmpdir = task
+    tile_metrics = RenderMetrics()
+
+    tile_w, tile_h = w + 2 * margin, h + 2 * margin
+    filename = os.path.join(tmpdir, 'map_tile%d.png' % number)
+    surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, tile_w, tile_h)
+
+    ctx = cairo.Context(surface)
+    for canvas_task in canvas_tasks:
+        with tile_metrics.phase('mapnik_render', canvas_task[0].name):
+            MapCanvas.render_tile(canvas_task, ctx, x - margin, y - margin,
+                                  tile_w, tile_h, scale_factor, margin)
+
+    surface.write_to_png(filename)
+    surface.finish()
+
+    return filename, tile_metrics.as_dict()['phases']
+
+def _create_tile_executor(workers):
+    """ Create a pool of map tile worker processes
+
+    The workers are not forked from the current process, as it may hold
+    open database connections of already loaded Mapnik stylesheets, but
+    from a fork server process that only has the modules preloaded.
+
+    Parameters
+    ----------
+    workers : int
+        Number of worker processes
+
+    Returns
+    -------
+    concurrent.futures.ProcessPoolExecutor
+    """
+    mp_context = multiprocessing.get_context('forkserver')
+    mp_context.set_forkserver_preload([__name__])
+    return concurrent.futures.ProcessPoolExecutor(max_workers=workers,
+                                                  mp_context=mp_context)
+
+
 class SinglePageRenderer(Renderer):
     """
     This Renderer creates a full-page map, with the overlayed features
@@ -76,6 +142,8 @@ class SinglePageRenderer(Renderer):
     # TODO make configurable
     MAX_INDEX_OCCUPATION_RATIO = 1/3.
 
+    supports_recording = True
+
     def __init__(self, db, rc, tmpdir, dpi, file_prefix,
                  index_position = 'side'):
         """
@@ -125,12 +193,21 @@ class SinglePageRenderer(Renderer):
                     self.street_index = None
                     self.index_position = None
                 else:
-                    self.street_index = indexer_class(db,
-                                                      self,
-                                                      rc.bounding_box,
-                                                      rc.polygon_wkt,
-                                                      rc.i18n,
-                    )
+                    # The index queries mostly wait for the database, so
+                    # run them in the background while parsing stylesheets
+                    def create_index():
+                        with rc.metrics.phase('index_query', indexer_name):
+                            return indexer_class(db,
+                                                 self,
+                                                 rc.bounding_box,
+                                                 rc.polygon_wkt,
+                                                 rc.i18n,
+                            )
+
+                    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+                        index_future = executor.submit(create_index)
+                        self._preload_stylesheets()
+                        self.street_index = index_future.result()
 
             if self.street_index and not self.street_index.categories:
                 LOG.warning("Designated area leads to an empty index")
@@ -167,8 +244,9 @@ class SinglePageRenderer(Renderer):
             if ( index_position and self.street_index
                  and self.street_index.categories ):
                 self.rc.status_update(_("%s: fetching index data") % self.rc.output_format)
-                self._index_renderer, self._index_area \
-                    = self._create_index_rendering(index_position)
+                with self.rc.metrics.phase('index_layout'):
+                    self._index_renderer, self._index_area \
+                        = self._create_index_rendering(index_position)
             else:
                 self._index_renderer, self._index_area = None, None
         except IndexDoesNotFitError as e:
@@ -177,11 +255,12 @@ class SinglePageRenderer(Renderer):
         self._map_coords = self._get_map_coords(index_position if self._index_area else None)
 
         # Prepare the map
-        self._map_canvas = self._create_map_canvas(
-            float(self._map_coords[2]),  # W
-            float(self._map_coords[3]),  # H
-            dpi,
-            rc.osmid is not None )
+        with rc.metrics.phase('map_canvas'):
+            self._map_canvas = self._create_map_canvas(
+                float(self._map_coords[2]),  # W
+                float(self._map_coords[3]),  # H
+                dpi,
+                rc.osmid is not None )
 
         # Prepare overlay styles from config
         self._overlays = copy(self.rc.overlays)
@@ -228,11 +307,12 @@ class SinglePageRenderer(Renderer):
                 self._overlay_effects[plugin_name] = self.get_plugin(plugin_name)
             else:
                 # Mapnix style overlay
-                self._overlay_canvases.append(MapCanvas(overlay,
-                                              self.rc.bounding_box,
-                                              float(self._map_coords[2]),  # W
-                                              float(self._map_coords[3]),  # H
-                                              dpi))
+                with rc.metrics.phase('map_canvas'):
+                    self._overlay_canvases.append(MapCanvas(overlay,
+                                                  self.rc.bounding_box,
+                                                  float(self._map_coords[2]),  # W
+                                                  float(self._map_coords[3]),  # H
+                                                  dpi))
 
         # Prepare the grid
         self.grid = self._create_grid(self._map_canvas, dpi)
@@ -240,9 +320,102 @@ class SinglePageRenderer(Renderer):
             self._apply_grid(self.grid, self._map_canvas)
 
         # Commit the internal rendering stack of the map
-        self._map_canvas.render()
-        for overlay_canvas in self._overlay_canvases:
-           overlay_canvas.render()
+        with rc.metrics.phase('map_canvas'):
+            self._map_canvas.render()
+            for overlay_canvas in self._overlay_canvases:
+               overlay_canvas.render()
+
+    def _render_map_tiles(self, ctx, tiles, scale_factor):
+        """ Render the map and its overlays tile by tile in worker processes
+
+        Each tile is rendered together with a margin of its neighbouring
+        tiles, so that features and labels crossing tile borders are
+        drawn the same way on both sides, and only the tile itself is
+        then drawn onto the map. Tiles are handed over as bitmaps, so
+        this is only used for raster output.
+
+        Parameters
+        ----------
+        ctx : cairo.Context
+            Context to draw into, with the map origin at (0, 0)
+        tiles : list of tuple
+            (x, y, width, height) pixel rectangles covering the map
+        scale_factor : float
+            Mapnik scale factor for symbol sizes
+
+        Returns
+        -------
+        void
+        """
+        workers = min(self.rc.map_tile_workers, len(tiles))
+        margin = self.rc.map_tile_margin
+
+        canvas_tasks = [canvas.get_tile_task()
+                        for canvas in [self._map_canvas] + self._overlay_canvases]
+
+        LOG.debug("Rendering map in %d tiles with %d tile workers"
+                  % (len(tiles), workers))
+
+        tile_executor = _create_tile_executor(workers)
+        tile_futures = []
+        try:
+            for number, tile in enumerate(tiles):
+                tile_futures.append(tile_executor.submit(_render_map_tile, (
+                    number, canvas_tasks, tile, margin, scale_factor,
+                    self.tmpdir)))
+
+            for number, (tile, future) in enumerate(zip(tiles, tile_futures)):
+                self.rc.status_update(_("%(format)s: rendering map tile %(tile)d of %(total)d")
+                                      % { 'format': self.rc.output_format,
+                                          'tile':   number + 1,
+                                          'total':  len(tiles),
+                                         })
+                filename, phases = future.result()
+                for phase in phases:
+                    self.rc.metrics.add(phase['phase'], phase['detail'],
+                                        phase['wall'], phase['cpu'])
+
+                x, y, w, h = tile
+                with self.rc.metrics.phase('page_assembly'):
+                    ctx.save()
+                    ctx.rectangle(x, y, w, h)
+                    ctx.clip()
+                    ctx.translate(x - margin, y - margin)
+                    image = cairo.ImageSurface.create_from_png(filename)
+                    ctx.set_source_surface(image, 0, 0)
+                    ctx.paint()
+                    ctx.restore()
+                os.unlink(filename)
+        finally:
+            for future in tile_futures:
+                future.cancel()
+            tile_executor.shutdown()
+
+    def _preload_stylesheets(self):
+        """ Parse the map and overlay stylesheets ahead of canvas creation
+
+        Failures are ignored here, they are reported when actually
+        creating the canvases later.
+
+        Parameters
+        ----------
+        none
+
+        Returns
+        -------
+        void
+        """
+        stylesheets = [self.rc.stylesheet]
+        stylesheets += [overlay for overlay in self.rc.overlays
+                        if not overlay.path.strip().startswith('internal:')]
+
+        with self.rc.metrics.phase('map_canvas'):
+            for stylesheet in stylesheets:
+                try:
+                    MapCanvas.preload_stylesheet(stylesheet)
+                except Exception as e:
+                    LOG.debug("Could not preload stylesheet %s: %s"
+                              % (stylesheet.path, e))
 
     def _get_map_coords(self, index_position):
         """ Determine actual map output dimensions
@@ -297,8 +470,6 @@ class SinglePageRenderer(Renderer):
             The actual index renderer and the area it will cover.
         """
 
-        index_area = None
-
         # Now we determine the actual occupation of the index
         # TODO: index type choice should not be hard coded here
         if self.rc.indexer == 'Poi':
@@ -310,6 +481,32 @@ class SinglePageRenderer(Renderer):
             index_renderer = GeneralIndexRenderer(self.rc.i18n,
                                                  self.street_index.categories)
 
+        index_area = self._shared_index_layout(
+            ('area', type(index_renderer).__name__, index_position,
+             self._title_margin_pt),
+            lambda: self._compute_index_area(index_renderer, index_position))
+
+        return index_renderer, index_area
+
+    def _compute_index_area(self, index_renderer, index_position):
+        """Determine the area the index will cover.
+
+        Parameters
+        ----------
+           index_renderer : GeneralIndexRenderer or PoiIndexRenderer
+               The index renderer
+           index_position : str, optional
+               None, "side", "bottom" or "extra_page"
+
+        Returns
+        -------
+        IndexRenderingArea or None
+            The area the index will cover, or None if it does not fit
+            or is not shown on the map page.
+        """
+
+        index_area = None
+
         # We use a fake vector device to determine the actual
         # rendering characteristics
         fake_surface = cairo.PDFSurface(None,
@@ -359,7 +556,105 @@ class SinglePageRenderer(Renderer):
         except IndexDoesNotFitError:
             index_area = None
 
-        return index_renderer, index_area
+        return index_area
+
+    def _compute_extra_page_index_area(self):
+        """Determine the area the index will cover on an extra page.
+
+        Returns
+        -------
+        IndexRenderingArea or None
+            The area the index will cover, or None if it does not fit.
+        """
+
+        # We use a fake vector device to determine the actual
+        # rendering characteristics
+        fake_surface = cairo.PDFSurface(None,
+                                        self.paper_width_pt,
+                                        self.paper_height_pt)
+
+        usable_area_width_pt = (self.paper_width_pt -
+                                2 * Renderer.PRINT_SAFE_MARGIN_PT)
+        usable_area_height_pt = (self.paper_height_pt -
+                                 2 * Renderer.PRINT_SAFE_MARGIN_PT)
+
+        try:
+            return self._index_renderer.precompute_occupation_area(
+                fake_surface,
+                Renderer.PRINT_SAFE_MARGIN_PT,
+                ( self.paper_height_pt
+                  - Renderer.PRINT_SAFE_MARGIN_PT
+                  - usable_area_height_pt
+                ),
+                usable_area_width_pt,
+                usable_area_height_pt,
+                'width', 'left')
+        except IndexDoesNotFitError:
+            return None
+
+    def _get_index_layout_plan(self, where, index_area):
+        """Get the layout of the index items within the index area.
+
+        The layout is computed once per job, after the grid locations
+        have been applied to the index items.
+
+        Parameters
+        ----------
+           where : str
+               The part of the document the index is rendered to
+           index_area : IndexRenderingArea
+               The area the index covers
+
+        Returns
+        -------
+        IndexLayoutPlan or None
+            The index layout, or None if the index renderer does not
+            support precomputed layouts.
+        """
+        if not hasattr(self._index_renderer, 'plan_layout'):
+            return None
+
+        def compute():
+            # We use a fake vector device to determine the actual
+            # rendering characteristics
+            fake_surface = cairo.PDFSurface(None,
+                                            self.paper_width_pt,
+                                            self.paper_height_pt)
+            return self._index_renderer.plan_layout(fake_surface, index_area)
+
+        return self._shared_index_layout(
+            ('plan', type(self._index_renderer).__name__, where,
+             index_area.x, index_area.y, index_area.w, index_area.h,
+             index_area.n_cols),
+            compute)
+
+    def _shared_index_layout(self, kind, compute):
+        """Compute an index layout only once per job.
+
+        A renderer is created for every output format, so index layouts
+        are kept in the job's rendering configuration and reused by all
+        renderers of the job that lay out the same index the same way.
+
+        Parameters
+        ----------
+           kind : tuple
+               What kind of layout for which part of the page
+           compute : callable
+               Function computing the layout if not known yet
+
+        Returns
+        -------
+        The layout returned by compute.
+        """
+        key = kind + (self.paper_width_pt, self.paper_height_pt,
+                      index_fingerprint(self.street_index.categories))
+
+        layouts = self.rc.index_layouts
+        if key not in layouts:
+            layouts[key] = compute()
+        else:
+            LOG.debug("Reusing index layout for %s" % (kind,))
+        return layouts[key]
 
 
     def _draw_title(self, ctx, w_dots, h_dots, font_face):
@@ -538,7 +833,7 @@ class SinglePageRenderer(Renderer):
                               self._map_coords))
 
         # create the cairo context to draw into
-        ctx = cairo.Context(cairo_surface)
+        ctx = commons.create_context(cairo_surface)
 
         # Set a white background (so that generated bitmaps are not transparent)
         ctx.save()
@@ -572,11 +867,25 @@ class SinglePageRenderer(Renderer):
 
         # now perform the actual map drawing
         self.rc.status_update(_("%s: rendering base map") % self.rc.output_format)
-        mapnik.render(rendered_map, ctx, scale_factor, 0, 0)
+        tiles = []
+        # tiles are rendered into bitmaps, vector output is rendered
+        # in one piece to keep labels as text
+        if (self.rc.map_tile_workers or 1) > 1 \
+           and output_writers.is_raster_output(self.rc.output_format):
+            tiles = commons.split_map_tiles(rendered_map.width, rendered_map.height,
+                                            self.rc.map_tile_size)
+        if len(tiles) > 1:
+            # map and overlays are rendered together, tile by tile
+            self._render_map_tiles(ctx, tiles, scale_factor)
+            overlay_canvases = []
+        else:
+            with self.rc.metrics.phase('mapnik_render', self._map_canvas.get_style_name()):
+                mapnik.render(rendered_map, ctx, scale_factor, 0, 0)
+            overlay_canvases = self._overlay_canvases
         ctx.restore()
 
         # Draw the rescaled Overlays on top of the map one by one
-        for overlay_canvas in self._overlay_canvases:
+        for overlay_canvas in overlay_canvases:
             ctx.save()
             rendered_overlay = overlay_canvas.get_rendered_map()
             LOG.info('Overlay: %s' % overlay_canvas.get_style_name())
@@ -584,7 +893,8 @@ class SinglePageRenderer(Renderer):
                                   % { 'format': self.rc.output_format,
                                       'style': overlay_canvas.get_style_name(),
                                      })
-            mapnik.render(rendered_overlay, ctx, scale_factor, 0, 0)
+            with self.rc.metrics.phase('mapnik_render', overlay_canvas.get_style_name()):
+                mapnik.render(rendered_overlay, ctx, scale_factor, 0, 0)
             ctx.restore()
 
         # Place the vertical and horizontal square labels
@@ -616,7 +926,8 @@ class SinglePageRenderer(Renderer):
                                       'style':  plugin_name,
                                      })
             try:
-                effect.render(self, ctx)
+                with self.rc.metrics.phase('plugin_effect', plugin_name):
+                    effect.render(self, ctx)
             except Exception as e:
                 # TODO better logging
                 LOG.warning("Error while rendering overlay: %s\n%s" % (plugin_name, e))
@@ -659,17 +970,24 @@ class SinglePageRenderer(Renderer):
             # comments within.
 
             self.rc.status_update(_("%s: rendering index") % self.rc.output_format)
-            self._index_renderer.render(ctx, self._index_area, dpi)
+            with self.rc.metrics.phase('index_layout'):
+                frame_area = self._index_area
+                plan = self._get_index_layout_plan('map_page', self._index_area)
+                if plan is not None:
+                    self._index_renderer.render(ctx, self._index_area, dpi, plan)
+                    frame_area = plan.rendering_area
+                else:
+                    self._index_renderer.render(ctx, self._index_area, dpi)
 
             ctx.restore()
 
             # Also draw a rectangle frame around the index
             ctx.save()
             ctx.set_line_width(1)
-            ctx.rectangle(commons.convert_pt_to_dots(self._index_area.x, dpi),
-                          commons.convert_pt_to_dots(self._index_area.y, dpi),
-                          commons.convert_pt_to_dots(self._index_area.w, dpi),
-                          commons.convert_pt_to_dots(self._index_area.h, dpi))
+            ctx.rectangle(commons.convert_pt_to_dots(frame_area.x, dpi),
+                          commons.convert_pt_to_dots(frame_area.y, dpi),
+                          commons.convert_pt_to_dots(frame_area.w, dpi),
+                          commons.convert_pt_to_dots(frame_area.h, dpi))
             ctx.stroke()
             ctx.restore()
 
@@ -695,27 +1013,11 @@ class SinglePageRenderer(Renderer):
             if self.index_position == 'extra_page' and self._has_multipage_format() and self._index_renderer is not None:
                 self.rc.status_update(_("%s: rendering extra index page") % self.rc.output_format)
 
-                # We use a fake vector device to determine the actual
-                # rendering characteristics
-                fake_surface = cairo.PDFSurface(None,
-                                                self.paper_width_pt,
-                                                self.paper_height_pt)
-
-                usable_area_width_pt = (self.paper_width_pt -
-                                        2 * Renderer.PRINT_SAFE_MARGIN_PT)
-                usable_area_height_pt = (self.paper_height_pt -
-                                         2 * Renderer.PRINT_SAFE_MARGIN_PT)
-
-                index_area = self._index_renderer.precompute_occupation_area(
-                    fake_surface,
-                    Renderer.PRINT_SAFE_MARGIN_PT,
-                    ( self.paper_height_pt
-                      - Renderer.PRINT_SAFE_MARGIN_PT
-                      - usable_area_height_pt
-                    ),
-                    usable_area_width_pt,
-                    usable_area_height_pt,
-                    'width', 'left')
+                index_area = self._shared_index_layout(
+                    ('area', type(self._index_renderer).__name__, 'extra_page_area'),
+                    self._compute_extra_page_index_area)
+                if index_area is None:
+                    raise IndexDoesNotFitError
 
                 cairo_surface.show_page()
 
@@ -730,7 +1032,11 @@ class SinglePageRenderer(Renderer):
 
                 # render the actual index
                 ctx.save()
-                self._index_renderer.render(ctx, index_area, dpi)
+                plan = self._get_index_layout_plan('extra_page', index_area)
+                if plan is not None:
+                    self._index_renderer.render(ctx, index_area, dpi, plan)
+                else:
+                    self._index_renderer.render(ctx, index_area, dpi)
                 ctx.restore()
 
                 cairo_surface.show_page()
@@ -121,7 +121,7 @@ class TK25Renderer(Renderer):
         return d, m
 
     def render(self, cairo_surface, dpi, osm_date):
-        ctx = cairo.Context(cairo_surface)
+        ctx = commons.create_context(cairo_surface)
         pc = PangoCairo.create_context(ctx)
 
         normal_fd = Pango.FontDescription("DejaVu 7")
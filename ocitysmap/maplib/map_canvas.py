@@ -35,6 +35,7 @@ import os
 import ocitysmap
 from ocitysmap.layoutlib.commons import convert_pt_to_dots
 import ocitysmap.maplib.shapes
+from ocitysmap.maplib import style_cache
 
 LOG = logging.getLogger('ocitysmap')
 
@@ -48,6 +49,11 @@ class MapCanvas:
     given width and height (in pixels). Shape files can be overlayed on the
     map; the order they are added to the map being important with regard to
     their respective alpha levels.
+
+    The parsed stylesheet is shared with all other canvases using the
+    same stylesheet, see style_cache, so the Mapnik map returned by
+    get_rendered_map() has to be rendered before using another canvas
+    of the same stylesheet.
     """
 
     def __init__(self, stylesheet, bounding_box, _width, _height, dpi=72.0,
@@ -64,6 +70,7 @@ class MapCanvas:
             provided rendering area. Needed by SinglePageRenderer.
         """
 
+        self._stylesheet = stylesheet
         self._style_name = stylesheet.name
         self._proj = ocitysmap.coords.get_proj_transformation()
         self._dpi  = dpi
@@ -92,23 +99,34 @@ class MapCanvas:
         g_width  = int(convert_pt_to_dots(_width, dpi))
         g_height = int(convert_pt_to_dots(_height, dpi))
 
-        # Create the Mapnik map with the corrected width and height and zoom to
-        # the corrected bounding box ('envelope' in the Mapnik jargon)
-        self._map = mapnik.Map(g_width, g_height, _MAPNIK_PROJECTION)
-        mapnik.load_map(self._map, stylesheet.path)
-        self._map.zoom_to_box(envelope)
-
-        # exclude layers based on configuration setting "exclude_layers"
-        for layer in self._map.layers:
-            if layer.name in stylesheet.exclude_layers:
-                LOG.debug("Excluding layer: %s" % layer.name)
-                layer.status = False
+        # Get the parsed stylesheet, and remember the corrected width and
+        # height and the corrected bounding box ('envelope' in the Mapnik
+        # jargon) to apply to it when rendering
+        self._style = style_cache.get_shared_style(stylesheet, _MAPNIK_PROJECTION)
+        self._width = g_width
+        self._height = g_height
+        self._envelope = envelope
 
-        # Added shapes to render
+        # Added shapes to render, and the layers generated from them
         self._shapes = []
+        self._extra_layers = []
+
+        self._scale_denominator = self.get_rendered_map().scale_denominator()
 
         LOG.debug('MapCanvas rendering map on %dx%dpx.' % (g_width, g_height))
 
+    @staticmethod
+    def preload_stylesheet(stylesheet):
+        """Parse a stylesheet ahead of creating canvases using it.
+
+        Lets callers parse stylesheets while waiting for something else,
+        like database queries, before the canvas size is known.
+
+        Args:
+            stylesheet (Stylesheet): map stylesheet.
+        """
+        style_cache.get_shared_style(stylesheet, _MAPNIK_PROJECTION)
+
     def _fix_bbox_ratio(self, off_x, off_y, width, height, dest_ratio):
         """Adjusts the area expressed by its origin's offset and its size to
         the given destination ratio by tweaking one of the two dimensions
@@ -130,18 +148,17 @@ class MapCanvas:
                        line_width=1.0):
         """
         Args:
-            shape_file (shapes.ShapeFile): path to the shape file to overlay on
-                this map canvas.
+            shape_file (shapes.ShapeFile): the shapes to overlay on this map
+                canvas.
             str_color (string): litteral name of the layer's color, needs to be
                 understood by mapnik.Color.
             alpha (float): transparency factor in the range 0 (invisible) -> 1
                 (opaque).
             line_width (float): line width for the features that will be drawn.
         """
-        col = mapnik.Color(str_color)
-        col.a = int(255 * alpha)
         self._shapes.append({'shape_file': shape_file,
-                             'color': col,
+                             'str_color': str_color,
+                             'alpha': alpha,
                              'line_width': line_width})
         LOG.debug('Added shape file %s to map canvas as layer %s.' %
                 (shape_file.get_filepath(), shape_file.get_layer_name()))
@@ -150,12 +167,79 @@ class MapCanvas:
         """Render the map in memory with all the added shapes. The Mapnik Map
         object can be accessed with self.get_rendered_map()."""
 
-        # Add all shapes to the map
-        for shape in self._shapes:
-            self._render_shape_file(**shape)
+        # Create map layers for all shapes
+        self._extra_layers = [self._render_shape_file(**shape)
+                              for shape in self._shapes]
 
     def get_rendered_map(self):
-        return self._map
+        """Returns the shared Mapnik map, set up for this canvas. It stays
+        valid until another canvas with the same stylesheet is used."""
+        return self._style.apply(self._width, self._height, self._envelope,
+                                 self._extra_layers)
+
+    def get_tile_task(self):
+        """Returns a picklable description of this canvas, to render parts
+        of it in other processes with render_tile()."""
+        rendered_map = self.get_rendered_map()
+        envelope = rendered_map.envelope()
+        return (self._stylesheet, rendered_map.width, rendered_map.height,
+                (envelope.minx, envelope.miny, envelope.maxx, envelope.maxy),
+                self._shapes)
+
+    @staticmethod
+    def render_tile(task, ctx, x, y, width, height, scale_factor=1.0,
+                    buffer_size=0):
+        """Render a rectangular part of a canvas into a Cairo context.
+
+        The part is rendered at the same scale as the whole canvas, so
+        that tiles of a canvas rendered next to each other line up.
+
+        Args:
+            task (tuple): canvas description, see get_tile_task().
+            ctx (cairo.Context): context to render into, the top left
+                corner of the tile is drawn at its origin.
+            x, y (int): position of the tile on the canvas, in pixels.
+                May be negative, or extend beyond the canvas.
+            width, height (int): size of the tile in pixels.
+            scale_factor (float): Mapnik scale factor for symbol sizes.
+            buffer_size (int): extra pixels around the tile to take
+                features and labels into account from.
+        """
+        stylesheet, canvas_width, canvas_height, envelope, shapes = task
+        minx, miny, maxx, maxy = envelope
+        res_x = (maxx - minx) / canvas_width
+        res_y = (maxy - miny) / canvas_height
+
+        tile_envelope = mapnik.Box2d(minx + x * res_x,
+                                     maxy - (y + height) * res_y,
+                                     minx + (x + width) * res_x,
+                                     maxy - y * res_y)
+
+        style = style_cache.get_shared_style(stylesheet, _MAPNIK_PROJECTION)
+        extra_layers = [MapCanvas._render_shape_file(**shape)
+                        for shape in shapes]
+        rendered_map = style.apply(width, height, tile_envelope,
+                                   extra_layers, buffer_size)
+        mapnik.render(rendered_map, ctx, scale_factor, 0, 0)
+
+    @staticmethod
+    def render_shapes(ctx, envelope, width, height, shapes):
+        """Render shapes on their own, without any stylesheet.
+
+        Args:
+            ctx (cairo.Context): context to render into.
+            envelope (mapnik.Box2d): projected map area to show.
+            width, height (int): map size in pixels.
+            shapes (list): (shape_file, str_color, alpha, line_width)
+                tuples, as taken by add_shape_file().
+        """
+        shapes_map = mapnik.Map(width, height, _MAPNIK_PROJECTION)
+        for style_name, style, layer in [MapCanvas._render_shape_file(*shape)
+                                         for shape in shapes]:
+            shapes_map.append_style(style_name, style)
+            shapes_map.layers.append(layer)
+        shapes_map.zoom_to_box(envelope)
+        mapnik.render(shapes_map, ctx)
 
     def get_style_name(self):
         return self._style_name
@@ -167,7 +251,7 @@ class MapCanvas:
 
     def get_actual_scale(self):
         # get the scale denominator computed by mapnik
-        scale = self._map.scale_denominator()
+        scale = self._scale_denominator
         # the actual scale depends on the latitude
         lat = self._geo_bbox.get_top_left()[0]
         scale *= math.cos(math.radians(lat))
@@ -175,9 +259,12 @@ class MapCanvas:
         scale *= float(self._dpi) / 90
         return scale
 
-    def _render_shape_file(self, shape_file, color, line_width):
+    @staticmethod
+    def _render_shape_file(shape_file, str_color, alpha, line_width):
         LOG.debug("render_shape_file")
-        shape_file.flush()
+
+        color = mapnik.Color(str_color)
+        color.a = int(255 * alpha)
 
         shpid = os.path.basename(shape_file.get_filepath())
         s,r = mapnik.Style(), mapnik.Rule()
@@ -191,12 +278,11 @@ class MapCanvas:
         r.symbols.append(line_sym)
         s.rules.append(r)
 
-        self._map.append_style('style_%s' % shpid, s)
         layer = mapnik.Layer(shpid)
-        layer.datasource = mapnik.Shapefile(file=shape_file.get_filepath())
+        layer.datasource = shape_file.get_datasource()
         layer.styles.append('style_%s' % shpid)
 
-        self._map.layers.append(layer)
+        return ('style_%s' % shpid, s, layer)
 
     def _project_envelope(self, bbox):
         """Project the given bounding box into the rendering projection."""
@@ -55,8 +55,8 @@ class OverviewGrid:
         vertical lines added.
 
         Args:
-            filename (string): path to the temporary shape file that will be
-                generated.
+            filename (string): unique name of the shape file, nothing is
+                written to it.
         Returns the ShapeFile object.
         """
 
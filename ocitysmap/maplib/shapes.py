@@ -22,24 +22,20 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-import locale
 import logging
-import os
 
-# The ogr module is now known as osgeo.ogr in recent versions of the
-# module, but we want to keep compatibility with older versions
-try:
-    from osgeo import ogr
-except ImportError:
-    import ogr
+import mapnik
 
 LOG = logging.getLogger('ocitysmap')
 
 class _ShapeFile:
     """
-    This class represents a shapefile (.shp) that can be added to a Mapnik map
-    as a layer. It provides a few methods to add some geometry 'features' to
-    the shape file.
+    This class represents a set of geometry features that can be added to a
+    Mapnik map as a layer. It provides a few methods to add some geometry
+    'features' to it.
+
+    Despite its name nothing is written to disk: features are kept in memory
+    and handed to Mapnik as an in-memory datasource.
 
     This is a private base class and is not meant to be used directly from the
     outside.
@@ -49,7 +45,8 @@ class _ShapeFile:
         """
         Args:
             bounding_box (BoundingBox): bounding box of the map area.
-            out_filename (string): path to the output shape file to generate.
+            out_filename (string): unique name of the shape, like the path
+                of a shape file; only used to identify it.
             layer_name (string): layer name for the shape file.
         """
 
@@ -57,34 +54,49 @@ class _ShapeFile:
         self._filepath = out_filename
         self._layer_name = layer_name
 
-        driver = ogr.GetDriverByName('ESRI Shapefile')
-        if os.path.exists(out_filename):
-            # Delete the detination file first
-            driver.DeleteDataSource(out_filename)
+        self._features = [] # WKT strings, in EPSG:4326
+        self._datasource = None
 
-        self._ds = driver.CreateDataSource(out_filename)
-        self._layer = None
+    def _add_feature(self, wkt):
+        self._features.append(wkt)
+        self._datasource = None
 
-    def _add_feature(self, feature):
-        f = ogr.Feature(feature_def=self._layer.GetLayerDefn())
-        f.SetGeometryDirectly(feature)
-        self._layer.CreateFeature(f)
-        f.Destroy()
+    def _add_line(self, *points):
+        self._add_feature('LINESTRING(%s)'
+                          % ','.join('%r %r' % (float(x), float(y))
+                                     for x, y in points))
 
     def flush(self):
         """
-        Commit the file to disk and prevent any further addition of
-        new longitude/latitude lines
+        Create the Mapnik datasource holding all features added so far
         """
-        self._ds.Destroy()
-        self._ds = None
+        if self._datasource is not None:
+            return
+
+        context = mapnik.Context()
+        self._datasource = mapnik.MemoryDatasource()
+        for feature_id, wkt in enumerate(self._features, 1):
+            feature = mapnik.Feature(context, feature_id)
+            feature.geometry = mapnik.Geometry.from_wkt(wkt)
+            self._datasource.add_feature(feature)
+
+    def __getstate__(self):
+        # Mapnik datasources can't be pickled, they are recreated on demand
+        state = self.__dict__.copy()
+        state['_datasource'] = None
+        return state
+
+    def get_datasource(self):
+        """Returns the Mapnik datasource with all features of this shape."""
+        self.flush()
+        return self._datasource
 
     def get_layer_name(self):
         """Returns the name of the layer used for this shape file."""
         return self._layer_name
 
     def get_filepath(self):
-        """Returns the path to the destination shape file."""
+        """Returns the unique name of this shape."""
         return self._filepath
 
     def __str__(self):
@@ -97,8 +109,6 @@ class LineShapeFile(_ShapeFile):
 
     def __init__(self, bounding_box, out_filename, layer_name):
         _ShapeFile.__init__(self, bounding_box, out_filename, layer_name)
-        self._layer = self._ds.CreateLayer(self._layer_name,
-                                           geom_type=ogr.wkbLineString)
         LOG.debug('Created layer %s in LineShapeFile %s.' %
                 (layer_name, out_filename))
 
@@ -111,18 +121,14 @@ class LineShapeFile(_ShapeFile):
 
     def add_horiz_line(self, y):
         """Add a new latitude line at the given latitude."""
-        line = ogr.Geometry(type = ogr.wkbLineString)
-        line.AddPoint_2D(self._bbox.get_top_left()[1], y)
-        line.AddPoint_2D(self._bbox.get_bottom_right()[1], y)
-        self._add_feature(line)
+        self._add_line((self._bbox.get_top_left()[1], y),
+                       (self._bbox.get_bottom_right()[1], y))
         return self
 
     def add_vert_line(self, x):
         """Add a new longitude line at the given longitude."""
-        line = ogr.Geometry(type = ogr.wkbLineString)
-        line.AddPoint_2D(x, self._bbox.get_top_left()[0])
-        line.AddPoint_2D(x, self._bbox.get_bottom_right()[0])
-        self._add_feature(line)
+        self._add_line((x, self._bbox.get_top_left()[0]),
+                       (x, self._bbox.get_bottom_right()[0]))
         return self
 
 class BoxShapeFile(LineShapeFile):
@@ -133,25 +139,14 @@ class BoxShapeFile(LineShapeFile):
     def add_box(self, box):
         top_left, bottom_right = box.get_top_left(), box.get_bottom_right()
 
-        line = ogr.Geometry(type = ogr.wkbLineString)
-        line.AddPoint_2D(*list(reversed(top_left)))
-        line.AddPoint_2D(bottom_right[1], top_left[0])
-        self._add_feature(line)
-
-        line = ogr.Geometry(type = ogr.wkbLineString)
-        line.AddPoint_2D(bottom_right[1], top_left[0])
-        line.AddPoint_2D(*list(reversed(bottom_right)))
-        self._add_feature(line)
-
-        line = ogr.Geometry(type = ogr.wkbLineString)
-        line.AddPoint_2D(*list(reversed(bottom_right)))
-        line.AddPoint_2D(top_left[1], bottom_right[0])
-        self._add_feature(line)
-
-        line = ogr.Geometry(type = ogr.wkbLineString)
-        line.AddPoint_2D(top_left[1], bottom_right[0])
-        line.AddPoint_2D(*list(reversed(top_left)))
-        self._add_feature(line)
+        self._add_line(reversed(top_left),
+                       (bottom_right[1], top_left[0]))
+        self._add_line((bottom_right[1], top_left[0]),
+                       reversed(bottom_right))
+        self._add_line(reversed(bottom_right),
+                       (top_left[1], bottom_right[0]))
+        self._add_line((top_left[1], bottom_right[0]),
+                       reversed(top_left))
         return self
 
 class PolyShapeFile(_ShapeFile):
@@ -161,27 +156,12 @@ class PolyShapeFile(_ShapeFile):
 
     def __init__(self, bounding_box, out_filename, layer_name):
         _ShapeFile.__init__(self, bounding_box, out_filename, layer_name)
-        self._layer = self._ds.CreateLayer(self._layer_name,
-                                           geom_type=ogr.wkbPolygon)
         LOG.debug('Created layer %s in PolyShapeFile %s.' %
                 (layer_name, out_filename))
 
     def add_shade_from_wkt(self, wkt):
         """Add the polygon feature to the shape file."""
-        # Prevent the current locale from influencing how the WKT data is
-        # parsed by OGR.
-        try:
-            prev_locale = locale.getlocale(locale.LC_ALL)
-        except:
-            prev_locale = ''
-        locale.setlocale(locale.LC_ALL, "C")
-
-        try:
-            poly = ogr.CreateGeometryFromWkt(wkt)
-        finally:
-            locale.setlocale(locale.LC_ALL, prev_locale)
-
-        self._add_feature(poly)
+        self._add_feature(wkt)
         return self
 
 if __name__ == "__main__":
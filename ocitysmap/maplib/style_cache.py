@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+
+# ocitysmap, city map and street index generator from OpenStreetMap data
+# Copyright (C) 2023  Hartmut Holzgraefe
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Process wide cache of parsed Mapnik stylesheets
+
+Parsing a large stylesheet like OSM Carto takes a considerable amount
+of time, and multi page renderings use many map canvases with the same
+stylesheet. Each stylesheet is therefore only loaded once per process
+into a `SharedStyle`, and the map canvases using it apply their own
+size, envelope and extra layers to the shared Mapnik map right before
+rendering it.
+
+Parsed stylesheets are kept across rendering jobs, and are reloaded
+when the stylesheet file changes.
+
+Parsed stylesheets must not be shared with forked child processes that
+render: Mapnik's PostGIS datasources connect while the stylesheet is
+loaded, and a forked child would inherit these database connections.
+"""
+
+import collections
+import logging
+import os
+import threading
+
+import mapnik
+
+LOG = logging.getLogger('ocitysmap')
+
+# Maximum number of parsed stylesheets to keep
+MAX_ENTRIES = 16
+
+_cache = collections.OrderedDict()
+_cache_lock = threading.Lock()
+
+
+class SharedStyle:
+    """
+    A parsed Mapnik stylesheet, shared by all map canvases using it.
+
+    The underlying Mapnik map is reconfigured for a canvas by `apply()`,
+    so the returned map is only valid until the next `apply()` call.
+    """
+
+    def __init__(self, path, exclude_layers, srs):
+        """
+        Parameters
+        ----------
+        path : str
+            Path of the Mapnik XML stylesheet
+        exclude_layers : list of str
+            Names of stylesheet layers to disable
+        srs : str
+            Default map projection if not set by the stylesheet
+        """
+        self.path = path
+
+        LOG.debug("Loading stylesheet %s" % path)
+        self._map = mapnik.Map(1, 1, srs)
+        mapnik.load_map(self._map, path)
+
+        # exclude layers based on configuration setting "exclude_layers"
+        for layer in self._map.layers:
+            if layer.name in exclude_layers:
+                LOG.debug("Excluding layer: %s" % layer.name)
+                layer.status = False
+
+        self._base_layer_count = len(self._map.layers)
+        self._base_buffer_size = self._map.buffer_size
+        self._extra_style_names = []
+
+    def apply(self, width, height, envelope, extra_layers=(), buffer_size=0):
+        """ Configure the shared map for one canvas
+
+        Parameters
+        ----------
+        width : int
+            Map width in pixels
+        height : int
+            Map height in pixels
+        envelope : mapnik.Box2d
+            Projected map area to show
+        extra_layers : list of (str, mapnik.Style, mapnik.Layer)
+            Additional styles and layers to draw on top of the stylesheet
+        buffer_size : int
+            Minimum number of pixels around the map to take features
+            and labels into account from, the stylesheet's own buffer
+            size is kept if larger
+
+        Returns
+        -------
+        mapnik.Map
+            The configured map
+        """
+        m = self._map
+
+        # remove the additions of the previous canvas
+        while len(m.layers) > self._base_layer_count:
+            del m.layers[len(m.layers) - 1]
+        for style_name in self._extra_style_names:
+            m.remove_style(style_name)
+        self._extra_style_names = []
+
+        m.resize(width, height)
+        m.buffer_size = max(self._base_buffer_size, buffer_size)
+        m.zoom_to_box(envelope)
+
+        for style_name, style, layer in extra_layers:
+            m.append_style(style_name, style)
+            m.layers.append(layer)
+            self._extra_style_names.append(style_name)
+
+        return m
+
+
+def get_shared_style(stylesheet, srs):
+    """ Get the parsed stylesheet, loading it on first use
+
+    Parameters
+    ----------
+    stylesheet : ocitysmap.stylelib.Stylesheet
+        Stylesheet to load
+    srs : str
+        Default map projection if not set by the stylesheet
+
+    Returns
+    -------
+    SharedStyle
+        Parsed stylesheet, shared within this process
+    """
+    path = os.path.realpath(stylesheet.path)
+    exclude_layers = tuple(sorted(stylesheet.exclude_layers or []))
+    try:
+        mtime = os.stat(path).st_mtime
+    except OSError:
+        # let mapnik report the actual problem
+        mtime = None
+
+    key = (path, mtime, exclude_layers, srs)
+
+    with _cache_lock:
+        if key in _cache:
+            _cache.move_to_end(key)
+            return _cache[key]
+
+    # load outside of the lock, parsing large stylesheets takes time
+    style = SharedStyle(path, exclude_layers, srs)
+
+    with _cache_lock:
+        _cache[key] = style
+        _cache.move_to_end(key)
+        while len(_cache) > MAX_ENTRIES:
+            _cache.popitem(last=False)
+
+    return style
+
+def clear():
+    """ Forget all parsed stylesheets """
+    with _cache_lock:
+        _cache.clear()
@@ -0,0 +1,317 @@
+# -*- coding: utf-8 -*-
+
+# ocitysmap, city map and street index generator from OpenStreetMap data
+# Copyright (C) 2023  Hartmut Holzgraefe
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Rendering phase timing and metrics export
+
+Each rendering job records the wall clock and CPU time spent in its
+phases in a `RenderMetrics` instance, available as `metrics` attribute
+of the job's RenderingConfiguration. Phases recorded are:
+
+    geographic_lookup : OSM id envelope and area lookup
+    index_query       : index database queries
+    index_layout      : index column layout and index rendering
+    map_canvas        : Mapnik map and overlay preparation
+    mapnik_render     : Mapnik rendering, per style or overlay
+    plugin_effect     : Python overlay plugins, per plugin
+    page_assembly     : drawing multi page map pages rendered by
+                        page workers into the final document
+    serialization     : writing output files, per format
+
+Phases may be nested, e.g. index queries happen while the map canvas
+of a multi page rendering is prepared. CPU times are process wide,
+so they include helper threads running at the same time.
+
+The `PrometheusExporter` aggregates the metrics of all jobs rendered
+by long running workers into a Prometheus text format file, suitable
+for the node exporter textfile collector.
+"""
+
+import collections
+import contextlib
+import fcntl
+import json
+import logging
+import os
+import threading
+import time
+
+LOG = logging.getLogger('ocitysmap')
+
+
+class RenderMetrics:
+    """
+    Wall clock and CPU time spent in the phases of one rendering job.
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        self._phases = collections.OrderedDict() # (phase, detail) -> [count, wall, cpu]
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def phase(self, name, detail=None):
+        """ Context manager timing the code run in its scope
+
+        Parameters
+        ----------
+        name : str
+            Phase name, see module documentation
+        detail : str, optional
+            Phase detail like a style or output format name
+
+        Returns
+        -------
+        void
+        """
+        wall = time.perf_counter()
+        cpu  = time.process_time()
+        try:
+            yield
+        finally:
+            self.add(name, detail,
+                     time.perf_counter() - wall,
+                     time.process_time() - cpu)
+
+    def add(self, name, detail, wall, cpu):
+        """ Add time measured elsewhere to a phase
+
+        Parameters
+        ----------
+        name : str
+            Phase name, see module documentation
+        detail : str or None
+            Phase detail like a style or output format name
+        wall : float
+            Wall clock time in seconds
+        cpu : float
+            CPU time in seconds
+
+        Returns
+        -------
+        void
+        """
+        with self._lock:
+            entry = self._phases.setdefault((name, detail), [0, 0.0, 0.0])
+            entry[0] += 1
+            entry[1] += wall
+            entry[2] += cpu
+
+    def totals(self):
+        """ Times per phase, summed up over all details
+
+        Parameters
+        ----------
+        none
+
+        Returns
+        -------
+        dict
+            Dictionary of phase name to `count`, `wall` and `cpu` sums
+        """
+        totals = collections.OrderedDict()
+        with self._lock:
+            for (name, detail), (count, wall, cpu) in self._phases.items():
+                total = totals.setdefault(name, {'count': 0, 'wall': 0.0, 'cpu': 0.0})
+                total['count'] += count
+                total['wall']  += wall
+                total['cpu']   += cpu
+        return totals
+
+    def as_dict(self):
+        """ Machine readable job report
+
+        Parameters
+        ----------
+        none
+
+        Returns
+        -------
+        dict
+            Job start time, elapsed wall time, and lists of detailed
+            phase timings and per phase totals, JSON serializable
+        """
+        with self._lock:
+            phases = [ { 'phase':  name,
+                         'detail': detail,
+                         'count':  count,
+                         'wall':   round(wall, 4),
+                         'cpu':    round(cpu, 4) }
+                       for (name, detail), (count, wall, cpu) in self._phases.items() ]
+
+        totals = { name: { 'count': total['count'],
+                           'wall':  round(total['wall'], 4),
+                           'cpu':   round(total['cpu'], 4) }
+                   for name, total in self.totals().items() }
+
+        return { 'started': self.started,
+                 'elapsed': round(time.time() - self.started, 4),
+                 'phases':  phases,
+                 'totals':  totals }
+
+    def write_json(self, filename):
+        """ Write the job report to a JSON file
+
+        Parameters
+        ----------
+        filename : str
+            Path of the file to write
+
+        Returns
+        -------
+        void
+        """
+        with open(filename, 'w') as f:
+            json.dump(self.as_dict(), f, indent=2)
+
+
+class PrometheusExporter:
+    """
+    Prometheus text format export of job metrics.
+
+    Counters and histograms are aggregated in a JSON state file next
+    to the exported text file, so that all processes of a worker pool
+    can contribute to the same metrics. Both files are updated under
+    an exclusive lock after each job.
+    """
+
+    # Histogram bucket upper bounds in seconds
+    BUCKETS = [0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300, 900]
+
+    def __init__(self, filename):
+        """
+        Parameters
+        ----------
+        filename : str
+            Path of the Prometheus text file to write, usually ending
+            in '.prom' and located in the textfile collector directory
+        """
+        self._filename = filename
+        self._state_file = filename + '.state'
+
+    def _observe(self, histogram, value):
+        if not histogram:
+            histogram.update({ 'buckets': [0] * len(self.BUCKETS),
+                               'sum': 0.0, 'count': 0 })
+        for i, bound in enumerate(self.BUCKETS):
+            if value <= bound:
+                histogram['buckets'][i] += 1
+        histogram['sum']   += value
+        histogram['count'] += 1
+
+    def record_job(self, status, elapsed, totals=None):
+        """ Add a finished job to the exported metrics
+
+        Parameters
+        ----------
+        status : str
+            Job status, e.g. 'ok' or 'error'
+        elapsed : float
+            Job wall clock time in seconds
+        totals : dict, optional
+            Per phase totals of the job as returned by
+            `RenderMetrics.totals()`, if it got that far
+
+        Returns
+        -------
+        void
+        """
+        try:
+            with open(self._state_file, 'a+') as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                f.seek(0)
+                try:
+                    state = json.loads(f.read() or '{}')
+                except ValueError:
+                    state = {}
+
+                jobs = state.setdefault('jobs', {})
+                jobs[status] = jobs.get(status, 0) + 1
+                self._observe(state.setdefault('job_duration', {}), elapsed)
+
+                if totals:
+                    phases = state.setdefault('phases', {})
+                    for name, total in totals.items():
+                        phase = phases.setdefault(name, { 'wall': 0.0, 'cpu': 0.0,
+                                                          'duration': {} })
+                        phase['wall'] += total['wall']
+                        phase['cpu']  += total['cpu']
+                        self._observe(phase['duration'], total['wall'])
+
+                f.seek(0)
+                f.truncate()
+                f.write(json.dumps(state))
+                f.flush()
+
+                self._write_text(state)
+        except OSError as e:
+            LOG.warning("Could not update metrics file %s: %s" % (self._filename, e))
+
+    def _histogram_lines(self, name, labels, histogram):
+        lines = []
+        prefix = labels + ',' if labels else ''
+        for bound, count in zip(self.BUCKETS, histogram['buckets']):
+            lines.append('%s_bucket{%sle="%s"} %d' % (name, prefix, bound, count))
+        lines.append('%s_bucket{%sle="+Inf"} %d' % (name, prefix, histogram['count']))
+        labels = '{%s}' % labels if labels else ''
+        lines.append('%s_sum%s %f' % (name, labels, histogram['sum']))
+        lines.append('%s_count%s %d' % (name, labels, histogram['count']))
+        return lines
+
+    def _write_text(self, state):
+        lines = [
+            '# HELP ocitysmap_jobs_total Rendering jobs processed, by status.',
+            '# TYPE ocitysmap_jobs_total counter',
+        ]
+        for status, count in sorted(state['jobs'].items()):
+            lines.append('ocitysmap_jobs_total{status="%s"} %d' % (status, count))
+
+        lines += [
+            '# HELP ocitysmap_job_duration_seconds Rendering job wall clock time.',
+            '# TYPE ocitysmap_job_duration_seconds histogram',
+        ]
+        lines += self._histogram_lines('ocitysmap_job_duration_seconds', '',
+                                       state['job_duration'])
+
+        phases = sorted(state.get('phases', {}).items())
+        lines += [
+            '# HELP ocitysmap_phase_seconds_total Wall clock time spent per rendering phase.',
+            '# TYPE ocitysmap_phase_seconds_total counter',
+        ]
+        for name, phase in phases:
+            lines.append('ocitysmap_phase_seconds_total{phase="%s"} %f' % (name, phase['wall']))
+
+        lines += [
+            '# HELP ocitysmap_phase_cpu_seconds_total CPU time spent per rendering phase.',
+            '# TYPE ocitysmap_phase_cpu_seconds_total counter',
+        ]
+        for name, phase in phases:
+            lines.append('ocitysmap_phase_cpu_seconds_total{phase="%s"} %f' % (name, phase['cpu']))
+
+        lines += [
+            '# HELP ocitysmap_phase_duration_seconds Wall clock time per job and rendering phase.',
+            '# TYPE ocitysmap_phase_duration_seconds histogram',
+        ]
+        for name, phase in phases:
+            lines += self._histogram_lines('ocitysmap_phase_duration_seconds',
+                                           'phase="%s"' % name, phase['duration'])
+
+        # atomic replace, so that the collector never sees partial files
+        tmp_filename = self._filename + '.tmp'
+        with open(tmp_filename, 'w') as f:
+            f.write("\n".join(lines) + "\n")
+        os.rename(tmp_filename, self._filename)
@@ -0,0 +1,580 @@
+# -*- coding: utf-8 -*-
+
+# ocitysmap, city map and street index generator from OpenStreetMap data
+# Copyright (C) 2023  Hartmut Holzgraefe
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Output file writers
+
+Creation of the Cairo output surfaces for the supported file formats,
+and replaying of a page that has been rendered once into a Cairo
+recording surface onto these, so that the expensive parts of a
+rendering job only need to be done once for all requested formats.
+
+Raster images are rendered directly into a Cairo image surface where
+they fit into memory. Larger PNG files are written band by band from a
+recorded page instead, so that the memory needed does not depend on
+the size of the image. JPEG and WebP output, and PNG palette
+quantization, need the optional Pillow package.
+"""
+
+import cairo
+import concurrent.futures
+import gzip
+import logging
+import multiprocessing
+import os
+import struct
+import sys
+import zlib
+
+try:
+    import PIL.Image
+except ImportError:
+    PIL = None
+
+from .layoutlib import commons
+
+LOG = logging.getLogger('ocitysmap')
+
+# Formats that are written by replaying a recorded page
+RECORDABLE_FORMATS = ['png', 'jpg', 'webp', 'svg', 'svgz', 'pdf', 'ps', 'ps.gz']
+
+# Raster image formats, all but PNG need Pillow
+RASTER_FORMATS = ['png', 'jpg', 'webp']
+
+# Raster formats besides PNG that can be written with what is installed
+EXTRA_RASTER_FORMATS = ['jpg', 'webp'] if PIL is not None else []
+
+# Raster encoder settings, see write_raster()
+DEFAULT_RASTER_OPTIONS = {
+    'png_compression_level': 6,
+    'png_palette_colors':    0,
+    'jpeg_quality':          90,
+    'webp_quality':          80,
+}
+
+# Maximum size of a raster image to render in one piece
+RASTER_SURFACE_BYTES = 256 * 1024 * 1024
+
+# Maximum size of the raster band kept in memory while writing PNG files
+PNG_BAND_BYTES = 64 * 1024 * 1024
+
+# Maximum width of a single raster band surface, Cairo image
+# surfaces are limited to 32767 pixels in each direction
+_PNG_PIECE_WIDTH = 16384
+
+# Amount of compressed image data to collect per PNG IDAT chunk
+_PNG_CHUNK_BYTES = 1024 * 1024
+
+# Byte offsets of red, green and blue in a Cairo RGB24 pixel,
+# which is a native endian 32 bit value
+if sys.byteorder == 'little':
+    _RGB24_OFFSETS = (2, 1, 0)
+else:
+    _RGB24_OFFSETS = (1, 2, 3)
+
+# Recording surfaces can't be pickled, so writer processes inherit
+# the recording to replay via this global when being forked
+_shared_recording = None
+
+
+def create_vector_surface(output_format, filename, width_pt, height_pt,
+                          metadata = None):
+    """ Create a Cairo output surface for a vector file format
+
+    Parameters
+    ----------
+    output_format : str
+        One of `pdf`, `ps`, `ps.gz`, `svg`, `svgz`
+    filename : str
+        Path of the file to write to
+    width_pt : float
+        Page width in points
+    height_pt : float
+        Page height in points
+    metadata : dict, optional
+        PDF metadata, using cairo.PDFMetadata values as keys
+
+    Returns
+    -------
+    cairo.Surface
+        The Cairo surface writing to the given file
+    """
+    if output_format == 'svg':
+        surface = cairo.SVGSurface(filename, width_pt, height_pt)
+        surface.restrict_to_version(cairo.SVGVersion.VERSION_1_2);
+    elif output_format == 'svgz':
+        surface = cairo.SVGSurface(gzip.GzipFile(filename, 'wb'),
+                                   width_pt, height_pt)
+        surface.restrict_to_version(cairo.SVGVersion.VERSION_1_2);
+    elif output_format == 'pdf':
+        surface = cairo.PDFSurface(filename, width_pt, height_pt)
+        surface.restrict_to_version(cairo.PDFVersion.VERSION_1_5);
+
+        try:
+            for key, value in (metadata or {}).items():
+                surface.set_metadata(key, value)
+        except:
+          LOG.warning("Installed Cairo version does not support PDF annotations yet")
+
+    elif output_format == 'ps':
+        surface = cairo.PSSurface(filename, width_pt, height_pt)
+    elif output_format == 'ps.gz':
+        surface = cairo.PSSurface(gzip.GzipFile(filename, 'wb'),
+                                  width_pt, height_pt)
+    else:
+        raise ValueError( \
+            'Unsupported output format: %s!' % output_format.upper())
+
+    return surface
+
+def pdf_metadata(title, subject):
+    """ PDF document metadata for a rendering job
+
+    Parameters
+    ----------
+    title : str
+        Document title
+    subject : str
+        Document subject, usually the renderer description
+
+    Returns
+    -------
+    dict
+        cairo.PDFMetadata keys with their values
+    """
+    try:
+        return {
+            cairo.PDFMetadata.CREATOR:
+                'MyOSMatic <https://print.get-map.org/>',
+            cairo.PDFMetadata.TITLE:
+                title,
+            cairo.PDFMetadata.AUTHOR:
+                "Created using MapOSMatic/OCitySMap\n" +
+                "Map data © 2018 OpenStreetMap contributors (see http://osm.org/copyright)",
+            cairo.PDFMetadata.SUBJECT:
+                subject, # TODO add style annotations here
+            cairo.PDFMetadata.KEYWORDS:
+                "OpenStreetMap, MapOSMatic, OCitysMap",
+        }
+    except AttributeError:
+        # cairo.PDFMetadata not available in this PyCairo version
+        return {}
+
+def create_recording_surface(width_pt, height_pt):
+    """ Create a recording surface to render a page into once
+
+    Parameters
+    ----------
+    width_pt : float
+        Page width in points
+    height_pt : float
+        Page height in points
+
+    Returns
+    -------
+    cairo.RecordingSurface
+        Recording surface covering exactly the page area
+    """
+    return cairo.RecordingSurface(cairo.Content.COLOR_ALPHA,
+                                  cairo.Rectangle(0, 0, width_pt, height_pt))
+
+def create_raster_surface(w_px, h_px):
+    """ Create an image surface to render a page into directly
+
+    Parameters
+    ----------
+    w_px, h_px : int
+        Image size in pixels
+
+    Returns
+    -------
+    cairo.ImageSurface
+        Opaque image surface with a white background
+    """
+    surface = cairo.ImageSurface(cairo.FORMAT_RGB24, w_px, h_px)
+    ctx = cairo.Context(surface)
+    ctx.set_source_rgb(1, 1, 1)
+    ctx.paint()
+    return surface
+
+def fits_raster_surface(w_px, h_px):
+    """ Whether an image is small enough to be rendered in one piece
+
+    Parameters
+    ----------
+    w_px, h_px : int
+        Image size in pixels
+
+    Returns
+    -------
+    bool
+        True if the image fits into a single `create_raster_surface()`
+    """
+    return (w_px <= 32767 and h_px <= 32767
+            and 4 * w_px * h_px <= RASTER_SURFACE_BYTES)
+
+def fits_raster_output(output_format, w_px, h_px):
+    """ Whether an image can be written in a raster output format
+
+    PNG files of any size can be written band by band, the other raster
+    formats are encoded from an image surface holding the whole image.
+
+    Parameters
+    ----------
+    output_format : str
+        One of the `RASTER_FORMATS`
+    w_px, h_px : int
+        Image size in pixels
+
+    Returns
+    -------
+    bool
+        True if the image can be written in this format
+    """
+    return output_format == 'png' or fits_raster_surface(w_px, h_px)
+
+def is_raster_output(output_format):
+    """ Whether a rendering only produces raster output
+
+    Parameters
+    ----------
+    output_format : str
+        Output format of a rendering, or several formats separated by
+        '/' when rendering once for all of them
+
+    Returns
+    -------
+    bool
+        True if all the formats are `RASTER_FORMATS`
+    """
+    return all(f in RASTER_FORMATS
+               for f in (output_format or '').lower().split('/'))
+
+def _copy_rgb_rows(surface, band, x, row_bytes, first_row = 0, rows = None):
+    """ Copy rows of an RGB24 surface into PNG scanlines
+
+    The pixels are written to the scanlines in band starting at pixel
+    column x, leaving the filter type byte of each scanline untouched.
+    """
+    data = surface.get_data()
+    stride = surface.get_stride()
+    width = surface.get_width()
+    if rows is None:
+        rows = surface.get_height() - first_row
+    r, g, b = _RGB24_OFFSETS
+
+    for row in range(rows):
+        offset = (first_row + row) * stride
+        pixels = data[offset : offset + 4 * width]
+        start = row * row_bytes + 1 + 3 * x
+        end = start + 3 * width
+        band[start    : end : 3] = pixels[r::4]
+        band[start + 1: end : 3] = pixels[g::4]
+        band[start + 2: end : 3] = pixels[b::4]
+
+def _recording_bands(recording, factor, w_px, h_px, band_height):
+    """ Rasterize a recorded page in horizontal bands of PNG scanlines """
+    row_bytes = 1 + 3 * w_px
+
+    for y in range(0, h_px, band_height):
+        rows = min(band_height, h_px - y)
+        band = bytearray(row_bytes * rows)
+
+        for x in range(0, w_px, _PNG_PIECE_WIDTH):
+            surface = create_raster_surface(min(_PNG_PIECE_WIDTH, w_px - x), rows)
+            ctx = cairo.Context(surface)
+            ctx.translate(-x, -y)
+            ctx.scale(factor, factor)
+            ctx.set_source_surface(recording, 0, 0)
+            ctx.paint()
+            surface.flush()
+
+            _copy_rgb_rows(surface, band, x, row_bytes)
+            surface.finish()
+
+        yield band
+
+def _surface_bands(surface, band_height):
+    """ Split an RGB24 image surface into bands of PNG scanlines """
+    surface.flush()
+    w_px, h_px = surface.get_width(), surface.get_height()
+    row_bytes = 1 + 3 * w_px
+
+    for y in range(0, h_px, band_height):
+        rows = min(band_height, h_px - y)
+        band = bytearray(row_bytes * rows)
+        _copy_rgb_rows(surface, band, 0, row_bytes, y, rows)
+        yield band
+
+def _write_png_chunk(f, chunk_type, data):
+    f.write(struct.pack('>I', len(data)))
+    f.write(chunk_type)
+    f.write(data)
+    f.write(struct.pack('>I', zlib.crc32(data, zlib.crc32(chunk_type))))
+
+def _write_png_file(filename, w_px, h_px, bands, dpi, compression_level):
+    """ Write an 8 bit RGB PNG file from bands of unfiltered scanlines """
+    with open(filename, 'wb') as f:
+        f.write(b'\x89PNG\r\n\x1a\n')
+        # 8 bit RGB, default compression and filtering, no interlacing
+        _write_png_chunk(f, b'IHDR',
+                         struct.pack('>IIBBBBB', w_px, h_px, 8, 2, 0, 0, 0))
+        if dpi:
+            pixels_per_meter = int(round(dpi / 0.0254))
+            _write_png_chunk(f, b'pHYs', struct.pack('>IIB', pixels_per_meter,
+                                                     pixels_per_meter, 1))
+
+        compressor = zlib.compressobj(compression_level)
+        pending = b''
+        for band in bands:
+            pending += compressor.compress(band)
+            if len(pending) >= _PNG_CHUNK_BYTES:
+                _write_png_chunk(f, b'IDAT', pending)
+                pending = b''
+        pending += compressor.flush()
+        _write_png_chunk(f, b'IDAT', pending)
+
+        _write_png_chunk(f, b'IEND', b'')
+
+def write_png(recording, filename, w_px, h_px, factor = 1.0, dpi = None,
+              compression_level = DEFAULT_RASTER_OPTIONS['png_compression_level'],
+              band_bytes = PNG_BAND_BYTES):
+    """ Write a recorded page into a PNG file, band by band
+
+    The page is rasterized in horizontal bands of limited size, and
+    each band is compressed and appended to the file before the next
+    one is rendered, so the image as a whole is never kept in memory.
+
+    Parameters
+    ----------
+    recording : cairo.RecordingSurface
+        Recorded page
+    filename : str
+        Path of the file to write to
+    w_px, h_px : int
+        Image size in pixels
+    factor : float, optional
+        Scale factor from recording units to pixels
+    dpi : int, optional
+        Resolution to store in the file
+    compression_level : int, optional
+        zlib compression level, 0 to 9
+    band_bytes : int, optional
+        Maximum raster band size in bytes
+
+    Returns
+    -------
+    void
+    """
+    band_height = max(1, min(h_px, band_bytes // (4 * max(1, w_px))))
+    LOG.debug("Writing %dpx x %dpx PNG in bands of %d rows"
+              % (w_px, h_px, band_height))
+
+    _write_png_file(filename, w_px, h_px,
+                    _recording_bands(recording, factor, w_px, h_px, band_height),
+                    dpi, compression_level)
+
+def _pillow_image(surface):
+    """ Wrap an RGB24 image surface into a Pillow image """
+    surface.flush()
+    raw_mode = 'BGRX' if sys.byteorder == 'little' else 'XRGB'
+    return PIL.Image.frombuffer('RGB',
+                                (surface.get_width(), surface.get_height()),
+                                bytes(surface.get_data()), 'raw', raw_mode,
+                                surface.get_stride(), 1)
+
+def write_raster(surface, output_format, filename, dpi = None, options = None):
+    """ Write a rendered raster image into a file
+
+    PNG files are written with a built in encoder, unless they are to
+    be quantized to a color palette. Palette quantization, JPEG and WebP
+    files need Pillow.
+
+    Parameters
+    ----------
+    surface : cairo.ImageSurface
+        Rendered page, see `create_raster_surface()`
+    output_format : str
+        One of the `RASTER_FORMATS`
+    filename : str
+        Path of the file to write to
+    dpi : int, optional
+        Resolution to store in the file
+    options : dict, optional
+        Encoder settings overriding `DEFAULT_RASTER_OPTIONS`
+
+    Returns
+    -------
+    void
+    """
+    settings = dict(DEFAULT_RASTER_OPTIONS)
+    settings.update(options or {})
+
+    if output_format == 'png' and not settings['png_palette_colors']:
+        w_px, h_px = surface.get_width(), surface.get_height()
+        band_height = max(1, min(h_px, PNG_BAND_BYTES // (4 * max(1, w_px))))
+        _write_png_file(filename, w_px, h_px,
+                        _surface_bands(surface, band_height),
+                        dpi, settings['png_compression_level'])
+        return
+
+    if PIL is None:
+        raise ValueError("Writing %s output%s requires Pillow"
+                         % (output_format.upper(),
+                            " with a color palette" if output_format == 'png' else ""))
+
+    image = _pillow_image(surface)
+    extra = { 'dpi': (dpi, dpi) } if dpi else {}
+
+    if output_format == 'png':
+        image = image.quantize(colors = min(256, settings['png_palette_colors']))
+        image.save(filename, 'PNG',
+                   compress_level = settings['png_compression_level'], **extra)
+    elif output_format == 'jpg':
+        image.save(filename, 'JPEG', quality = settings['jpeg_quality'],
+                   optimize = True, **extra)
+    elif output_format == 'webp':
+        image.save(filename, 'WEBP', quality = settings['webp_quality'])
+    else:
+        raise ValueError( \
+            'Unsupported output format: %s!' % output_format.upper())
+
+def write_recording(recording, output_format, output_filename,
+                    width_pt, height_pt, png_dpi = None,
+                    title = None, subject = None, raster_options = None):
+    """ Replay a recorded page into an output file
+
+    The file is written to a temporary name first, and only renamed to
+    its final name after it has been written completely.
+
+    Parameters
+    ----------
+    recording : cairo.RecordingSurface
+        Page recorded at 72dpi, see `create_recording_surface()`
+    output_format : str
+        One of the `RECORDABLE_FORMATS`
+    output_filename : str
+        Final output file path
+    width_pt : float
+        Page width in points
+    height_pt : float
+        Page height in points
+    png_dpi : int, optional
+        Resolution to use for raster output
+    title : str, optional
+        Document title for PDF metadata
+    subject : str, optional
+        Document subject for PDF metadata
+    raster_options : dict, optional
+        Raster encoder settings, see `write_raster()`
+
+    Returns
+    -------
+    bool
+        True if the file has been written, False if it has been
+        skipped as the image is too large for the output format
+    """
+    tmp_output_filename = output_filename + ".tmp"
+
+    if output_format in RASTER_FORMATS:
+        w_px = int(commons.convert_pt_to_dots(width_pt, png_dpi))
+        h_px = int(commons.convert_pt_to_dots(height_pt, png_dpi))
+        if not fits_raster_output(output_format, w_px, h_px):
+            LOG.warning("Image of %dpx x %dpx too large for %s output, skipping it"
+                        % (w_px, h_px, output_format.upper()))
+            return False
+        factor = png_dpi / commons.PT_PER_INCH
+        LOG.debug("Writing %s into %dpx x %dpx area at %ddpi ..."
+                  % (output_format.upper(), w_px, h_px, png_dpi))
+        # Text has already been laid out in the recording, so unlike
+        # with direct rendering raster surfaces can be used here
+        if fits_raster_surface(w_px, h_px):
+            surface = create_raster_surface(w_px, h_px)
+            ctx = cairo.Context(surface)
+            ctx.scale(factor, factor)
+            ctx.set_source_surface(recording, 0, 0)
+            ctx.paint()
+            write_raster(surface, output_format, tmp_output_filename,
+                         png_dpi, raster_options)
+            surface.finish()
+        else:
+            settings = dict(DEFAULT_RASTER_OPTIONS)
+            settings.update(raster_options or {})
+            if settings['png_palette_colors']:
+                LOG.warning("Image too large for palette quantization, writing RGB PNG")
+            write_png(recording, tmp_output_filename, w_px, h_px, factor,
+                      png_dpi, settings['png_compression_level'])
+    else:
+        surface = create_vector_surface(output_format, tmp_output_filename,
+                                        width_pt, height_pt,
+                                        pdf_metadata(title, subject))
+        ctx = cairo.Context(surface)
+
+        ctx.set_source_surface(recording, 0, 0)
+        ctx.paint()
+
+        LOG.debug('Writing %s...' % output_filename)
+
+        surface.finish()
+
+    os.rename(tmp_output_filename, output_filename)
+
+    return True
+
+def _write_shared_recording(args):
+    return write_recording(_shared_recording, *args)
+
+def write_recordings(recording, jobs, max_workers = 1):
+    """ Replay a recorded page into several output files
+
+    With more than one worker the files are written in parallel by a
+    pool of forked processes, each of them inheriting the recording.
+
+    Parameters
+    ----------
+    recording : cairo.RecordingSurface
+        Page recorded at 72dpi, see `create_recording_surface()`
+    jobs : list of tuple
+        Arguments for `write_recording()` following the recording,
+        one tuple per output file
+    max_workers : int, optional
+        Maximum number of writer processes to use
+
+    Returns
+    -------
+    int
+        Number of files written, see `write_recording()`
+    """
+    global _shared_recording
+
+    if max_workers <= 1 or len(jobs) <= 1:
+        return sum(1 for job in jobs if write_recording(recording, *job))
+
+    LOG.debug("Writing %d output files using up to %d processes"
+              % (len(jobs), max_workers))
+
+    _shared_recording = recording
+    try:
+        with concurrent.futures.ProcessPoolExecutor(
+                max_workers = min(max_workers, len(jobs)),
+                mp_context = multiprocessing.get_context('fork')) as executor:
+            futures = [executor.submit(_write_shared_recording, job)
+                       for job in jobs]
+            # propagate writer errors, if any
+            return sum(1 for future in futures if future.result())
+    finally:
+        _shared_recording = None
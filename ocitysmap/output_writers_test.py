@@ -0,0 +1,167 @@
+# -*- coding: utf-8; mode: Python -*-
+import os
+import random
+import struct
+import tempfile
+import unittest
+import zlib
+from unittest import mock
+
+try:
+    import cairo
+    from ocitysmap import output_writers
+except ImportError:
+    cairo = None
+
+# Size in points of the single colored blocks of the test pattern
+BLOCK = 4
+
+def block_color(bx, by):
+    """ 8 bit RGB color of a test pattern block """
+    return ((bx * 37 + by * 11) % 256, (bx * 5 + by * 71) % 256, (bx * by * 13) % 256)
+
+def draw_pattern(surface, width, height):
+    """ Draw colored blocks aligned to whole points """
+    ctx = cairo.Context(surface)
+    ctx.set_antialias(cairo.ANTIALIAS_NONE)
+    for by in range(0, (height + BLOCK - 1) // BLOCK):
+        for bx in range(0, (width + BLOCK - 1) // BLOCK):
+            r, g, b = block_color(bx, by)
+            ctx.set_source_rgb(r / 255., g / 255., b / 255.)
+            ctx.rectangle(bx * BLOCK, by * BLOCK, BLOCK, BLOCK)
+            ctx.fill()
+
+def read_png(filename):
+    """ Decode an 8 bit RGB PNG file without filtering or interlacing
+
+    Returns the image size, the pHYs pixels per meter if present, the
+    number of IDAT chunks, and the list of pixel rows as bytes.
+    """
+    with open(filename, 'rb') as f:
+        data = f.read()
+
+    assert data[:8] == b'\x89PNG\r\n\x1a\n'
+    pos = 8
+    chunks = []
+    while pos < len(data):
+        (length,) = struct.unpack('>I', data[pos : pos + 4])
+        chunk_type = data[pos + 4 : pos + 8]
+        payload = data[pos + 8 : pos + 8 + length]
+        (crc,) = struct.unpack('>I', data[pos + 8 + length : pos + 12 + length])
+        assert crc == zlib.crc32(chunk_type + payload)
+        chunks.append((chunk_type, payload))
+        pos += 12 + length
+
+    assert chunks[0][0] == b'IHDR' and chunks[-1][0] == b'IEND'
+    w_px, h_px, depth, color_type, compression, filtering, interlace = \
+        struct.unpack('>IIBBBBB', chunks[0][1])
+    assert (depth, color_type, compression, filtering, interlace) == (8, 2, 0, 0, 0)
+
+    ppm = None
+    for chunk_type, payload in chunks:
+        if chunk_type == b'pHYs':
+            ppm = struct.unpack('>IIB', payload)[0]
+
+    idat = [payload for chunk_type, payload in chunks if chunk_type == b'IDAT']
+    raw = zlib.decompress(b''.join(idat))
+    row_bytes = 1 + 3 * w_px
+    assert len(raw) == row_bytes * h_px
+    rows = []
+    for y in range(h_px):
+        row = raw[y * row_bytes : (y + 1) * row_bytes]
+        assert row[0] == 0
+        rows.append(row[1:])
+
+    return w_px, h_px, ppm, len(idat), rows
+
+def expected_rows(w_px, h_px, factor):
+    block_px = int(BLOCK * factor)
+    rows = []
+    for y in range(h_px):
+        row = bytearray()
+        for x in range(w_px):
+            row.extend(block_color(x // block_px, y // block_px))
+        rows.append(bytes(row))
+    return rows
+
+
+@unittest.skipIf(cairo is None, "needs pycairo")
+class write_png_test(unittest.TestCase):
+    def setUp(self):
+        fd, self.filename = tempfile.mkstemp(suffix='.png')
+        os.close(fd)
+
+    def tearDown(self):
+        os.unlink(self.filename)
+
+    def check_recording(self, width_pt, height_pt, factor, band_rows):
+        recording = output_writers.create_recording_surface(width_pt, height_pt)
+        draw_pattern(recording, width_pt, height_pt)
+        recording.flush()
+
+        w_px, h_px = int(width_pt * factor), int(height_pt * factor)
+        output_writers.write_png(recording, self.filename, w_px, h_px,
+                                 factor, dpi=144,
+                                 band_bytes=4 * w_px * band_rows)
+
+        size_x, size_y, ppm, chunks, rows = read_png(self.filename)
+        self.assertEqual((size_x, size_y), (w_px, h_px))
+        self.assertEqual(ppm, int(round(144 / 0.0254)))
+        self.assertEqual(rows, expected_rows(w_px, h_px, factor))
+        return chunks
+
+    def test_bands_and_pieces(self):
+        # bands of 5 rows, the last one shorter, each rasterized in
+        # pieces of 16 columns, the last one narrower
+        with mock.patch.object(output_writers, '_PNG_PIECE_WIDTH', 16):
+            self.check_recording(45, 23, 1.0, 5)
+
+    def test_scaled(self):
+        with mock.patch.object(output_writers, '_PNG_PIECE_WIDTH', 24):
+            self.check_recording(30, 17, 2.0, 7)
+
+    def test_single_band(self):
+        self.check_recording(20, 12, 1.0, 100)
+
+    def test_chunks(self):
+        # noise does not compress, so compressed data is split into
+        # several IDAT chunks while the bands are written
+        noise = random.Random(0)
+        rows = [bytes(noise.getrandbits(8) for i in range(3 * 100))
+                for y in range(100)]
+        bands = [bytearray(b''.join(b'\0' + row for row in rows[y : y + 8]))
+                 for y in range(0, 100, 8)]
+        with mock.patch.object(output_writers, '_PNG_CHUNK_BYTES', 4096):
+            output_writers._write_png_file(self.filename, 100, 100,
+                                           iter(bands), None, 6)
+
+        w_px, h_px, ppm, chunks, decoded = read_png(self.filename)
+        self.assertEqual((w_px, h_px), (100, 100))
+        self.assertGreater(chunks, 1)
+        self.assertEqual(decoded, rows)
+
+    def test_raster_surface(self):
+        surface = output_writers.create_raster_surface(37, 29)
+        draw_pattern(surface, 37, 29)
+        with mock.patch.object(output_writers, 'PNG_BAND_BYTES', 4 * 37 * 6):
+            output_writers.write_raster(surface, 'png', self.filename)
+
+        w_px, h_px, ppm, chunks, rows = read_png(self.filename)
+        self.assertEqual((w_px, h_px, ppm), (37, 29, None))
+        self.assertEqual(rows, expected_rows(37, 29, 1.0))
+
+    @unittest.skipIf(cairo is None or output_writers.PIL is None, "needs Pillow")
+    def test_pillow_decode(self):
+        with mock.patch.object(output_writers, '_PNG_PIECE_WIDTH', 16):
+            self.check_recording(45, 23, 1.0, 5)
+
+        image = output_writers.PIL.Image.open(self.filename)
+        self.assertEqual(image.size, (45, 23))
+        self.assertEqual(image.mode, 'RGB')
+        for (x, y) in [(0, 0), (15, 3), (16, 4), (44, 22), (31, 20)]:
+            self.assertEqual(image.getpixel((x, y)),
+                             block_color(x // BLOCK, y // BLOCK))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,243 @@
+# -*- coding: utf-8 -*-
+
+# ocitysmap, city map and street index generator from OpenStreetMap data
+# Copyright (C) 2023  Hartmut Holzgraefe
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Pre-forking render worker daemon
+
+The daemon parent process imports all rendering libraries, parses the
+configuration and registers fonts once, and then forks a fixed number
+of worker children sharing that state copy-on-write. The children
+accept jobs on a local Unix socket, one connection per job: the client
+sends a single line with a JSON job description (see `ocitysmap.jobs`)
+and receives a single JSON line with the result.
+
+Each child exits after a configurable number of jobs to contain
+resource leaks, and is then replaced by a fresh fork of the parent.
+Database connections are opened by the children, and kept open for
+all jobs handled by the same child.
+"""
+
+import json
+import logging
+import os
+import signal
+import socket
+import sys
+import time
+import traceback
+
+from .jobs import create_job_configuration, JobError
+from .metrics import PrometheusExporter
+
+LOG = logging.getLogger('ocitysmap')
+
+
+class _Shutdown(Exception):
+    pass
+
+def _raise_shutdown(signum, frame):
+    raise _Shutdown()
+
+
+class RenderWorkerDaemon:
+    """
+    Pre-forking worker daemon rendering jobs received on a Unix socket.
+    """
+
+    # Maximum size of a job description line
+    MAX_REQUEST_SIZE = 1024 * 1024
+
+    def __init__(self, mapper, socket_path, max_children=4,
+                 max_jobs_per_child=100, metrics_file=None):
+        """
+        Parameters
+        ----------
+        mapper : ocitysmap.OCitySMap
+            Fully initialized OCitySMap instance shared by all children
+        socket_path : str
+            File system path of the Unix socket to listen on
+        max_children : int, optional
+            Number of worker children rendering jobs concurrently
+        max_jobs_per_child : int, optional
+            Number of jobs after which a worker child is replaced
+        metrics_file : str, optional
+            Prometheus text file to export job metrics to
+        """
+        self._mapper = mapper
+        self._socket_path = socket_path
+        self._max_children = max_children
+        self._max_jobs_per_child = max_jobs_per_child
+        self._socket = None
+        self._children = set()
+        self._exporter = None
+        if metrics_file:
+            self._exporter = PrometheusExporter(metrics_file)
+
+    def serve_forever(self):
+        """ Run the daemon until SIGTERM or SIGINT is received
+
+        Parameters
+        ----------
+        none
+
+        Returns
+        -------
+        void
+        """
+        if os.path.exists(self._socket_path):
+            os.unlink(self._socket_path)
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._socket.bind(self._socket_path)
+        self._socket.listen(self._max_children * 4)
+
+        LOG.info("Render worker daemon listening on %s with %d children"
+                 % (self._socket_path, self._max_children))
+
+        signal.signal(signal.SIGTERM, _raise_shutdown)
+        signal.signal(signal.SIGINT, _raise_shutdown)
+
+        try:
+            while True:
+                while len(self._children) < self._max_children:
+                    self._spawn_child()
+
+                pid, status = os.waitpid(-1, 0)
+                if pid in self._children:
+                    self._children.remove(pid)
+                    exit_code = os.waitstatus_to_exitcode(status)
+                    if exit_code < 0:
+                        LOG.warning("Render worker %d killed by signal %d"
+                                    % (pid, -exit_code))
+                    elif exit_code != 0:
+                        LOG.warning("Render worker %d exited with status %d"
+                                    % (pid, exit_code))
+        except _Shutdown:
+            LOG.info("Shutting down render worker daemon")
+        finally:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            for pid in self._children:
+                try:
+                    os.kill(pid, signal.SIGTERM)
+                except ProcessLookupError:
+                    pass
+            for pid in self._children:
+                try:
+                    os.waitpid(pid, 0)
+                except ChildProcessError:
+                    pass
+            self._children = set()
+            self._socket.close()
+            os.unlink(self._socket_path)
+
+    def _spawn_child(self):
+        pid = os.fork()
+        if pid:
+            self._children.add(pid)
+            return
+
+        # in child process: never return into the parent main loop
+        status = 0
+        try:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            self._child_main()
+        except Exception:
+            LOG.exception("Render worker %d failed" % os.getpid())
+            status = 1
+        finally:
+            logging.shutdown()
+            os._exit(status)
+
+    def _child_main(self):
+        LOG.debug("Render worker %d started" % os.getpid())
+        for job_number in range(self._max_jobs_per_child):
+            conn, address = self._socket.accept()
+            with conn:
+                self._handle_connection(conn)
+        LOG.debug("Render worker %d retiring after %d jobs"
+                  % (os.getpid(), self._max_jobs_per_child))
+
+    def _read_request(self, conn):
+        data = b''
+        while not data.endswith(b'\n'):
+            chunk = conn.recv(65536)
+            if not chunk:
+                break
+            data += chunk
+            if len(data) > self.MAX_REQUEST_SIZE:
+                raise JobError("Job description too large")
+        return json.loads(data.decode('utf-8'))
+
+    def _handle_connection(self, conn):
+        try:
+            job = self._read_request(conn)
+            result = run_job(self._mapper, job)
+        except (ValueError, JobError) as e:
+            result = { 'status': 'error', 'error': str(e), 'elapsed': 0 }
+
+        if self._exporter is not None:
+            self._exporter.record_job(result['status'], result['elapsed'],
+                                      result.get('metrics', {}).get('totals'))
+
+        try:
+            conn.sendall((json.dumps(result) + "\n").encode('utf-8'))
+        except OSError as e:
+            LOG.warning("Could not send job result: %s" % e)
+
+
+def run_job(mapper, job):
+    """ Render a single job, catching and reporting all errors
+
+    Parameters
+    ----------
+    mapper : ocitysmap.OCitySMap
+        OCitySMap instance to render with
+    job : dict
+        Job description, see `ocitysmap.jobs`
+
+    Returns
+    -------
+    dict
+        Job result with `status` ('ok' or 'error'), the job `id` if
+        given, wall time `elapsed` in seconds, either the number of
+        output `files` written or an `error` message, and the per phase
+        `metrics` report if rendering got started
+    """
+    result = { 'id': job.get('id') }
+    start = time.time()
+    config = None
+
+    try:
+        config, renderer_name, output_formats, prefix \
+            = create_job_configuration(mapper, job)
+        result['files'] = mapper.render(config, renderer_name,
+                                        output_formats, prefix)
+        result['status'] = 'ok'
+    except JobError as e:
+        result['status'] = 'error'
+        result['error'] = str(e)
+    except Exception as e:
+        LOG.error("Job %s failed:\n%s" % (job.get('id'), traceback.format_exc()))
+        result['status'] = 'error'
+        result['error'] = "%s: %s" % (type(e).__name__, e)
+
+    result['elapsed'] = round(time.time() - start, 3)
+    if config is not None:
+        result['metrics'] = config.metrics.as_dict()
+
+    return result
@@ -24,24 +24,116 @@
 
 __version__ = '0.22'
 
+import concurrent.futures
+import json
 import logging
+import multiprocessing
 import optparse
 import os
 import sys
-import re
+import time
 
 import ocitysmap
+import ocitysmap.jobs
 import ocitysmap.layoutlib.renderers
 from coords import BoundingBox
 
-from stylelib.Gpx  import GpxProcessor
-from stylelib.Umap import UmapProcessor
-from stylelib.Poi  import PoiProcessor
-
 from pprint import pprint
 
 LOG = logging.getLogger('ocitysmap')
 
+# OCitySMap instance of a batch worker process
+_batch_mapper = None
+
+def _init_batch_worker(config_files, language):
+    global _batch_mapper
+    _batch_mapper = ocitysmap.OCitySMap(config_files, language)
+
+def _run_batch_job(numbered_line):
+    """ Render one job line of a batch file in a batch worker process """
+    from ocitysmap.worker import run_job
+
+    (line_number, line) = numbered_line
+    try:
+        job = json.loads(line)
+    except ValueError as e:
+        return { 'line': line_number, 'status': 'error',
+                 'error': 'Invalid JSON: %s' % e }
+
+    result = { 'line': line_number, 'started': time.time() }
+    result.update(run_job(_batch_mapper, job))
+    return result
+
+def run_batch(config_files, language, batch_file, workers, results_file):
+    """ Render all jobs from a JSONL batch file
+
+    Each line of the batch file holds one JSON job description, see
+    `ocitysmap.jobs` for details. Jobs are rendered by a pool of worker
+    processes, each using a single OCitySMap instance for all its jobs.
+    One JSON result line per job is written in order of completion.
+
+    Parameters
+    ----------
+    config_files : list of str
+        OCitySMap configuration files
+    language : str
+        Language to instanciate OCitySMap with
+    batch_file : str
+        Path of the JSONL job file, '-' for stdin
+    workers : int
+        Number of jobs to render in parallel
+    results_file : str
+        Path of the JSONL result file, '-' for stdout
+
+    Returns
+    -------
+    int
+        Exit status, 0 if all jobs succeeded, 2 otherwise
+    """
+    if batch_file == '-':
+        lines = sys.stdin.readlines()
+    else:
+        with open(batch_file, encoding='utf-8') as f:
+            lines = f.readlines()
+
+    jobs = [(n + 1, line) for (n, line) in enumerate(lines)
+            if line.strip() and not line.lstrip().startswith('#')]
+
+    if results_file == '-':
+        # keep log output from mixing with the result lines
+        for handler in logging.getLogger().handlers:
+            if isinstance(handler, logging.StreamHandler) \
+               and handler.stream is sys.stdout:
+                handler.setStream(sys.stderr)
+        out = sys.stdout
+    else:
+        out = open(results_file, 'w', encoding='utf-8')
+
+    failed = 0
+    try:
+        # concurrent.futures worker processes are not daemonic, unlike
+        # multiprocessing.Pool ones, so jobs can still use the output,
+        # page and map tile worker processes of their own
+        with concurrent.futures.ProcessPoolExecutor(
+                max_workers=workers,
+                mp_context=multiprocessing.get_context('fork'),
+                initializer=_init_batch_worker,
+                initargs=(config_files, language)) as executor:
+            futures = [executor.submit(_run_batch_job, job) for job in jobs]
+            for future in concurrent.futures.as_completed(futures):
+                result = future.result()
+                if result['status'] != 'ok':
+                    failed += 1
+                out.write(json.dumps(result) + "\n")
+                out.flush()
+    finally:
+        if out is not sys.stdout:
+            out.close()
+
+    LOG.info("Batch finished: %d jobs, %d failed" % (len(jobs), failed))
+
+    return 2 if failed else 0
+
 def main():
     """ Parse cmdline options and start actual renderer
 
@@ -66,13 +158,6 @@ def main():
         list(map(lambda r: "%s (%s)" % (r.name, r.description),
             ocitysmap.layoutlib.renderers.get_renderers()))
 
-    # Known paper orientations
-    KNOWN_PAPER_ORIENTATIONS = ['portrait', 'landscape']
-
-    # Import file data
-    bbox = None
-    title = None
-
     # Command line parsing
     usage = '%prog [options] [-b <lat1,long1 lat2,long2>|--osmid <osmid>]'
     parser = optparse.OptionParser(usage=usage,
@@ -85,7 +170,8 @@ def main():
                       default='citymap')
     parser.add_option('-f', '--format', dest='output_formats', metavar='FMT',
                       help='specify the output formats. Supported file '
-                           'formats: svg, svgz, pdf, ps, ps.gz, png, and csv. '
+                           'formats: svg, svgz, pdf, ps, ps.gz, png, jpg, '
+                           'webp and csv. '
                            'Defaults to PDF. May be specified multiple times.',
                       action='append')
     parser.add_option('-t', '--title', dest='output_title', metavar='TITLE',
@@ -143,6 +229,21 @@ def main():
     parser.add_option('--logo', metavar='NAME', help="SVG logo image URL, defaults to 'builtin:osm-logo.svg'")
     parser.add_option('--extra-logo', metavar='NAME', help="SVG logo image URL, defaults to None")
     parser.add_option('--extra-text', metavar='NAME', help="Extra annotation text")
+    parser.add_option('--metrics-report', metavar='FILE', dest='metrics_report',
+                      help="write a JSON report of the time spent in the "
+                           "rendering phases to FILE.")
+    parser.add_option('--batch', metavar='FILE', dest='batch_file',
+                      help="render all jobs from a JSONL file, one JSON job "
+                           "description per line, '-' for stdin. "
+                           "Single job options are ignored in this mode.")
+    parser.add_option('--batch-workers', metavar='N', dest='batch_workers',
+                      type='int', default=1,
+                      help='number of batch jobs to render in parallel. '
+                           'Defaults to 1.')
+    parser.add_option('--batch-results', metavar='FILE', dest='batch_results',
+                      default='-',
+                      help="file to write JSONL job results and timings to, "
+                           "defaults to stdout.")
     
     # deprecated legacy options
     parser.add_option('--poi-file', metavar='FILE', dest='import_file', action='append',
@@ -160,10 +261,15 @@ def main():
         parser.print_help()
         return 1
 
+    config_files = [options.config_file or os.path.join(os.environ["HOME"], '.ocitysmap.conf')]
+
+    # batch mode, all job details are read from the batch file
+    if options.batch_file:
+        return run_batch(config_files, options.language, options.batch_file,
+                         options.batch_workers, options.batch_results)
+
     # Parse config file and instanciate main object
-    mapper = ocitysmap.OCitySMap(
-        [options.config_file or os.path.join(os.environ["HOME"], '.ocitysmap.conf')],
-        options.language)
+    mapper = ocitysmap.OCitySMap(config_files, options.language)
 
     # process the --list option if present
     # just generate output and exit then
@@ -201,230 +307,45 @@ def main():
         # no match so far?
         parser.error("Unknown list option '%s'. Available options are 'stylesheets', 'overlays', 'layouts', 'indexers' and 'paper-formats'" % options.list)
 
-    # Parse stylesheet (defaults to 1st one in config file)
-    if options.stylesheet is None:
-        stylesheet = mapper.get_all_style_configurations()[0]
-    else:
-        try:
-            stylesheet = mapper.get_stylesheet_by_name(options.stylesheet)
-        except LookupError as ex:
-            parser.error("%s. Available stylesheets: %s."
-                 % (ex, ', '.join(map(lambda s: s.name,
-                      mapper.STYLESHEET_REGISTRY))))
-
-    # Parse overlay stylesheet (defaults to none)
-    overlays = []
-    if options.overlays is not None:
-        for overlay_name in options.overlays.split(","):
-            try:
-                overlays.append(mapper.get_overlay_by_name(overlay_name))
-            except LookupError as ex:
-                parser.error("%s. Available overlay stylesheets: %s."
-                     % (ex, ', '.join(map(lambda s: s.name,
-                          mapper.OVERLAY_REGISTRY))))
-
-    # Parse rendering layout
-    if options.layout is None:
-        cls_renderer = ocitysmap.layoutlib.renderers.get_renderers()[0]
-    else:
-        try:
-            cls_renderer = ocitysmap.layoutlib.renderers.get_renderer_class_by_name(options.layout)
-        except LookupError as ex:
-            parser.error("%s\nAvailable layouts: %s."
-                 % (ex, ', '.join(map(lambda lo: "%s (%s)"
-                          % (lo.name, lo.description),
-                          ocitysmap.layoutlib.renderers.get_renderers()))))
-
-    # Parse Indexer
-    if options.indexer is None:
-        indexer = 'Street'
-    else:
-        indexers = mapper.get_all_indexer_names()
-        if options.indexer in indexers:
-            indexer = options.indexer
-        else:
-            parser.error("Unknown indexer '%s'.\nAvailable indexers: %s"
-                         % (options.indexer, ", ".join(indexers)))
-            
-    # Output file formats
-    if not options.output_formats:
-        options.output_formats = ['pdf']
-    options.output_formats = set(options.output_formats)
-
-    # Reject output formats that are not supported by the renderer
-    compatible_output_formats = cls_renderer.get_compatible_output_formats()
-    for format in options.output_formats:
-        if format not in compatible_output_formats:
-            parser.error("Output format %s not supported by layout %s" %
-                         (format, cls_renderer.name))
-
-    # check paper-format option if given
-    paper_width = None
-    paper_height = None
-    if options.paper_format and options.paper_format != 'default':
-        matches = re.search('^(\d+)[x\*](\d+)$', options.paper_format)
-        if bool(matches):
-            paper_width  = int(matches.group(1))
-            paper_height = int(matches.group(2))
-        else:
-            paper_format_names = mapper.get_all_paper_size_names()
-            for format_name in paper_format_names:
-                name1 = format_name.lower().replace(" ","")
-                name2 = options.paper_format.lower().replace(" ","")
-                if name1 == name2:
-                    options.paper_format = format_name
-                    break
-            if not options.paper_format in paper_format_names:
-                parser.error("Requested paper format %s not found. Compatible paper formats are:\n\t%s."
-                             % ( options.paper_format,
-                                 ', '.join(paper_format_names)))
-
-    # get bounding box information from import files
-    if options.import_file:
-        for import_file in options.import_file:
-            import_file = os.path.realpath(import_file)
-            file_type = ocitysmap.guess_filetype(import_file)
-
-            file_bbox = None
-            if file_type == 'gpx':
-                gpx = GpxProcessor(import_file)
-                file_bbox  = gpx.getBoundingBox()
-                file_title = gpx.getTitle()
-            if file_type == 'umap':
-                umap = UmapProcessor(import_file)
-                file_bbox  = umap.getBoundingBox()
-                file_title = umap.getTitle()
-            if file_type == 'poi':
-                poi = PoiProcessor(import_file)
-                file_bbox  = poi.getBoundingBox()
-                file_title = poi.getTitle()
-
-            if file_bbox:
-                file_bbox = file_bbox.create_padded(0.1)
-                if bbox:
-                    bbox.merge(file_bbox)
-                else:
-                    bbox = file_bbox
-                if title:
-                    title = title + "; " + file_title
-                else:
-                    title = file_title
+    # Build a job description from the command line options, the
+    # job configuration logic is shared with batch mode and the
+    # render worker daemon
+    job = {
+        'prefix':       options.output_prefix,
+        'osmid':        options.osmid,
+        'title':        options.output_title,
+        'language':     options.language,
+        'stylesheet':   options.stylesheet,
+        'overlays':     options.overlays.split(",") if options.overlays else [],
+        'layout':       options.layout,
+        'indexer':      options.indexer,
+        'paper':        options.paper_format,
+        'orientation':  options.orientation,
+        'formats':      list(dict.fromkeys(options.output_formats or ['pdf'])),
+        'import_files': options.import_file or [],
+        'logo':         options.logo,
+        'extra_logo':   options.extra_logo,
+        'extra_text':   options.extra_text,
+    }
 
-    # Parse bounding box arguments when given
-    # This overrides any implicit bounding box settings
-    # derived from --osmid or --import-file options
     if options.bbox:
         try:
             bbox = BoundingBox.parse_latlon_strtuple(options.bbox)
         except ValueError:
             parser.error('Invalid bounding box!')
-        # Check that latitude and langitude are different
-        lat1, lon1 = bbox.get_top_left()
-        lat2, lon2 = bbox.get_bottom_right()
-        if lat1 == lat2:
-            parser.error('Same latitude in bounding box corners')
-        if lon1 == lon2:
-            parser.error('Same longitude in bounding box corners')
-
-    if options.osmid:
-        try:
-            osmid_bbox  = BoundingBox.parse_wkt(
-                mapper.get_geographic_info(options.osmid)[0])
-        except LookupError:
-            parser.error('No such OSM id: %d' % options.osmid)
-        if not options.bbox:
-            bbox = osmid_bbox
-
-    if bbox == None:
-        parser.error('No bounding box found, add --bbox=... option')
-
-    if options.output_title:
-        title = options.output_title
-
-    # Determine actual paper size
-
-    if paper_width and paper_height:
-        min_width, min_height = cls_renderer.get_minimal_paper_size(bbox)
-        if paper_width < min_width or paper_height < min_height:
-            parser.error("Given paper size %dmm x %dmm is too small, minimal required size is: %dmm x %dmm" %
-                         (paper_width, paper_height, min_width, min_height))
-    else:
-        compat_papers = cls_renderer.get_compatible_paper_sizes(bbox, mapper)
-        if not compat_papers:
-            parser.error("No paper size compatible with this rendering.")
-
-        paper_descr = None
-        if options.paper_format == 'default':
-            for paper in compat_papers:
-                if paper['landscape_ok'] and paper['portrait_ok']:
-                    paper_descr = paper
-                    break
-        else:
-            # Make sure the requested paper size is in list
-            for paper in compat_papers:
-                if paper['name'] == options.paper_format:
-                    paper_descr = paper
-                    break
-        if not paper_descr:
-            parser.error("Requested paper format not compatible with rendering. Compatible paper formats are:\n\t%s."
-                         % ',\n\t'.join(map(lambda p: "%s (%.1fx%.1fcm²)"
-                                            % (p['name'], p['width']/10., p['height']/10.),
-                                            compat_papers)))
-        assert paper_descr['portrait_ok'] or paper_descr['landscape_ok']
-
-        # Validate requested orientation
-        if options.orientation not in KNOWN_PAPER_ORIENTATIONS:
-            parser.error("Invalid paper orientation. Allowed orientations: %s"
-                         % KNOWN_PAPER_ORIENTATIONS)
-
-        if (options.orientation == 'portrait' and not paper_descr['portrait_ok']) or \
-           (options.orientation == 'landscape' and not paper_descr['landscape_ok']):
-            parser.error("Requested paper orientation %s not compatible with this rendering at this paper size." % options.orientation)
-
-    # Prepare the rendering config
-    rc              = ocitysmap.RenderingConfiguration()
-    rc.title        = title
-    rc.osmid        = options.osmid or None # Force to None if absent
-    rc.bounding_box = bbox
-    rc.indexer      = indexer
-    rc.language     = options.language
-    rc.stylesheet   = stylesheet
-    rc.overlays     = overlays
-
-    rc.import_files = []
-
-    if options.logo:
-        rc.logo = options.logo
-    if options.extra_logo:
-        rc.extra_logo = options.extra_logo
-    if options.extra_text:
-        rc.extra_text = options.extra_text
-                
-    # add actual import files
-    if options.import_file:
-        for import_file in options.import_file:
-            import_file = os.path.realpath(import_file)
-            file_type = ocitysmap.guess_filetype(import_file)
-            rc.import_files.append((file_type, import_file))
-
-    # set paper size
-    if paper_width and paper_height:
-        # actual dimensions given
-        rc.paper_width_mm  = paper_width
-        rc.paper_height_mm = paper_height
-    elif options.orientation == 'portrait':
-        # take dimension from choosen predefind paper
-        rc.paper_width_mm  = paper_descr['width']
-        rc.paper_height_mm = paper_descr['height']
-    else:
-        # take dimension from choosen predefind paper
-        # swapping width and height to go landscape
-        rc.paper_width_mm  = paper_descr['height']
-        rc.paper_height_mm = paper_descr['width']
+        job['bbox'] = bbox.get_top_left() + bbox.get_bottom_right()
+
+    try:
+        (rc, renderer_name, output_formats, prefix) = \
+            ocitysmap.jobs.create_job_configuration(mapper, job)
+    except ocitysmap.jobs.JobError as ex:
+        parser.error(str(ex))
 
     # now we are ready to render
-    mapper.render(rc, cls_renderer.name, options.output_formats,
-                  options.output_prefix)
+    mapper.render(rc, renderer_name, output_formats, prefix)
+
+    if options.metrics_report:
+        rc.metrics.write_json(options.metrics_report)
 
     return 0
 
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8; mode: Python -*-
+
+# ocitysmap, city map and street index generator from OpenStreetMap data
+# Copyright (C) 2023  Hartmut Holzgraefe
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+import optparse
+import os
+import sys
+
+import ocitysmap
+from ocitysmap.worker import RenderWorkerDaemon
+
+LOG = logging.getLogger('ocitysmap')
+
+def main():
+    """ Parse cmdline options and run the render worker daemon
+
+    Jobs are sent to the daemon as single line JSON job descriptions
+    over its Unix socket, e.g. using
+
+        echo '{"osmid": -62422, "prefix": "/tmp/berlin"}' \\
+            | socat - UNIX-CONNECT:/run/ocitysmap/worker.sock
+
+    Parameters
+    ----------
+    none
+        The actual input is in the cmldine parameters.
+
+    Returns
+    -------
+    int
+        Exit status, 0 for success and non-zero for error codes.
+    """
+    usage = '%prog [options] --socket <path>'
+    parser = optparse.OptionParser(usage=usage)
+    parser.add_option('-C', '--config', dest='config_file', metavar='FILE',
+                      help='specify the location of the config file.')
+    parser.add_option('-S', '--socket', dest='socket_path', metavar='PATH',
+                      help='path of the Unix socket to accept jobs on.')
+    parser.add_option('-w', '--workers', dest='workers', metavar='N',
+                      type='int', default=4,
+                      help='number of jobs to render concurrently. '
+                           'Defaults to 4.')
+    parser.add_option('--max-jobs', dest='max_jobs', metavar='N',
+                      type='int', default=100,
+                      help='number of jobs after which a worker process '
+                           'is replaced by a fresh one. Defaults to 100.')
+    parser.add_option('--metrics-file', dest='metrics_file', metavar='FILE',
+                      help='Prometheus text file to export job metrics to, '
+                           'e.g. in the node exporter textfile directory.')
+    parser.add_option('-L', '--language', dest='language',
+                      metavar='LANGUAGE_CODE',
+                      help='language to use for stylesheet descriptions '
+                           '(default=en_US.UTF-8).',
+                      default='en_US.UTF-8')
+    parser.add_option('-v', '--verbose', dest='verbose', action='store_true',
+                      help='enable debug logging.')
+
+    (options, args) = parser.parse_args()
+
+    if len(args) or not options.socket_path:
+        parser.print_help()
+        return 1
+
+    logging.basicConfig(stream=sys.stdout,
+                        level=logging.DEBUG if options.verbose else logging.INFO)
+
+    # Parse config file, register fonts and load stylesheet
+    # configuration once, to be shared by all worker processes
+    mapper = ocitysmap.OCitySMap(
+        [options.config_file or os.path.join(os.environ["HOME"], '.ocitysmap.conf')],
+        options.language)
+
+    daemon = RenderWorkerDaemon(mapper, options.socket_path,
+                                options.workers, options.max_jobs,
+                                options.metrics_file)
+    daemon.serve_forever()
+
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -42,8 +42,9 @@ designed to be printed.
       packages = ['ocitysmap',
                   'ocitysmap.maplib',
                   'ocitysmap.indexlib',
-                  'ocitysmap.layoutlib' ],
-      scripts = ['render.py' ],
+                  'ocitysmap.layoutlib',
+                  'ocitysmap.cachelib' ],
+      scripts = ['render.py', 'render_worker.py' ],
       data_files = [
           ('share/images/ocitysmap', ['images/osm-logo.png',
                                       'images/osm-logo.svg'])